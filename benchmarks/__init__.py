@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+Load test and benchmark of the Todoer routes.
+
+It seeds a SQLite database with users and todos, and drives the app built by create_app() through the Flask test
+ client and through a local WSGI server, from concurrent simulated users. For each route it reports the p50/p95/p99
+ latency, the requests per second, the SQL statements per request and the peak RSS of the process.
+Run it from the root of the project, e.g.:
+    python -m benchmarks --users 50 --todos 100000 --requests 2000 --concurrency 8
+    python -m benchmarks --json --output bench.json
+"""
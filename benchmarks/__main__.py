@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# JSON: output of the results, to compare the runs across commits
+import json
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Platform: version of Python, recorded with the results
+import platform
+# SQLite3: version of SQLite, recorded with the results
+import sqlite3
+# Subprocess: asks git for the commit being measured
+import subprocess
+# Tempfile: directory of the seeded database, unless one is given
+import tempfile
+# Time: clock used to time the seeding
+import time
+
+from todoer import create_app
+
+from benchmarks.drivers import DRIVERS
+from benchmarks.materialize import measure_materialization
+from benchmarks.runner import SCENARIOS, WRITE_SCENARIOS, install_statement_counter, run_scenario
+from benchmarks.seed import seed
+from benchmarks.startup import measure_cold_starts
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ('git', 'rev-parse', 'HEAD'), capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _window(window: float) -> str:
+    return '-' if window is None else f'{window * 1000:g}ms'
+
+
+def _print_table(results: list):
+    click.echo(
+        f'{"scenario":<12} {"driver":<7} {"window":>7} {"shards":>6} {"requests":>8} {"errors":>6} {"req/s":>9}'
+        f' {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"stmts/req":>9} {"peak RSS MB":>11}'
+    )
+    for result in results:
+        rss = result['peak_rss_bytes']
+        click.echo(
+            f'{result["scenario"]:<12} {result["driver"]:<7} {_window(result["write_window"]):>7}'
+            f' {result["shards"] or "-":>6} {result["requests"]:>8} {result["errors"]:>6}'
+            f' {result["requests_per_second"]:>9.1f} {result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f}'
+            f' {result["p99_ms"]:>8.2f} {result["statements_per_request"]:>9.2f}'
+            f' {(rss / 2 ** 20 if rss else float("nan")):>11.1f}'
+        )
+
+
+def _print_startup(startup: dict):
+    click.echo(f'{"start":<22} {"import ms":>9} {"create_app ms":>13} {"1st request ms":>14} {"2nd request ms":>14}')
+    for name, start in startup.items():
+        click.echo(
+            f'{name:<22} {start["import_ms"]:>9.1f} {start["create_app_ms"]:>13.1f}'
+            f' {start["first_request_ms"]:>14.1f} {start["second_request_ms"]:>14.1f}'
+        )
+    click.echo()
+
+
+def _print_materialization(materialization: dict):
+    click.echo(f'{"rows of a page":<14} {"rows":>7} {"us/row":>7} {"bytes/row":>9}')
+    for name, measure in materialization.items():
+        click.echo(f'{name:<14} {measure["rows"]:>7} {measure["us_per_row"]:>7.2f} {measure["bytes_per_row"]:>9.0f}')
+    click.echo()
+
+
+@click.command()
+@click.option('--users', default=50, show_default=True, help='Seeded users.')
+@click.option('--todos', default=100000, show_default=True, help='Seeded todos.')
+@click.option('--requests', default=1000, show_default=True, help='Requests per scenario and driver.')
+@click.option('--concurrency', default=8, show_default=True, help='Simulated users sending requests at the same time.')
+@click.option('--driver', 'drivers', type=click.Choice(('client', 'server', 'both')), default='both',
+              show_default=True, help='Flask test client, local WSGI server, or both.')
+@click.option('--scenario', 'scenarios', type=click.Choice(tuple(SCENARIOS)), multiple=True,
+              help='Scenario to run, can be repeated. Defaults to all of them.')
+@click.option('--write-window', 'write_windows', type=float, multiple=True,
+              help='Also run the write scenarios with the write queue and this batch window in seconds, can be'
+                   ' repeated to compare windows.')
+@click.option('--shards', 'shard_counts', type=int, multiple=True,
+              help='Also run the write scenarios with the todos sharded across this number of SQLite files, seeded'
+                   ' apart, can be repeated to compare shard counts.')
+@click.option('--page-rows', default=100000, show_default=True,
+              help='Size of the page of todos whose materialization is measured.')
+@click.option('--database', type=click.Path(dir_okay=False),
+              help='SQLite file to seed, overwritten. Defaults to a temporary file.')
+@click.option('--config', 'config_file', default='', help='Config file of the app. Defaults to config.py.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON.')
+@click.option('--output', type=click.File('w', encoding='utf8'), help='Also write the JSON results to a file.')
+def main(users, todos, requests, concurrency, drivers, scenarios, write_windows, shard_counts, page_rows, database,
+         config_file, as_json, output):
+    """
+    Seed a database, and measure every route of Todoer under concurrent load.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.abspath(database or os.path.join(directory, 'benchmark.db'))
+        app = create_app(config_file)
+        app.config['DATABASE'] = database
+
+        started = time.perf_counter()
+        seed(app, users, todos)
+        seed_seconds = time.perf_counter() - started
+        if not as_json:
+            click.echo(f'Seeded {users} users and {todos} todos in {seed_seconds:.2f} seconds.', err=True)
+
+        # Start of the app in new processes, before this one warms anything up
+        startup = measure_cold_starts(database, config_file)
+        # Cost of turning the rows of a big page into the todos of the list
+        materialization = measure_materialization(app, page_rows)
+
+        results = []
+        # The run without the write queue, then one run of the write scenarios per batch window, and then one per
+        #  shard count
+        for window, shards in ((None, 0), *((window, 0) for window in write_windows),
+                               *((None, shards) for shards in shard_counts)):
+            # A fresh app, so every connection of its pools is opened after the seeding and counts its statements
+            app = create_app(config_file)
+            app.config['DATABASE'] = database
+            # Errors are answered with 500 and counted, as in production, instead of stopping the run
+            app.config['PROPAGATE_EXCEPTIONS'] = False
+            app.config['WRITE_QUEUE'] = window is not None
+            if window is not None:
+                app.config['WRITE_QUEUE_WINDOW'] = window
+            if shards:
+                # The sharded runs have their own databases, seeded with the same todos by another app, so the pools of
+                #  this one are still to be opened
+                app.config.update(
+                    DATABASE=os.path.join(directory, f'benchmark-{shards}-shards.db'),
+                    SHARDS=shards,
+                    SHARD_DIR=os.path.join(directory, f'shards-{shards}')
+                )
+                seed_app = create_app(config_file)
+                seed_app.config.update({key: app.config[key] for key in ('DATABASE', 'SHARDS', 'SHARD_DIR')})
+                seed(seed_app, users, todos)
+            counter = install_statement_counter(app)
+
+            for name in ('client', 'server') if drivers == 'both' else (drivers, ):
+                with DRIVERS[name](app) as driver:
+                    for scenario in scenarios or SCENARIOS:
+                        if (window is not None or shards) and scenario not in WRITE_SCENARIOS:
+                            continue
+                        result = run_scenario(driver, SCENARIOS[scenario], counter, users, requests, concurrency)
+                        result['write_window'] = window
+                        results.append(result)
+                        if not as_json:
+                            click.echo(
+                                f'{name} {scenario}{"" if window is None else f" window {window}"}'
+                                f'{f" {shards} shards" if shards else ""}:'
+                                f' {result["requests_per_second"]:.1f} req/s',
+                                err=True
+                            )
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'users': users,
+            'todos': todos,
+            'requests': requests,
+            'concurrency': concurrency,
+            'seed_seconds': seed_seconds,
+        },
+        'startup': startup,
+        'materialization': materialization,
+        'results': results,
+    }
+    if output:
+        json.dump(report, output, indent=2)
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        _print_startup(startup)
+        _print_materialization(materialization)
+        _print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# HTTP.client: HTTP client used against the local WSGI server
+import http.client
+# Threading: the local WSGI server runs in a background thread
+import threading
+# URLLib: encodes the form data of the requests
+from urllib.parse import urlencode
+
+# Werkzeug: "make_server" creates the local, multi-threaded, WSGI server
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+
+class TestClientSession:
+    """
+    Session of one simulated user, sending the requests in-process through the Flask test client, so only the app is
+     measured, without the network and the HTTP server.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, data: dict = None) -> int:
+        """
+        :param method: HTTP method
+        :param path: path of the URL, with the query string
+        :param data: form data
+
+        :return: HTTP status code of the response
+        """
+        response = self.client.open(path, method=method, data=data)
+        response.close()
+        return response.status_code
+
+
+class TestClientDriver:
+    """
+    Drives the app through the Flask test client.
+    """
+    name = 'client'
+
+    def __init__(self, app):
+        self.app = app
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def session(self) -> TestClientSession:
+        return TestClientSession(self.app)
+
+
+class HTTPSession:
+    """
+    Session of one simulated user, sending real HTTP requests to the local WSGI server, and keeping its session cookie.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = None
+
+    def request(self, method: str, path: str, data: dict = None) -> int:
+        """
+        :param method: HTTP method
+        :param path: path of the URL, with the query string
+        :param data: form data
+
+        :return: HTTP status code of the response
+        """
+        headers = {}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    # Keeps the connections alive between requests, as a production server does, and doesn't log every request
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WSGIServerDriver:
+    """
+    Drives the app through a local multi-threaded WSGI server, serving from a background thread.
+    """
+    name = 'server'
+
+    def __init__(self, app, host: str = '127.0.0.1'):
+        self.app = app
+        self.host = host
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        # Port 0 lets the OS choose a free port
+        self.server = make_server(self.host, 0, self.app, threaded=True, request_handler=_QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+    def session(self) -> HTTPSession:
+        return HTTPSession(self.host, self.server.server_port)
+
+
+DRIVERS = {driver.name: driver for driver in (TestClientDriver, WSGIServerDriver)}
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Time: clock used to time the materialization
+import time
+# Tracemalloc: memory allocated by the rows of a page
+import tracemalloc
+
+from todoer.db import get_read_db
+from todoer.todo import TODO_COLUMNS, build_todo_page_query, fetch_todos
+from todoer.usernames import get_usernames
+
+# The same columns with the timestamps as declared, so PARSE_DECLTYPES parses each of them into a datetime
+_DECLTYPES_COLUMNS = (
+    'todo.id, todo.task, todo.description, todo.created_by, todo.created_at, todo.completed, todo.completed_at'
+)
+
+
+def _rows_as_dicts(conn, sql: str, parameters) -> list:
+    # The list views before the records: a sqlite3.Row per row, with parsed timestamps, copied into a dict
+    return get_usernames().attach(conn.execute(sql.replace(TODO_COLUMNS, _DECLTYPES_COLUMNS), parameters), conn)
+
+
+def _rows_as_records(conn, sql: str, parameters) -> list:
+    return fetch_todos(conn, sql, parameters)
+
+
+# Ways of materializing the rows of a page, the current one last
+MATERIALIZERS = {'row_dicts': _rows_as_dicts, 'records': _rows_as_records}
+
+
+def measure_materialization(app, rows: int = 100000, repeat: int = 3) -> dict:
+    """
+    Fetch one page of the todo list with every way of materializing its rows, and measure the time and the memory per
+     row. The best of some runs is kept, as the query is the same for all.
+
+    :param app: application, whose database is seeded
+    :param rows: page size
+    :param repeat: runs of each way
+
+    :return: measures of each way: rows, microseconds per row and bytes allocated per row
+    """
+    results = {}
+    with app.app_context():
+        conn = get_read_db()
+        sql, parameters = build_todo_page_query(per_page=rows)
+        for name, materialize in MATERIALIZERS.items():
+            seconds = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                page = materialize(conn, sql, parameters)
+                seconds.append(time.perf_counter() - started)
+                del page
+
+            # Measured apart, as tracing the allocations slows them down
+            tracemalloc.start()
+            try:
+                page = materialize(conn, sql, parameters)
+                allocated = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            results[name] = {
+                'rows': len(page),
+                'us_per_row': min(seconds) / max(len(page), 1) * 10 ** 6,
+                'bytes_per_row': allocated / max(len(page), 1),
+            }
+            del page
+    return results
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent.futures: the simulated users send their requests from a pool of threads
+from concurrent.futures import ThreadPoolExecutor
+# Sys: the platform, which sets the unit of the peak resident set size
+import sys
+# Threading: lock of the statement counter, shared by all the connections
+import threading
+# Time: clock used to time the requests
+import time
+# URLLib: encodes the query string of the requests
+from urllib.parse import urlencode
+
+from todoer.db import get_pool, get_read_db
+from todoer.shards import database_ids, user_shard
+from todoer.todo import encode_cursor
+
+from benchmarks.seed import PASSWORD, username
+
+try:
+    # Resource: usage of the process resources, only available on Unix
+    import resource
+except ImportError:
+    resource = None
+
+
+class StatementCounter:
+    """
+    Count the SQL statements run by every connection of the pools, through the trace callback of the connections.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def install(self, conn):
+        conn.set_trace_callback(self._trace)
+
+    def _trace(self, statement: str):
+        # The statements run inside triggers are reported as '-- TRIGGER ...', they are not requested by the app
+        if not statement.startswith('--'):
+            with self._lock:
+                self.count += 1
+
+
+def peak_rss() -> int:
+    """
+    :return: peak resident set size of the process, in bytes, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def percentile(values: list, rank: float) -> float:
+    """
+    :param values: sorted values
+    :param rank: percentile, from 0 to 100
+
+    :return: value at the percentile, by the nearest-rank method
+    """
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(round(rank / 100 * len(values))) - 1))]
+
+
+class Scenario:
+    """
+    Requests of one route. Each simulated user gets its own session, logged in as one of the seeded users when the
+     route requires it, and sends its share of the requests.
+    """
+
+    def __init__(self, name: str, login: bool = True):
+        self.name = name
+        self.login = login
+
+    def prepare(self, app, users: int, concurrency: int):
+        """
+        Look up in the database whatever the requests need, before they are timed.
+        """
+
+    def request(self, worker: int, user: int, number: int) -> tuple:
+        """
+        :param worker: number of the simulated user
+        :param user: number of the seeded user it is logged in as
+        :param number: number of the request of the simulated user
+
+        :return: tuple (method, path, form data)
+        """
+        raise NotImplementedError
+
+
+class IndexScenario(Scenario):
+    def request(self, worker, user, number):
+        return 'GET', '/', None
+
+
+class DeepIndexScenario(Scenario):
+    # Page of the index 90% deep into the list, through its cursor
+    def prepare(self, app, users, concurrency):
+        with app.app_context():
+            db = get_read_db()
+            count = db.execute('SELECT COUNT(*) FROM todo').fetchone()[0]
+            todo = db.execute(
+                'SELECT id, created_at FROM todo ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?',
+                (count * 9 // 10, )
+            ).fetchone()
+        self.path = f'/?{urlencode({"before": encode_cursor(todo)})}' if todo else '/'
+
+    def request(self, worker, user, number):
+        return 'GET', self.path, None
+
+
+class APIPageScenario(DeepIndexScenario):
+    # Large page of the JSON API, which is not cached, from 90% deep into the list
+    def prepare(self, app, users, concurrency):
+        super().prepare(app, users, concurrency)
+        self.path = '/api/todos' + (self.path[1:] + '&' if '?' in self.path else '?') + 'per_page=500'
+
+
+class StatsScenario(Scenario):
+    def request(self, worker, user, number):
+        return 'GET', '/stats', None
+
+
+class CreateScenario(Scenario):
+    def request(self, worker, user, number):
+        return 'POST', '/create', {'task': f'Benchmark task {worker}-{number}', 'description': 'Created by benchmark.'}
+
+
+class OwnTodosScenario(Scenario):
+    # Requests on the todos of the seeded user, read from their shard when sharded
+    def prepare(self, app, users, concurrency):
+        with app.app_context():
+            self.todo_ids = {
+                user: [row[0] for row in get_read_db(user_shard(user)).execute(
+                    'SELECT id FROM todo WHERE created_by = ? ORDER BY id', (user, )
+                )]
+                for user in {worker % users + 1 for worker in range(concurrency)}
+            }
+
+
+class UpdateScenario(OwnTodosScenario):
+    def request(self, worker, user, number):
+        ids = self.todo_ids[user]
+        # The simulated users logged in as the same seeded user take turns over its todos
+        id = ids[(worker + number) % len(ids)] if ids else 0
+        return 'POST', f'/{id}/update', {'task': f'Updated task {number}', 'description': 'Updated by benchmark.'}
+
+
+class DeleteScenario(OwnTodosScenario):
+    def request(self, worker, user, number):
+        # Each todo can be deleted once, so the simulated users consume the list of the seeded user
+        ids = self.todo_ids[user]
+        id = ids.pop() if ids else 0
+        return 'POST', f'/{id}/delete', None
+
+
+class LoginScenario(Scenario):
+    def request(self, worker, user, number):
+        return 'POST', '/auth/login', {'username': username(user), 'password': PASSWORD}
+
+
+class RegisterScenario(Scenario):
+    def prepare(self, app, users, concurrency):
+        # Unique per run, so the usernames never collide with the ones of a previous run on the same database
+        self.run = f'{time.time_ns():x}'
+
+    def request(self, worker, user, number):
+        return 'POST', '/auth/register', {'username': f'bench-{self.run}-{worker}-{number}', 'password': PASSWORD}
+
+
+# The scenarios, in the order they run. The ones that change data go last, so the reads are measured on the seeded data.
+SCENARIOS = {scenario.name: scenario for scenario in (
+    IndexScenario('index'),
+    DeepIndexScenario('index_deep'),
+    APIPageScenario('api_page'),
+    StatsScenario('stats', login=False),
+    LoginScenario('login', login=False),
+    CreateScenario('create'),
+    UpdateScenario('update'),
+    DeleteScenario('delete'),
+    RegisterScenario('register', login=False),
+)}
+# The scenarios whose writes go through the write queue, when it is enabled
+WRITE_SCENARIOS = ('create', 'update', 'delete')
+
+
+def install_statement_counter(app) -> StatementCounter:
+    """
+    Count the statements of every connection the pools of the app open from now on.
+    Must be called before the app opens any connection.
+
+    :param app: application
+
+    :return: the counter
+    """
+    counter = StatementCounter()
+    with app.app_context():
+        for database in database_ids():
+            for readonly in (False, True):
+                get_pool(readonly, shard=database).on_connect.append(counter.install)
+    return counter
+
+
+def run_scenario(driver,
+                 scenario: Scenario,
+                 counter: StatementCounter,
+                 users: int,
+                 requests: int,
+                 concurrency: int) -> dict:
+    """
+    Send the requests of a scenario from concurrent simulated users, and measure them.
+
+    :param driver: driver of the app, see drivers.DRIVERS
+    :param scenario: scenario to run
+    :param counter: counter of the SQL statements
+    :param users: number of seeded users
+    :param requests: total number of requests, shared among the simulated users
+    :param concurrency: number of simulated users sending requests at the same time
+
+    :return: measures of the scenario
+    """
+    scenario.prepare(driver.app, users, concurrency)
+
+    # The sessions are opened, and logged in, before the clock starts
+    sessions = []
+    for worker in range(concurrency):
+        session = driver.session()
+        user = worker % users + 1
+        if scenario.login:
+            session.request('POST', '/auth/login', {'username': username(user), 'password': PASSWORD})
+        sessions.append((session, user))
+
+    def simulate(worker: int) -> tuple:
+        session, user = sessions[worker]
+        latencies, errors = [], 0
+        for number in range(worker, requests, concurrency):
+            method, path, data = scenario.request(worker, user, number)
+            started = time.perf_counter()
+            status = session.request(method, path, data)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors += 1
+        return latencies, errors
+
+    statements = counter.count
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(simulate, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    statements = counter.count - statements
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    return {
+        'scenario': scenario.name,
+        'driver': driver.name,
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'statements_per_request': statements / len(latencies) if latencies else 0.0,
+        'peak_rss_bytes': peak_rss(),
+        'shards': driver.app.config.get('SHARDS', 0),
+    }
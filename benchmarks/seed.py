@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# datetime: this module supplies classes for manipulating dates and times.
+import datetime as dt
+# Random: spreads the todos among the users, and picks which ones are completed
+import random
+# SQLite3: support for SQLite
+import sqlite3
+
+# Werkzeug: has inbuilt functions for password hashing
+from werkzeug.security import generate_password_hash
+
+from todoer.db import init_db, shard_path
+
+# Password of every seeded user
+PASSWORD = 'benchmark'
+
+
+def username(number: int) -> str:
+    """
+    :param number: number of the seeded user, starting at 1
+
+    :return: username of the seeded user
+    """
+    return f'user{number:05d}'
+
+
+def seed(app,
+         users: int = 50,
+         todos: int = 100000,
+         completed_ratio: float = 0.3,
+         batch_size: int = 10000,
+         random_seed: int = 42):
+    """
+    Create the schema of the app database and fill it with users and todos.
+    The todos are spread along the last year, in the order of their ids, and randomly among the users. When the app is
+     sharded, each user is pinned to the shard given by their id, and their todos are inserted there.
+
+    :param app: application whose DATABASE is seeded
+    :param users: number of users
+    :param todos: number of todos
+    :param completed_ratio: ratio of completed todos
+    :param batch_size: rows inserted per executemany
+    :param random_seed: seed of the random generator, so the runs are comparable
+    """
+    with app.app_context():
+        init_db()
+
+    rng = random.Random(random_seed)
+    # All the users share the same password, so it is hashed once
+    password = generate_password_hash(PASSWORD, app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000'))
+
+    db = sqlite3.connect(app.config['DATABASE'])
+    db.executemany(
+        'INSERT INTO user (id, username, password) VALUES (?, ?, ?)',
+        ((number, username(number), password) for number in range(1, users + 1))
+    )
+    shards = app.config.get('SHARDS', 0)
+    if shards:
+        db.executemany(
+            'INSERT INTO user_shard (user_id, shard) VALUES (?, ?)',
+            ((number, number % shards) for number in range(1, users + 1))
+        )
+        db.commit()
+        db.close()
+        with app.app_context():
+            targets = [sqlite3.connect(shard_path(shard)) for shard in range(shards)]
+    else:
+        targets = [db]
+
+    start = dt.datetime.now() - dt.timedelta(days=365)
+    step = dt.timedelta(days=365) / max(todos, 1)
+    # The todos of each target database, the shards or the main one
+    batches = [[] for _ in targets]
+    for number in range(todos):
+        created_at = start + step * number
+        completed = rng.random() < completed_ratio
+        user = rng.randint(1, users)
+        batch = batches[user % len(targets)]
+        batch.append((
+            user, created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            f'Task number {number}', f'Description of the task number {number}, seeded for the benchmark.',
+            int(completed),
+            (created_at + dt.timedelta(hours=rng.randint(1, 240))).strftime('%Y-%m-%d %H:%M:%S') if completed else None
+        ))
+        if len(batch) >= batch_size:
+            _insert_todos(targets[user % len(targets)], batch)
+    for target, batch in zip(targets, batches):
+        _insert_todos(target, batch)
+        target.commit()
+        target.execute('ANALYZE')
+        target.close()
+
+
+def _insert_todos(db, batch: list):
+    db.executemany(
+        'INSERT INTO todo (created_by, created_at, task, description, completed, completed_at)'
+        ' VALUES (?, ?, ?, ?, ?, ?)',
+        batch
+    )
+    batch.clear()
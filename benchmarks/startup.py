@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# JSON: the measures are sent back to the benchmark as JSON
+import json
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Subprocess: each start is measured in a new Python process, so nothing is already imported nor compiled
+import subprocess
+# Sys: the Python interpreter running the benchmark
+import sys
+# Tempfile: directory of the settings and of the template cache of the measured starts
+import tempfile
+# Time: clock used to time the start
+import time
+
+# Root of the project, where the measured processes are started
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def measure_start(config_file: str = '') -> dict:
+    """
+    Measure, in the current process, the start of the app and its first requests.
+
+    :param config_file: config file of the app, defaults to config.py
+
+    :return: milliseconds of the import, create_app() and the first and second requests of the index
+    """
+    started = time.perf_counter()
+    from todoer import create_app
+    imported = time.perf_counter()
+    app = create_app(config_file)
+    created = time.perf_counter()
+    client = app.test_client()
+    client.get('/').close()
+    first = time.perf_counter()
+    client.get('/').close()
+    second = time.perf_counter()
+    return {
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': (first - created) * 1000,
+        'second_request_ms': (second - first) * 1000,
+    }
+
+
+def measure_cold_starts(database: str, config_file: str = '') -> dict:
+    """
+    Start the app in new processes, first with an empty template bytecode cache and then with the cache filled by the
+     first start, as a worker started after a deploy would find it without and with flask compile-templates.
+
+    :param database: SQLite file of the app
+    :param config_file: config file of the app, defaults to config.py
+
+    :return: measures of each start, see measure_start()
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        settings = os.path.join(directory, 'settings.py')
+        with open(settings, 'w', encoding='utf8') as f:
+            f.write(f'DATABASE = {database!r}\nTEMPLATE_CACHE_DIR = {os.path.join(directory, "cache")!r}\n')
+        env = {**os.environ, 'TODOER_SETTINGS': settings}
+
+        for name in ('empty_template_cache', 'filled_template_cache'):
+            completed = subprocess.run(
+                (sys.executable, '-m', 'benchmarks.startup', os.path.abspath(config_file) if config_file else ''),
+                cwd=_ROOT, env=env, capture_output=True, text=True, check=True
+            )
+            results[name] = json.loads(completed.stdout)
+    return results
+
+
+if __name__ == '__main__':
+    # Run by measure_cold_starts(), with the config file as argument
+    print(json.dumps(measure_start(sys.argv[1])))
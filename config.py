@@ -10,8 +10,9 @@ import os
 # Define the application directory
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-# Statement for enabling the development environment
-DEBUG = True
+# Statement for enabling the development environment, as runDevMode does.
+# The production settings, with debug off, are in config_production.py
+DEBUG = os.environ.get('FLASK_ENV') == 'development'
 
 # Statement for environment type
 # ENV = 'production'
@@ -19,10 +20,185 @@ DEBUG = True
 # Define the database - we are working with SQLite for this example
 # DATABASE = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
 DATABASE = os.path.join(BASE_DIR, 'app.db')
+# Additional keyword arguments for sqlite3.connect, e.g. {'timeout': 10}
 DATABASE_CONNECT_OPTIONS = {}
 
+# Pools of database connections, opened once and reused by the requests.
+#   - DATABASE_POOL_SIZE: maximum number of read-only connections open at the same time
+#   - DATABASE_WRITER_POOL_SIZE: maximum number of writer connections. SQLite allows one writer at a time, so with 1
+#     the requests that change data are serialized in the pool instead of failing with "database is locked"
+#   - DATABASE_POOL_TIMEOUT: seconds a request waits for a free connection before failing
+#   - DATABASE_POOL_PING_AFTER: seconds a connection can stay idle before being health checked when it is reused
+DATABASE_POOL_SIZE = 8
+DATABASE_WRITER_POOL_SIZE = 1
+DATABASE_POOL_TIMEOUT = 10.0
+DATABASE_POOL_PING_AFTER = 30.0
+
+# PRAGMAs applied once to each new connection of the pool, in order. Visit https://www.sqlite.org/pragma.html
+#   - auto_vacuum INCREMENTAL: lets the maintenance job "incremental_vacuum" give the free pages back to the file
+#     system. It only takes effect when the database file is created, so it goes before the journal mode
+#   - journal_mode WAL: readers don't block the writer, and the writer doesn't block the readers
+#   - synchronous NORMAL: safe with WAL, it syncs on checkpoints instead of on every commit
+#   - mmap_size: bytes of the database file read through memory-mapped I/O
+#   - cache_size: negative values are KiB of page cache per connection
+#   - busy_timeout: milliseconds to wait for a lock before failing with "database is locked"
+DATABASE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -16000,
+    'busy_timeout': 5000,
+}
+
+# In-process cache of the logged-in users rows, to avoid querying the database on every request.
+#   - USER_CACHE_SIZE: maximum number of users cached, the least recently used ones are evicted first
+#   - USER_CACHE_TTL: seconds a cached user row lives
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 300.0
+
+# In-process map from user id to username, shown on the todos without joining the user table, see todoer/usernames.py
+#   - USERNAME_CACHE_SIZE: maximum number of usernames kept, the least recently shown ones are evicted first
+#   - USERNAME_CACHE_TTL: seconds a username is kept, None to keep it until evicted, as a username never changes
+USERNAME_CACHE_SIZE = 16384
+USERNAME_CACHE_TTL = None
+
+# Password hashing, done in a pool of worker processes to keep the CPU-heavy work out of the request threads.
+#   - PASSWORD_HASH_METHOD: method and cost of the new hashes. When it changes, the stored hashes are upgraded as the
+#     users log in
+#   - PASSWORD_HASH_WORKERS: number of worker processes, 0 to hash in the request thread
+#   - PASSWORD_HASH_MAX_PENDING: maximum number of hashing jobs running or queued, beyond it requests get a 503
+#   - PASSWORD_HASH_TIMEOUT: seconds a request waits for its hashing job
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_MAX_PENDING = 16
+PASSWORD_HASH_TIMEOUT = 10.0
+
+# Login throttling: a username or IP address with LOGIN_MAX_FAILURES failed logins within the last
+#  LOGIN_FAILURE_WINDOW seconds is refused until the window slides
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 300.0
+
+# Number of todos shown on each page of the todo list
+TODOS_PER_PAGE = 20
+
+# Number of results shown on each page of the full-text search
+SEARCH_PER_PAGE = 20
+
+# JSON API: maximum page size of the todo list, and maximum number of operations of a bulk request
+API_MAX_PER_PAGE = 500
+API_BULK_MAX_ITEMS = 10000
+
+# Schema migrations (flask db-upgrade): rows per batch of the backfills, each one in its own short transaction, and
+#  seconds of pause between batches, so the live requests can take the write lock in between
+MIGRATION_BATCH_SIZE = 5000
+MIGRATION_PAUSE = 0.05
+
+# Export and import of todos: rows read per batch of the streamed export, and rows per transaction of the import
+EXPORT_BATCH_SIZE = 1000
+IMPORT_COMMIT_INTERVAL = 10000
+
+# In-process caches of rendered html, to avoid rendering again what has not changed.
+#   - PAGE_CACHE_SIZE / PAGE_CACHE_TTL: whole pages of the todo list, per user and page
+#   - CARD_CACHE_SIZE / CARD_CACHE_TTL: cards of each todo
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 300.0
+CARD_CACHE_SIZE = 4096
+CARD_CACHE_TTL = 3600.0
+
+# Group commit of the writes of the todo views, disabled by default. When enabled, a writer thread applies the writes of
+#  many requests in one transaction per batch, and each request waits until its batch is committed.
+#   - WRITE_QUEUE_WINDOW: seconds a batch waits for more writes after its first one. Longer windows make larger batches,
+#     raising the write throughput under bursts at the cost of some latency
+#   - WRITE_QUEUE_MAX_BATCH: maximum number of writes per transaction
+#   - WRITE_QUEUE_TIMEOUT: seconds a request waits for its write to be committed before failing
+WRITE_QUEUE = False
+WRITE_QUEUE_WINDOW = 0.002
+WRITE_QUEUE_MAX_BATCH = 256
+WRITE_QUEUE_TIMEOUT = 10.0
+
+# Live updates of the todo list: the index follows the change feed of the todos through Server-Sent Events, and patches
+#  its cards instead of reloading, see todoer/feed.py. Each open stream holds a thread of the server:
+#   - LIVE_UPDATES_MAX_STREAMS: streams open at the same time in each process, the production server serves at most half
+#     its threads as streams, see THREADS_PER_PAGE
+#   - LIVE_UPDATES_STREAM_SECONDS: seconds after which a stream ends, and the browser reconnects from its last change
+#   - LIVE_UPDATES_POLL_INTERVAL: seconds between checks for changes made by other processes, the ones of the same
+#     process are pushed right away
+#   - LIVE_UPDATES_BATCH_SIZE: changes read per query
+#   - LIVE_UPDATES_MAX_BACKLOG: changes behind from which the client reloads the page instead
+#   - LIVE_UPDATES_RETENTION: seconds the changes are kept, see flask prune-changes
+LIVE_UPDATES = True
+LIVE_UPDATES_MAX_STREAMS = 16
+LIVE_UPDATES_STREAM_SECONDS = 30.0
+LIVE_UPDATES_POLL_INTERVAL = 1.0
+LIVE_UPDATES_BATCH_SIZE = 500
+LIVE_UPDATES_MAX_BACKLOG = 1000
+LIVE_UPDATES_RETENTION = 86400.0
+
+# Maintenance of the database by a background thread of each process, disabled by default, see todoer/maintenance.py.
+#  The jobs also run from the CLI, with: flask maintenance. Each job runs when due during a quiet period of the process,
+#  or once overdue by another period, and stops at its time budget:
+#   - MAINTENANCE_JOBS: period ('every') and time budget ('budget'), in seconds, of each scheduled job
+#   - MAINTENANCE_CHECK_INTERVAL: seconds between checks for due jobs
+#   - MAINTENANCE_QUIET_SECONDS: seconds without requests nor changes of the data that make a quiet period
+#   - ARCHIVE_AFTER_DAYS: days after their completion that the todos are moved to the archive, browsed at /archive
+#   - ARCHIVE_BATCH_SIZE: todos moved per transaction, at most 500
+#   - ANALYSIS_LIMIT: rows of each index sampled by ANALYZE
+#   - VACUUM_PAGES_PER_STEP: free pages given back per transaction by the incremental vacuum
+#   - CHECKPOINT_MODE: mode of the WAL checkpoints, PASSIVE never waits for the readers nor blocks the writers
+MAINTENANCE = False
+MAINTENANCE_JOBS = {
+    'archive': {'every': 3600.0, 'budget': 5.0},
+    'prune_changes': {'every': 3600.0, 'budget': 2.0},
+    'incremental_vacuum': {'every': 3600.0, 'budget': 2.0},
+    'analyze': {'every': 86400.0, 'budget': 10.0},
+    'checkpoint': {'every': 300.0, 'budget': 2.0},
+}
+MAINTENANCE_CHECK_INTERVAL = 10.0
+MAINTENANCE_QUIET_SECONDS = 5.0
+ARCHIVE_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 500
+ANALYSIS_LIMIT = 1000
+VACUUM_PAGES_PER_STEP = 256
+CHECKPOINT_MODE = 'PASSIVE'
+
+# Sharding of the todos by user across SQLite files, disabled by default (0). When enabled, the main database keeps the
+#  users, and the todos of each user live in one of SHARDS files, so the writes of users in different shards don't
+#  wait for each other. The listings of all the users merge the shards, and the live updates are disabled. Move the
+#  todos of an existing database into the shards, or balance them, with: flask rebalance-shards. While a user is being
+#  moved, the lists of their todos miss the ones already copied to the new shard, and their writes are refused with
+#  503, until the move ends.
+#   - SHARD_DIR: folder of the shard files, shard-0.db, shard-1.db, ..., and of the rebalance generation, a counter
+#     that every process maps in memory and that flask rebalance-shards bumps after each move
+#   - SHARD_MAP_TTL: seconds each process keeps the shard of a user before reading it again. A user moved meanwhile is
+#     noticed earlier, on their next request, by the bump of the rebalance generation
+SHARDS = 0
+SHARD_DIR = os.path.join(BASE_DIR, 'instance', 'shards')
+SHARD_MAP_TTL = 60.0
+
+# Templates: compiled code cached on disk, shared by the processes and kept across restarts (None to disable), and
+#  check of the template files for changes on each render, only while developing
+TEMPLATE_CACHE_DIR = os.path.join(BASE_DIR, 'instance', 'template_cache')
+TEMPLATES_AUTO_RELOAD = os.environ.get('FLASK_ENV') == 'development'
+
+# Instrumentation of the requests, disabled by default. When enabled, the statements and the rendering of each request
+#  are timed, the responses get a Server-Timing header, and /metrics exposes histograms by endpoint for Prometheus.
+#   - SLOW_QUERY_THRESHOLD: seconds from which a statement is logged with its query plan, None to log none
+#   - METRICS_BUCKETS: upper bounds, in seconds, of the buckets of the time histograms
+INSTRUMENTATION = False
+SLOW_QUERY_THRESHOLD = 0.1
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Page /status, disabled by default. It reports the state of the pools, caches, write queue, maintenance jobs and shards
+#  as JSON to anyone, without authentication, so it is meant for development and must not be enabled in production
+STATUS_PAGE = False
+
 # Application threads. A common general assumption is using 2 per available processor cores - to handle
 # incoming requests using one and performing background operations using the other.
+# Threads serving requests in each worker process of the production server, see todoer/server.py
+# Each stream of live updates holds one of these threads, so the server serves at most half of them as streams, below
+#  LIVE_UPDATES_MAX_STREAMS: with 2 threads, each worker serves 1 stream at a time. With 1 thread the live updates are
+#  off, and the server logs it on startup. Raise it along with the streams wanted
 THREADS_PER_PAGE = 2
 
 # Enable protection agains *Cross-site Request Forgery (CSRF)*
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+
+# Settings of the production environment, loaded over config.py by the production server and by wsgi.py, or by any
+#  entry point when the environment variable TODOER_SETTINGS points to this file.
+
+# No debugger nor reloader, and templates are not checked for changes on each render
+ENV = 'production'
+DEBUG = False
+TESTING = False
+TEMPLATES_AUTO_RELOAD = False
+
+# The internals of the app are not reported at /status, see STATUS_PAGE in config.py
+STATUS_PAGE = False
+
+# The secret key must not be the one in the source code: the app doesn't start without it
+SECRET_KEY = os.environ['TODOER_SECRET_KEY']
+CSRF_SESSION_KEY = os.environ.get('TODOER_CSRF_SESSION_KEY', SECRET_KEY)
+
+# Optionally, another database file
+if os.environ.get('TODOER_DATABASE'):
+    DATABASE = os.environ['TODOER_DATABASE']
+
+# The maintenance jobs of the database run in the background of the workers, see MAINTENANCE in config.py
+MAINTENANCE = True
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Pytest: testing framework, fixtures are shared by the tests of this directory through conftest.py
+import pytest
+
+# Todoer: the application factory and the creation of the database
+from todoer import create_app
+from todoer.db import ConnectionPool, init_db
+from todoer.stats import ALL_TODOS, COUNT_TODOS
+
+
+@pytest.fixture
+def settings() -> dict:
+    """
+    Settings of the test app, loaded over the ones of the app fixture. Overridden by the test modules that need others,
+     e.g. SHARDS.
+    """
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, settings):
+    """
+    Create the app over an empty database in a temporary directory, so the tests never touch app.db. The passwords are
+     hashed in the test process, with a low cost.
+    TODOER_SETTINGS points to the settings for the whole test, so create_app() gives other apps over the same
+     databases, as the other processes of a server.
+
+    :return: app. Its application context is not left pushed, as the requests of the test client would share its g
+    """
+    values = {
+        'DATABASE': str(tmp_path / 'test.db'),
+        'SHARD_DIR': str(tmp_path / 'shards'),
+        'TEMPLATE_CACHE_DIR': str(tmp_path / 'template_cache'),
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        'PASSWORD_HASH_WORKERS': 0,
+        'TESTING': True,
+        **settings,
+    }
+    settings_file = tmp_path / 'settings.cfg'
+    settings_file.write_text(''.join(f'{name} = {value!r}\n' for name, value in values.items()))
+    monkeypatch.setenv('TODOER_SETTINGS', str(settings_file))
+
+    app = create_app()
+    with app.app_context():
+        init_db()
+    yield app
+    close_pools(app)
+
+
+@pytest.fixture
+def client(app):
+    """
+    :return: test client of the app
+    """
+    return app.test_client()
+
+
+def close_pools(app):
+    """
+    Close the connections of the pools of an app, once its test is done.
+
+    :param app: app
+    """
+    for extension in app.extensions.values():
+        if isinstance(extension, ConnectionPool):
+            extension.close()
+
+
+def login(client, username: str, password: str = 'secret'):
+    """
+    Register a user, unless it exists, and log it in through the client.
+
+    :param client: test client
+    :param username: username
+    :param password: password
+    """
+    client.post('/auth/register', data={'username': username, 'password': password})
+    response = client.post('/auth/login', data={'username': username, 'password': password})
+    assert response.status_code == 302, response.get_data(as_text=True)
+
+
+def assert_stats_match(db):
+    """
+    Check that the counters of user_stats, kept by the triggers, are the ones computed from scratch over the todos and
+     the archived todos of a database.
+
+    :param db: database connection
+    """
+    def rounded(rows):
+        # The users whose todos were all deleted keep a row of zeros, and the seconds are added in a different order
+        return {
+            row[0]: (row[1], row[2], row[3], round(row[4], 3))
+            for row in rows if row[1] or row[2]
+        }
+
+    kept = rounded(db.execute(
+        'SELECT user_id, open_todos, completed_todos, timed_todos, completion_seconds FROM user_stats'
+    ))
+    computed = rounded(db.execute(COUNT_TODOS.format(source=ALL_TODOS, where='')))
+    assert kept == computed
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Pytest: testing framework
+import pytest
+
+from conftest import login
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def settings(request) -> dict:
+    # The bulk operations are applied to the shard of the user, so they are tested with and without shards
+    return request.param
+
+
+def _bulk(client, operations: list):
+    return client.post('/api/todos/bulk', json=operations)
+
+
+def _tasks(client) -> dict:
+    # Tasks of the todos of the logged in user, by id
+    todos = client.get('/api/todos?created_by=me&per_page=500').get_json()['todos']
+    return {todo['id']: todo['task'] for todo in todos}
+
+
+def test_returned_ids_match_the_inserted_rows(client):
+    login(client, 'ann')
+    response = _bulk(client, [{'op': 'create', 'task': f'task {number}', 'description': ''} for number in range(5)])
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [201] * 5
+    for number, result in enumerate(results):
+        todo = client.get(f'/api/todos/{result["id"]}').get_json()
+        assert todo['task'] == f'task {number}'
+    assert sorted(_tasks(client).values()) == [f'task {number}' for number in range(5)]
+
+    # Creates mixed with updates and deletes of the same batch
+    first, second = results[0]['id'], results[1]['id']
+    response = _bulk(client, [
+        {'op': 'create', 'task': 'task 5'},
+        {'op': 'update', 'id': first, 'task': 'task 0 renamed', 'completed': True},
+        {'op': 'delete', 'id': second},
+        {'op': 'create', 'task': 'task 6'},
+    ])
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [201, 200, 200, 201]
+    tasks = _tasks(client)
+    assert tasks[results[0]['id']] == 'task 5'
+    assert tasks[results[3]['id']] == 'task 6'
+    assert tasks[first] == 'task 0 renamed'
+    assert second not in tasks
+
+
+@pytest.mark.parametrize('invalid, status', [
+    ({'op': 'create', 'task': ''}, 400),
+    ({'op': 'create', 'task': 'x', 'completed': 'yes'}, 400),
+    ({'op': 'update', 'id': True, 'task': 'x'}, 400),
+    ({'op': 'update', 'id': 10 ** 15, 'task': 'x'}, 404),
+    ({'op': 'rename'}, 400),
+])
+def test_a_failed_operation_rolls_back_the_whole_batch(client, invalid, status):
+    login(client, 'ann')
+    id = _bulk(client, [{'op': 'create', 'task': 'kept', 'description': ''}]).get_json()['results'][0]['id']
+    before = _tasks(client)
+
+    response = _bulk(client, [
+        {'op': 'create', 'task': 'new'},
+        {'op': 'update', 'id': id, 'task': 'changed'},
+        invalid,
+        {'op': 'delete', 'id': id},
+    ])
+    assert response.status_code == status
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [424, 424, status, 424]
+    assert _tasks(client) == before
+
+
+def test_todos_of_other_users_are_refused(app, client):
+    login(client, 'bob')
+    id = _bulk(client, [{'op': 'create', 'task': "bob's", 'description': ''}]).get_json()['results'][0]['id']
+
+    other = app.test_client()
+    login(other, 'ann')
+    for operation in ({'op': 'update', 'id': id, 'task': 'stolen'}, {'op': 'delete', 'id': id}):
+        response = _bulk(other, [operation])
+        assert response.status_code == 403
+        assert response.get_json()['results'][0]['status'] == 403
+    assert _tasks(client) == {id: "bob's"}
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# SQLite3: the baseline database is built without the app
+import sqlite3
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the migrations of the schema
+from todoer import create_app
+from todoer.db import get_db
+from todoer.migrations import LATEST_VERSION, get_version, upgrade
+
+from conftest import assert_stats_match, close_pools
+
+# Schema of the databases created before the migrations, at version 0
+BASELINE_SCHEMA = """
+CREATE TABLE user (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  username TEXT UNIQUE NOT NULL COLLATE RTRIM,
+  password TEXT NOT NULL
+);
+
+CREATE TABLE todo (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  created_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  task TEXT NOT NULL COLLATE NOCASE,
+  description TEXT NOT NULL COLLATE NOCASE,
+  completed INTEGER NOT NULL DEFAULT 0,
+  completed_at TIMESTAMP,
+  FOREIGN KEY (created_by) REFERENCES user (id)
+);
+"""
+
+TODOS = 230
+
+
+@pytest.fixture
+def baseline_app(app, tmp_path):
+    """
+    :return: app over a database with the baseline schema and some todos, to be upgraded
+    """
+    path = tmp_path / 'baseline.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO user (username, password) VALUES (?, 'x')", [('ann', ), ('bob', ), ('cid', )])
+    conn.executemany(
+        'INSERT INTO todo (created_by, created_at, task, description, completed, completed_at) VALUES (?, ?, ?, ?, ?, ?)',
+        [
+            (number % 3 + 1, f'2022-05-01 10:{number % 60:02}:00', f'task {number} {"even" if number % 2 else "odd"}',
+             'alpha' if number % 5 == 0 else 'beta', number % 4 == 0,
+             f'2022-05-02 10:{number % 60:02}:00' if number % 8 == 0 else None)
+            for number in range(TODOS)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+    baseline_app = create_app()
+    baseline_app.config['DATABASE'] = str(path)
+    yield baseline_app
+    close_pools(baseline_app)
+
+
+def _check_derived_data(db):
+    # The search index and the counters of user_stats match the todos
+    db.execute("INSERT INTO todo_fts (todo_fts) VALUES ('integrity-check')")
+    for word in ('alpha', 'beta', 'even', 'odd'):
+        found = db.execute('SELECT COUNT(*) FROM todo_fts WHERE todo_fts MATCH ?', (word, )).fetchone()[0]
+        expected = db.execute(
+            "SELECT COUNT(*) FROM todo WHERE ' ' || task || ' ' || description || ' ' LIKE ?", (f'% {word} %', )
+        ).fetchone()[0]
+        assert found == expected > 0
+    assert_stats_match(db)
+
+
+def test_db_upgrade_from_the_baseline_schema(baseline_app):
+    runner = baseline_app.test_cli_runner()
+    result = runner.invoke(args=['db-upgrade', '--batch-size', '40', '--pause', '0'])
+    assert result.exit_code == 0, result.output
+    assert f'to {LATEST_VERSION}' in result.output
+
+    with baseline_app.app_context():
+        db = get_db()
+        assert get_version(db) == LATEST_VERSION
+        assert db.execute('SELECT COUNT(*) FROM todo').fetchone()[0] == TODOS
+        assert db.execute('SELECT COUNT(*) FROM migration_progress').fetchone()[0] == 0
+        _check_derived_data(db)
+        dump = list(db.iterdump())
+
+    # A second upgrade does nothing
+    result = runner.invoke(args=['db-upgrade', '--batch-size', '40', '--pause', '0'])
+    assert result.exit_code == 0, result.output
+    assert f'up to date, at version {LATEST_VERSION}' in result.output
+    with baseline_app.app_context():
+        db = get_db()
+        assert get_version(db) == LATEST_VERSION
+        assert list(db.iterdump()) == dump
+
+
+def test_backfills_keep_up_with_the_writes_made_meanwhile(baseline_app):
+    with baseline_app.app_context():
+        db = get_db()
+        writes = []
+
+        def write_between_batches(message):
+            # Each batch of a backfill is echoed once committed: the todos are changed before and after its progress
+            if 'ids (' not in message:
+                return
+            number = len(writes)
+            db.execute("UPDATE todo SET task = task || ' edited', completed = 1, completed_at = '2022-06-01 00:00:00'"
+                       ' WHERE id IN (?, ?)', (1 + number, TODOS - number))
+            db.execute('DELETE FROM todo WHERE id IN (?, ?)', (100 + number, 200 - number))
+            db.execute("INSERT INTO todo (created_by, task, description) VALUES (2, 'new odd', 'alpha')")
+            # The todos created after the backfill started are kept in sync too
+            db.execute("UPDATE todo SET task = 'newer even', completed = 1, completed_at = '2022-06-01 00:00:00'"
+                       ' WHERE id = (SELECT MAX(id) FROM todo)')
+            db.commit()
+            writes.append(message)
+
+        upgrade(db, batch_size=40, pause=0, echo=write_between_batches)
+        assert writes
+        assert get_version(db) == LATEST_VERSION
+        _check_derived_data(db)
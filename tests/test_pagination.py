@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the todos are written straight to the databases, to share their creation time
+from todoer.db import get_db
+from todoer.shards import database_ids
+
+from conftest import login
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def settings(request) -> dict:
+    # Without a user filter, the pages of the shards are merged
+    return request.param
+
+
+def _create(client, count: int, completed=lambda number: False):
+    results = client.post('/api/todos/bulk', json=[
+        {'op': 'create', 'task': f'task {number}'} for number in range(count)
+    ]).get_json()['results']
+    ids = [result['id'] for result in results]
+    # The todos are created open
+    client.post('/api/todos/bulk', json=[
+        {'op': 'update', 'id': id, 'completed': True} for number, id in enumerate(ids) if completed(number)
+    ])
+    return ids
+
+
+def _walk(client, query: str = '', per_page: int = 3) -> list:
+    # Ids of every page, older and older, and then newer and newer back to the first page
+    pages, cursor = [], None
+    while True:
+        page = client.get(f'/api/todos?per_page={per_page}{query}' + (f'&before={cursor}' if cursor else '')).get_json()
+        pages.append([todo['id'] for todo in page['todos']])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    back, cursor = [], page['prev_cursor']
+    while cursor is not None:
+        page = client.get(f'/api/todos?per_page={per_page}{query}&after={cursor}').get_json()
+        back.append([todo['id'] for todo in page['todos']])
+        cursor = page['prev_cursor']
+    assert back == pages[-2::-1]
+    return [id for page in pages for id in page]
+
+
+def test_ties_on_created_at_are_broken_by_id(app, client):
+    login(client, 'ann')
+    ids = _create(client, 5)
+    login(client, 'bob')
+    ids += _create(client, 6)
+    # Created within the same second, as the todos of a bulk or an import
+    with app.app_context():
+        for database in database_ids():
+            get_db(database).execute("UPDATE todo SET created_at = '2022-05-01 10:00:00'")
+            get_db(database).commit()
+
+    for per_page in (1, 2, 4, 11, 20):
+        assert _walk(client, per_page=per_page) == sorted(ids, reverse=True)
+
+
+def test_filters_are_kept_along_the_cursor(client):
+    login(client, 'ann')
+    mine = _create(client, 10, completed=lambda number: number % 3 == 0)
+    login(client, 'bob')
+    _create(client, 10, completed=lambda number: number % 2 == 0)
+    login(client, 'ann')
+
+    assert _walk(client, '&created_by=me') == mine[::-1]
+    assert _walk(client, '&created_by=me&completed=true', per_page=2) == [mine[9], mine[6], mine[3], mine[0]]
+    open_todos = client.get('/api/todos?per_page=500&completed=false').get_json()['todos']
+    assert _walk(client, '&completed=false', per_page=4) == [todo['id'] for todo in open_todos]
+    assert all(not todo['completed'] for todo in open_todos) and len(open_todos) == 6 + 5
+
+
+# Cursors mangled by hand or by a client, none of them built by encode_cursor
+TAMPERED_CURSORS = (
+    '', 'x', '_', '_1', '2022-05-01 10:00:00', '2022-05-01 10:00:00_', '2022-05-01 10:00:00_x',
+    '2022-13-01 10:00:00_1', 'not a date_1', '2022-05-01 10:00:00_1.5', '2022-05-01 10:00:00_-1',
+    '2022-05-01 10:00:00_99999999999999999999', '2022-05-01 10:00:00+05:00_1', '2022-05-01T10:00:00_1',
+    '9999-12-31 23:59:59.999999_9223372036854775807', '2022-05-01 10:00:00\x00_1', '%ff_1',
+)
+
+
+def test_tampered_cursors_never_fail_the_request(client):
+    login(client, 'ann')
+    _create(client, 3)
+    for path, args in (('/api/todos', {'per_page': 2}), ('/', {}), ('/', {'created_by': 'me', 'completed': 'false'})):
+        for direction in ('before', 'after'):
+            for cursor in TAMPERED_CURSORS:
+                response = client.get(path, query_string={**args, direction: cursor})
+                assert response.status_code in (200, 400), (path, direction, cursor, response.get_data(as_text=True))
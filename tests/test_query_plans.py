@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+# Todoer: the query plans of the todo list
+from todoer.todo import explain_todo_page_queries
+
+
+def test_every_filter_searches_an_index(app):
+    """
+    Every combination of filters of the todo list, on any page, must search the todo table through an index. A filter
+     that falls back to a "SCAN todo" fails, with its plan in the message.
+    """
+    with app.app_context():
+        scans = [
+            f"{', '.join(names) or 'no filters'} ({pagination}): {'; '.join(details)}"
+            for names, pagination, details, indexed in explain_todo_page_queries()
+            if not indexed
+        ]
+    assert not scans, 'Todo list queries that scan the todo table:\n' + '\n'.join(scans)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the application factory, for another process of the server
+from todoer import create_app
+from todoer.db import get_db
+from todoer.shards import database_ids
+
+from conftest import close_pools, login
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def settings(request) -> dict:
+    # The data version covers the shards too
+    return request.param
+
+
+@pytest.fixture
+def other_app(app):
+    """
+    :return: another app over the same databases, as another process of the pre-fork server
+    """
+    other_app = create_app()
+    yield other_app
+    close_pools(other_app)
+
+
+def _get(client, etag: str = None):
+    return client.get('/', headers={'If-None-Match': etag} if etag else {})
+
+
+def test_unchanged_page_is_not_modified_for_every_process(client, other_app):
+    login(client, 'ann')
+    client.post('/create', data={'task': 'first', 'description': ''})
+    response = _get(client)
+    assert response.status_code == 200 and 'first' in response.get_data(as_text=True)
+    etag = response.headers['ETag']
+    assert _get(client, etag).status_code == 304
+
+    # The ETag given by one process is validated by the others, though they didn't make the change themselves
+    other = other_app.test_client()
+    login(other, 'ann')
+    assert _get(other, etag).status_code == 304
+
+    # A change made by the other process is seen by this one
+    other.post('/create', data={'task': 'second', 'description': ''})
+    response = _get(client, etag)
+    assert response.status_code == 200 and 'second' in response.get_data(as_text=True)
+    assert response.headers['ETag'] != etag
+    etag = response.headers['ETag']
+    assert _get(other, etag).status_code == 304
+
+
+def test_changes_made_outside_the_app_are_seen(app, client):
+    login(client, 'ann')
+    client.post('/create', data={'task': 'first', 'description': ''})
+    etag = _get(client).headers['ETag']
+
+    # Written without bumping the data version of the app, as the import of another process
+    with app.app_context():
+        for database in database_ids():
+            get_db(database).execute("UPDATE todo SET task = 'renamed' WHERE task = 'first'")
+            get_db(database).commit()
+
+    response = _get(client, etag)
+    assert response.status_code == 200 and 'renamed' in response.get_data(as_text=True)
+    assert _get(client, response.headers['ETag']).status_code == 304
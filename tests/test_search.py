@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+# Todoer: the full-text search of the todos
+from todoer.search import search_todos
+
+from conftest import login
+
+
+def test_matches_are_highlighted_in_the_escaped_text(app, client):
+    login(client, 'ann')
+    client.post('/create', data={'task': 'Buy <b>milk</b>', 'description': 'and some bread'})
+
+    with app.test_request_context():
+        results = search_todos('milk')['results']
+    assert [str(result['task']) for result in results] == ['Buy &lt;b&gt;<mark>milk</mark>&lt;/b&gt;']
+
+
+def test_control_characters_of_a_todo_are_not_turned_into_marks(app, client):
+    login(client, 'ann')
+    # Any text can be stored, from the forms, the API or the import, including the characters SQLite was once asked to
+    #  highlight with
+    client.post('/create', data={'task': '\x03 milk \x02 \x03', 'description': '\x02 milk'})
+    client.post('/api/todos/bulk', json=[{'op': 'create', 'task': 'oat \x02milk\x03', 'description': 'milk \x03'}])
+
+    with app.test_request_context():
+        results = search_todos('milk')['results']
+    assert len(results) == 2
+    for result in results:
+        for html in (str(result['task']), str(result['description'])):
+            assert html.count('<mark>') == html.count('</mark>') == 1
+            assert html.index('<mark>') < html.index('</mark>')
+    assert {str(result['task']) for result in results} == {'\x03 <mark>milk</mark> \x02 \x03', 'oat \x02<mark>milk</mark>\x03'}
+
+    page = client.get('/search?q=milk').get_data(as_text=True)
+    assert page.count('<mark>milk</mark>') == 4
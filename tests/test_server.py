@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Logging: the server logs when the live updates are off
+import logging
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the production server
+from todoer.server import ThreadPoolWSGIServer
+
+from conftest import login
+
+
+@pytest.mark.parametrize('threads, streams', [(1, 0), (2, 1), (8, 4), (64, 16)])
+def test_streams_are_limited_by_the_threads_without_changing_the_config(app, caplog, threads, streams):
+    config = dict(app.config)
+    with caplog.at_level(logging.WARNING, logger='todoer.server'):
+        server = ThreadPoolWSGIServer('127.0.0.1', 0, app, threads)
+    try:
+        assert server.live_update_streams == streams
+        assert dict(app.config) == config
+        assert ('Live updates are off' in caplog.text) == (streams == 0)
+    finally:
+        server.server_close()
+
+
+def test_without_streams_the_index_does_not_follow_the_changes(client):
+    login(client, 'ann')
+    assert 'data-changes-url' in client.get('/').get_data(as_text=True)
+    response = client.get('/changes?since=0', buffered=False)
+    assert response.status_code == 200
+    response.close()
+
+    # As served by a worker of the production server with a single thread. Another query string, as the page rendered
+    #  with live updates is cached, while the threads of a worker never change
+    environ = {'todoer.live_update_streams': 0}
+    assert 'data-changes-url' not in client.get('/?single=thread', environ_base=environ).get_data(as_text=True)
+    assert client.get('/changes?since=0', environ_base=environ).status_code == 503
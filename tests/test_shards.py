@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# SQLite3: the fence triggers refuse the writes with an IntegrityError
+import sqlite3
+
+# Pytest: testing framework
+import pytest
+# Werkzeug: the writes refused by a fence are answered with 503
+from werkzeug.exceptions import ServiceUnavailable
+
+# Todoer: the sharding of the todos
+from todoer import create_app, shards
+from todoer.db import get_db, get_read_db
+from todoer.shards import FENCE_MESSAGE, fenced, get_shard_map, move_user, route_user, user_shard
+from todoer.todo import get_todo_page
+
+from conftest import login
+
+
+@pytest.fixture
+def settings() -> dict:
+    return {'SHARDS': 2, 'SHARD_MAP_TTL': 3600.0}
+
+
+def _tasks(app, shard, user_id: int) -> list:
+    # Tasks of the todos and archived todos of a user in a shard, sorted, with their repetitions
+    with app.app_context():
+        db = get_read_db(shard)
+        return sorted(
+            row[0] for row in db.execute(
+                'SELECT task FROM todo WHERE created_by = ? UNION ALL SELECT task FROM todo_archive WHERE created_by = ?',
+                (user_id, user_id)
+            )
+        )
+
+
+def _create_todos(app, client, count: int) -> tuple:
+    # Create todos through the app for a new user, and archive one of them; return the user id and their shard
+    login(client, 'mover')
+    for number in range(count):
+        client.post('/create', data={'task': f'task {number:03}', 'description': ''})
+    with app.app_context():
+        user_id = get_read_db().execute("SELECT id FROM user WHERE username = 'mover'").fetchone()[0]
+        shard = user_shard(user_id)
+        db = get_db(shard)
+        db.execute(
+            'INSERT INTO todo_archive (id, created_by, created_at, task, description, completed, completed_at)'
+            " VALUES (1, ?, '2020-01-01 00:00:00', 'archived', '', 1, '2020-01-02 00:00:00')",
+            (user_id, )
+        )
+        db.commit()
+    return user_id, shard
+
+
+def test_move_user_copies_every_row_once(app, client):
+    user_id, source = _create_todos(app, client, 23)
+    target = 1 - source
+    expected = sorted([f'task {number:03}' for number in range(23)] + ['archived'])
+    assert _tasks(app, source, user_id) == expected
+
+    with app.app_context():
+        # Batches smaller than the todos, so the move takes several transactions
+        assert move_user(user_id, source, target, batch_size=5, pause=0) == len(expected)
+        assert user_shard(user_id) == target
+        counters = get_read_db(target).execute(
+            'SELECT open_todos, completed_todos FROM user_stats WHERE user_id = ?', (user_id, )
+        ).fetchone()
+
+    assert _tasks(app, target, user_id) == expected
+    assert _tasks(app, source, user_id) == []
+    assert tuple(counters) == (23, 1)
+    # The app lists every todo of the user once, from the new shard
+    todos = client.get('/api/todos?created_by=me&per_page=100').get_json()['todos']
+    assert sorted(todo['task'] for todo in todos) == [task for task in expected if task != 'archived']
+
+
+def test_fence_refuses_writes_to_the_old_shard(app, client):
+    user_id, source = _create_todos(app, client, 3)
+    with app.app_context():
+        move_user(user_id, source, 1 - source, pause=0)
+        db = get_db(source)
+        with pytest.raises(sqlite3.IntegrityError, match=FENCE_MESSAGE):
+            db.execute("INSERT INTO todo (task, description, created_by) VALUES ('late', '', ?)", (user_id, ))
+        db.rollback()
+
+    # Through the app, a refused write is answered with 503, and the user is read again from the shard map
+    with app.test_request_context():
+        get_shard_map().lookup(user_id)
+        with pytest.raises(ServiceUnavailable):
+            with fenced(user_id):
+                get_db(source).execute(
+                    "INSERT INTO todo (task, description, created_by) VALUES ('late', '', ?)", (user_id, )
+                )
+        get_db(source).rollback()
+        assert get_shard_map().stats()['users'] == 0
+
+    # Nothing was written to the old shard
+    assert _tasks(app, source, user_id) == []
+
+
+def test_cached_lookup_notices_a_move(app, client, monkeypatch):
+    user_id, source = _create_todos(app, client, 4)
+    target = 1 - source
+    # The list caches the shard of the user in the shard map of the app
+    assert len(client.get('/api/todos?created_by=me').get_json()['todos']) == 4
+
+    with app.app_context(), monkeypatch.context() as patch:
+        # A hit is served from memory, without querying any database
+        patch.setattr(shards, 'get_read_db', None)
+        assert user_shard(user_id) == source
+
+    # Another process of the app moves the user
+    other = create_app()
+    with other.app_context():
+        move_user(user_id, source, target, pause=0)
+
+    with app.app_context():
+        assert user_shard(user_id) == target
+    assert len(client.get('/api/todos?created_by=me').get_json()['todos']) == 4
+    assert client.post('/create', data={'task': 'after the move', 'description': ''}).status_code == 302
+    assert 'after the move' in _tasks(app, target, user_id)
+
+
+def test_merged_pages_follow_the_order_of_a_single_database(app):
+    with app.app_context():
+        db = get_db()
+        for username in ('ann', 'bob', 'cid'):
+            db.execute("INSERT INTO user (username, password) VALUES (?, 'x')", (username, ))
+        db.commit()
+        rows = []
+        for user_id in (1, 2, 3):
+            shard = user_id % 2
+            route_user(user_id, shard)
+            shard_db = get_db(shard)
+            for number in range(7):
+                # Many todos share their created_at, within a shard and across them, so the ids break the ties
+                created_at = f'2022-05-0{number % 3 + 1} 10:00:00'
+                cursor = shard_db.execute(
+                    'INSERT INTO todo (task, description, created_by, created_at) VALUES (?, ?, ?, ?)',
+                    (f'{user_id}-{number}', '', user_id, created_at)
+                )
+                rows.append((created_at, cursor.lastrowid))
+            shard_db.commit()
+        # The order a single database gives with ORDER BY created_at DESC, id DESC
+        expected = [id for created_at, id in sorted(rows, reverse=True)]
+
+        pages, cursor = [], None
+        while True:
+            page = get_todo_page(before=cursor, per_page=4)
+            pages.append([todo['id'] for todo in page['todos']])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        assert [id for page in pages for id in page] == expected
+
+        # Going back from the last page gives the same pages
+        back, cursor = [pages[-1]], page['prev_cursor']
+        while cursor is not None:
+            page = get_todo_page(after=cursor, per_page=4)
+            back.insert(0, [todo['id'] for todo in page['todos']])
+            cursor = page['prev_cursor']
+        assert back == pages
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# JSON: the imported todos are written as newline delimited JSON
+import json
+# Time: "tzset" applies the time zone of the test
+import time
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the counters of the todos of each user
+from todoer.db import get_read_db
+from todoer.shards import database_ids
+
+from conftest import assert_stats_match, login
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def settings(request) -> dict:
+    # Each shard keeps the counters of its todos
+    return request.param
+
+
+@pytest.fixture
+def local_time(monkeypatch):
+    # A local time zone away from UTC, so a completion time written in local time shows in the counters
+    monkeypatch.setenv('TZ', 'America/Argentina/Buenos_Aires')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _ids(client) -> list:
+    # Ids of the todos of the logged in user, most recent first
+    return [todo['id'] for todo in client.get('/api/todos?created_by=me&per_page=500').get_json()['todos']]
+
+
+def _check_counters(app):
+    with app.app_context():
+        for database in database_ids():
+            db = get_read_db(database)
+            assert_stats_match(db)
+            # The todos were completed right after being created, with created_at and completed_at both in UTC
+            for seconds in db.execute('SELECT completion_seconds / timed_todos FROM user_stats WHERE timed_todos > 0'):
+                assert 0 <= seconds[0] < 60
+
+
+def test_counters_follow_every_kind_of_write(app, client, tmp_path, local_time):
+    login(client, 'ann')
+
+    # Through the forms: create, complete, uncomplete and delete
+    for number in range(4):
+        client.post('/create', data={'task': f'form {number}', 'description': ''})
+    forms = _ids(client)
+    for id in forms[:3]:
+        client.post(f'/{id}/update', data={'task': 'done', 'description': '', 'completed': 'on'})
+    client.post(f'/{forms[1]}/update', data={'task': 'undone', 'description': ''})
+    client.post(f'/{forms[2]}/delete')
+    _check_counters(app)
+
+    # Through the bulk API
+    results = client.post('/api/todos/bulk', json=[
+        {'op': 'create', 'task': f'bulk {number}'} for number in range(4)
+    ]).get_json()['results']
+    bulk = [result['id'] for result in results]
+    response = client.post('/api/todos/bulk', json=[
+        {'op': 'update', 'id': bulk[0], 'completed': True},
+        {'op': 'update', 'id': bulk[1], 'completed': True},
+        {'op': 'update', 'id': bulk[2], 'completed': True},
+        {'op': 'delete', 'id': bulk[3]},
+    ])
+    assert response.status_code == 200
+    client.post('/api/todos/bulk', json=[
+        {'op': 'update', 'id': bulk[1], 'completed': False},
+        {'op': 'delete', 'id': bulk[2]},
+        {'op': 'update', 'id': forms[0], 'completed': False},
+    ])
+    _check_counters(app)
+
+    # Through the import, with completed todos with and without completion time
+    path = tmp_path / 'todos.ndjson'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in (
+        {'task': 'open', 'username': 'ann'},
+        {'task': 'timed', 'username': 'ann', 'created_at': '2022-05-01 10:00:00', 'completed': 1,
+         'completed_at': '2022-05-01 10:00:30'},
+        {'task': 'untimed', 'username': 'ann', 'completed': 1},
+    )))
+    result = app.test_cli_runner().invoke(args=['import-todos', str(path)])
+    assert 'Imported 3 todos, skipped 0' in result.output, result.output
+    _check_counters(app)
+
+    # Deleting every todo leaves the counters at zero
+    for id in _ids(client):
+        client.post(f'/{id}/delete')
+    _check_counters(app)
+    with app.app_context():
+        for database in database_ids():
+            counters, seconds = get_read_db(database).execute(
+                'SELECT TOTAL(open_todos + completed_todos + timed_todos), TOTAL(ABS(completion_seconds))'
+                ' FROM user_stats'
+            ).fetchone()
+            assert counters == 0 and seconds < 0.001
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+# Pytest: testing framework
+import pytest
+
+
+def test_status_is_disabled_by_default(client):
+    assert client.get('/status').status_code == 404
+
+
+@pytest.mark.parametrize('settings', [{'STATUS_PAGE': True}])
+def test_status_reports_the_internals_when_enabled(client):
+    response = client.get('/status')
+    assert response.status_code == 200
+    assert 'db_pool' in response.get_json()
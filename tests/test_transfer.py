@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# JSON: the todos are imported as newline delimited JSON
+import json
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the databases where the todos are deleted before importing them back
+from todoer.db import get_db, get_read_db
+from todoer.shards import database_ids
+
+from conftest import assert_stats_match, login
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def settings(request) -> dict:
+    # When sharded, the todos are exported shard after shard, and imported to the shard of their user
+    return request.param
+
+
+def _todos(app) -> list:
+    # The todos of every database, without their ids, which the import doesn't keep
+    with app.app_context():
+        return sorted(
+            tuple(row) for database in database_ids() for row in get_read_db(database).execute(
+                'SELECT created_by, task, description, CAST(created_at AS TEXT), completed, CAST(completed_at AS TEXT)'
+                ' FROM todo'
+            )
+        )
+
+
+def _import(app, path, *args) -> str:
+    result = app.test_cli_runner().invoke(args=['import-todos', str(path), *args])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_export_import_round_trip(app, client, tmp_path, fmt):
+    for username in ('ann', 'bob'):
+        login(client, username)
+        ids = [result['id'] for result in client.post('/api/todos/bulk', json=[
+            {'op': 'create', 'task': f'{username} {number}, "quoted"', 'description': f'línea 1\nlínea 2 · {number}'}
+            for number in range(7)
+        ]).get_json()['results']]
+        client.post('/api/todos/bulk', json=[{'op': 'update', 'id': id, 'completed': True} for id in ids[::2]])
+    before = _todos(app)
+
+    path = tmp_path / f'todos.{fmt}'
+    result = app.test_cli_runner().invoke(args=['export-todos', str(path)])
+    assert result.exit_code == 0, result.output
+    # The export of the API is the same as the one of the CLI
+    assert client.get(f'/api/todos/export?format={fmt}').get_data(as_text=True) == path.read_bytes().decode('utf8')
+
+    with app.app_context():
+        for database in database_ids():
+            get_db(database).execute('DELETE FROM todo')
+            get_db(database).commit()
+    assert 'Imported 14 todos, skipped 0' in _import(app, path)
+    assert _todos(app) == before
+    with app.app_context():
+        for database in database_ids():
+            assert_stats_match(get_read_db(database))
+
+
+def test_bad_rows_in_the_middle_of_a_batch_are_rejected(app, client, tmp_path):
+    login(client, 'ann')
+    good = [{'task': f'good {number}', 'username': 'ann', 'created_at': '2022-05-01 10:00:00'} for number in range(6)]
+    bad = [
+        '{"task": "unknown user", "username": "zoe"}',
+        '{"task": "", "username": "ann"}',
+        '{"task": "bad date", "username": "ann", "created_at": "yesterday"}',
+        '{"task": ["not", "text"], "username": "ann"}',
+        '{"task": "not text", "description": {"a": 1}, "username": "ann"}',
+        '{"task": "truncated", "username": ',
+        '["not", "a", "record"]',
+    ]
+    lines = [json.dumps(good[0]), json.dumps(good[1]), *bad[:4], json.dumps(good[2]), json.dumps(good[3]), *bad[4:],
+             json.dumps(good[4]), json.dumps(good[5])]
+    path = tmp_path / 'todos.ndjson'
+    path.write_text('\n'.join(lines) + '\n', 'utf8')
+
+    # A single batch and transaction for the whole file
+    output = _import(app, path, '--batch-size', '100', '--commit-every', '100')
+    assert f'Imported 6 todos, skipped {len(bad)}' in output
+    assert [row[1] for row in _todos(app)] == [f'good {number}' for number in range(6)]
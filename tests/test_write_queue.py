@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# SQLite3: the write that fails raises an IntegrityError
+import sqlite3
+# Threading: the writes are submitted from several threads, as from the requests
+import threading
+
+# Pytest: testing framework
+import pytest
+
+# Todoer: the group commit of the writes
+from todoer.db import get_db, get_pool, get_read_db
+from todoer.write_queue import WriteQueue, WriteQueueClosedError, close_write_queues, get_write_queue
+
+from conftest import login
+
+INSERT = "INSERT INTO todo (task, description, created_by) VALUES (?, '', 1)"
+
+
+@pytest.fixture
+def settings() -> dict:
+    return {'WRITE_QUEUE': True}
+
+
+@pytest.fixture
+def write_queue(app):
+    with app.app_context():
+        # The creator of the todos written
+        get_db().execute("INSERT INTO user (username, password) VALUES ('ann', 'x')")
+        get_db().commit()
+    # A long window, so the writes submitted one after the other go in the same batch
+    write_queue = WriteQueue(app, window=0.5)
+    yield write_queue
+    write_queue.close(timeout=5)
+
+
+def _tasks(app) -> list:
+    with app.app_context():
+        return sorted(row[0] for row in get_read_db().execute('SELECT task FROM todo'))
+
+
+def test_a_failed_write_does_not_roll_back_its_batch(app, write_queue):
+    futures = [
+        write_queue.submit(INSERT, ('first', )),
+        # task is NOT NULL
+        write_queue.submit(INSERT, (None, )),
+        write_queue.submit(INSERT, ('third', )),
+    ]
+    assert futures[0].result(5) == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(5)
+    assert futures[2].result(5) == 1
+
+    stats = write_queue.stats()
+    assert (stats['batches'], stats['writes'], stats['failed']) == (1, 3, 1)
+    assert _tasks(app) == ['first', 'third']
+
+
+def test_every_future_resolves_when_the_batch_fails(app, write_queue):
+    with app.app_context():
+        # The writer thread can't take the write lock while another connection holds it, and doesn't wait for it
+        pool = get_pool()
+        conn = pool.acquire()
+        conn.execute('PRAGMA busy_timeout = 0')
+        pool.release(conn)
+        blocker = sqlite3.connect(app.config['DATABASE'])
+        blocker.execute('BEGIN IMMEDIATE')
+        try:
+            futures = [write_queue.submit(INSERT, (f'task {number}', )) for number in range(3)]
+            for future in futures:
+                with pytest.raises(sqlite3.OperationalError):
+                    future.result(5)
+        finally:
+            blocker.rollback()
+            blocker.close()
+    assert _tasks(app) == []
+
+
+def test_close_commits_the_queued_writes_and_refuses_the_rest(app, write_queue):
+    futures = []
+
+    def submit(number):
+        futures.append(write_queue.submit(INSERT, (f'task {number}', )))
+
+    threads = [threading.Thread(target=submit, args=(number, )) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Closed while the writer thread still waits for the batch window to end
+    write_queue.close(timeout=5)
+
+    assert all(future.done() for future in futures)
+    assert [future.result() for future in futures] == [1] * 8
+    assert _tasks(app) == sorted(f'task {number}' for number in range(8))
+
+    late = write_queue.submit(INSERT, ('late', ))
+    assert late.done()
+    with pytest.raises(WriteQueueClosedError):
+        late.result()
+    assert 'late' not in _tasks(app)
+
+
+def test_requests_write_through_the_queue(app, client):
+    login(client, 'ann')
+    for number in range(3):
+        assert client.post('/create', data={'task': f'task {number}', 'description': ''}).status_code == 302
+    with app.app_context():
+        assert get_write_queue().stats()['writes'] == 3
+        assert get_db().execute('SELECT COUNT(*) FROM todo').fetchone()[0] == 3
+
+    # Once the queue is closed, as when the server stops, the writes are answered with 503
+    close_write_queues(app)
+    assert client.post('/create', data={'task': 'late', 'description': ''}).status_code == 503
@@ -20,6 +20,9 @@ def create_app(py_config_file_: str = '') -> object:
     #  known as the application factory. Any configuration, registration, and other setup the application needs will
     #  happen inside the function, then the application will be returned.
     app = Flask(__name__, instance_relative_config=True)
+    # The "g" object of each request supports lazily loaded attributes, such as g.user
+    from .globals import LazyAppGlobals
+    app.app_ctx_globals_class = LazyAppGlobals
 
     # Identify configuration file
     current_dir_ = path.dirname(path.abspath(__file__))
@@ -35,15 +38,37 @@ def create_app(py_config_file_: str = '') -> object:
 
     # Load the instance config
     app.config.from_pyfile(py_config_file_, silent=True)
+    # And over it, the settings of the environment, e.g. config_production.py, when TODOER_SETTINGS points to them
+    app.config.from_envvar('TODOER_SETTINGS', silent=True)
+
+    # Compiled templates cached on disk, see the TEMPLATE_CACHE_DIR configuration key. Set up before anything uses the
+    #  Jinja environment
+    from . import template_cache
+    template_cache.init_app(app)
 
     # Import and register access to the database
     from . import db
     db.init_app(app)
 
+    # Optional timing of the statements and the rendering of each request, see the INSTRUMENTATION configuration key
+    from . import instrument
+    instrument.init_app(app)
+
     # Import and register the blueprints
-    from . import auth, todo
+    from . import (
+        api, archive, auth, feed, hashing, maintenance, render_cache, shards, stats, todo, usernames, write_queue
+    )
     app.register_blueprint(auth.bp)
     app.register_blueprint(todo.bp)
+    # The JSON API of todos, under the /api prefix
+    app.register_blueprint(api.bp)
+    # The statistics of the todos of each user, at /stats
+    app.register_blueprint(stats.bp)
+    # The change feed of the todos, streamed to the index at /changes
+    app.register_blueprint(feed.bp)
+    # The archived todos, at /archive, moved there by the maintenance jobs run in the background or with the CLI
+    app.register_blueprint(archive.bp)
+    maintenance.init_app(app)
     # Unlike the 'auth' blueprint, the 'todo' blueprint does not have a url_prefix
     # The 'todo' is the main feature of Todoer, so it makes sense that the 'todo' index will be the main index.
     # So that url_for('index') or url_for('todo.index') will both work, generating the same '/' URL either way.
@@ -54,5 +79,35 @@ def create_app(py_config_file_: str = '') -> object:
     def hello():
         return 'Hello World 3!'
 
+    # a simple page that reports the state of the app internals, as JSON, only when STATUS_PAGE is enabled
+    def status():
+        writes = write_queue.get_write_queue()
+        scheduler = maintenance.get_scheduler()
+        shard_map = shards.get_shard_map()
+        return {
+            'db_pool': db.get_pool().stats(),
+            'db_read_pool': db.get_pool(readonly=True).stats(),
+            'user_cache': auth.get_user_cache().stats(),
+            'usernames': usernames.get_usernames().stats(),
+            'password_hasher': hashing.get_hasher().stats(),
+            'page_cache': render_cache.get_page_cache().stats(),
+            'card_cache': render_cache.get_card_cache().stats(),
+            'write_queue': writes.stats() if writes is not None else None,
+            'maintenance': scheduler.stats() if scheduler is not None else None,
+            'shards': {
+                **shard_map.stats(),
+                'pools': {
+                    shard: {
+                        'db_pool': db.get_pool(shard=shard).stats(),
+                        'db_read_pool': db.get_pool(readonly=True, shard=shard).stats(),
+                    }
+                    for shard in range(shard_map.count)
+                },
+            } if shard_map is not None else None,
+        }
+
+    if app.config.get('STATUS_PAGE', False):
+        app.add_url_rule('/status', 'status', status)
+
     # the application is returned.
     return app
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+# datetime: this module supplies classes for manipulating dates and times.
+import datetime as dt
+# Functools: module for HOF (Higher-Order Functions).
+import functools
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
+#        - "g" is a special object that is unique for each request. It is used to store data that might be accessed by
+#          multiple functions during the request
+#        - "jsonify" serializes data to a JSON response
+#        - "Response" with a generator as body streams it to the client chunk by chunk
+from flask import Blueprint, Response, current_app, g, jsonify, request
+# Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
+from werkzeug.exceptions import HTTPException, abort
+
+from todoer.db import get_db, get_read_db
+from todoer.render_cache import bump_data_version
+from todoer.shards import fenced, shard_of_todo, user_shard
+from todoer.stats import get_user_stats
+from todoer.todo import TODO_COLUMNS, check_todo, get_todo, get_todo_page, parse_todo_filters
+from todoer.transfer import MIMETYPES, stream_export
+
+# Create a Blueprint named 'api'. All its URLs are prefixed with /api, and all its responses are JSON.
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# Maximum number of ids bound to a single "IN (...)" query, below the SQLite limit of host parameters
+_IDS_PER_QUERY = 500
+
+
+# Errors raised with abort() inside the API, including the ones of get_todo(), are answered in JSON instead of HTML
+@bp.errorhandler(HTTPException)
+def handle_http_error(e: HTTPException):
+    return jsonify(error=e.name, message=e.description), e.code
+
+
+# Same as auth.login_required, but answering 401 instead of redirecting to the login page
+def api_login_required(view):
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if g.user is None:
+            # 401 HTTP code means “Unauthorized”
+            abort(401, 'Log in to use the API.')
+
+        return view(**kwargs)
+
+    return wrapped_view
+
+
+def todo_to_dict(todo) -> dict:
+    """
+    :param todo: todo row or record, see todo.TodoRecord
+
+    :return: todo as a JSON serializable dict, with the timestamps in ISO 8601 format
+    """
+    # Both rows and records iterate over their values, in the order of their keys
+    todo = dict(zip(todo.keys(), todo))
+    for key in ('created_at', 'completed_at'):
+        if isinstance(todo.get(key), dt.datetime):
+            todo[key] = todo[key].isoformat(sep=' ')
+    return todo
+
+
+# @bp.route associates the URL '/api/todos' with the 'list_todos' view function
+@bp.route('/todos')
+def list_todos():
+    """
+    List the todos, most recent first, one page at a time.
+    The query string arguments are:
+        - before / after: cursor of the page, as returned in next_cursor / prev_cursor
+        - per_page: page size, up to the API_MAX_PER_PAGE configuration key
+        - created_by, completed, created_from, created_to, completed_from, completed_to: filters of the list, see
+          todo.parse_todo_filters()
+
+    :return: JSON with the todos of the page and the cursors of the next and previous pages
+    """
+    per_page = request.args.get('per_page', current_app.config['TODOS_PER_PAGE'], type=int)
+    page = get_todo_page(
+        before=request.args.get('before'),
+        after=request.args.get('after'),
+        per_page=max(1, min(per_page, current_app.config.get('API_MAX_PER_PAGE', 500))),
+        **parse_todo_filters(request.args)
+    )
+    page['todos'] = [todo_to_dict(todo) for todo in page['todos']]
+    return jsonify(page)
+
+
+# @bp.route associates the URL '/api/todos/<int:id>' with the 'read_todo' view function
+@bp.route('/todos/<int:id>')
+def read_todo(id: int):
+    """
+    :param id: todo identifier
+
+    :return: JSON with the todo
+    """
+    return jsonify(todo_to_dict(get_todo(id, check_creator=False)))
+
+
+# @bp.route associates the URL '/api/stats' with the 'stats' view function
+@bp.route('/stats')
+def stats():
+    """
+    Statistics of the todos of each user, read from counters kept up to date by triggers, see stats.get_user_stats()
+
+    :return: JSON with the statistics of each user and the totals
+    """
+    return jsonify(get_user_stats())
+
+
+# @bp.route associates the URL '/api/todos/export' with the 'export' view function
+@bp.route('/todos/export')
+@api_login_required
+def export():
+    """
+    Export all the todos, streamed batch by batch, so the memory used doesn't grow with the number of todos.
+    The query string argument 'format' is 'ndjson' (default) or 'csv'.
+
+    :return: streamed response with the todos
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in MIMETYPES:
+        # 400 HTTP code means “Bad Request”
+        abort(400, 'Argument format must be csv or ndjson.')
+
+    return Response(
+        stream_export(fmt, current_app.config.get('EXPORT_BATCH_SIZE', 1000)),
+        mimetype=MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename=todos.{fmt}'}
+    )
+
+
+def _fetch_todos(db, ids: list) -> dict:
+    # Fetch the todos with the given ids, in chunks, keyed by id
+    ids = list(set(ids))
+    todos = {}
+    for start in range(0, len(ids), _IDS_PER_QUERY):
+        chunk = ids[start:start + _IDS_PER_QUERY]
+        for todo in db.execute(
+            f'SELECT {TODO_COLUMNS}'
+            ' FROM todo'
+            f' WHERE todo.id IN ({", ".join("?" * len(chunk))})',
+            chunk
+        ):
+            todos[todo['id']] = todo
+    return todos
+
+
+def _is_id(value) -> bool:
+    # JSON true and false are parsed as bool, which is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_fields(op: dict, task_required: bool) -> str:
+    # Error of the fields of a create or update operation, None if they are valid
+    if 'task' in op or task_required:
+        if not isinstance(op.get('task'), str) or not op['task']:
+            return 'Task name is required, as a non-empty string.'
+    if 'description' in op and not isinstance(op['description'], str):
+        return 'Description must be a string.'
+    if 'completed' in op and not isinstance(op['completed'], bool):
+        return 'Completed must be true or false.'
+    return None
+
+
+def _apply_bulk(db, shard, operations: list) -> tuple:
+    # Check and apply the operations of a bulk request, inside its transaction
+    ids = [
+        op['id'] for op in operations
+        if isinstance(op, dict) and op.get('op') in ('update', 'delete') and _is_id(op.get('id'))
+    ]
+    existing = _fetch_todos(db, ids)
+    # The todos of other shards can't be changed from this one, they are only read to answer why
+    others = {}
+    for id in ids:
+        if id not in existing and shard_of_todo(id) != shard:
+            others.setdefault(shard_of_todo(id), []).append(id)
+    elsewhere = {}
+    for other, other_ids in others.items():
+        elsewhere.update(_fetch_todos(get_read_db(other), other_ids))
+
+    results = [None] * len(operations)
+    creates, updates, deletes = [], [], []
+    created_positions = []
+    # In UTC, as created_at is set by CURRENT_TIMESTAMP
+    now = dt.datetime.utcnow()
+    for position, op in enumerate(operations):
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind == 'create':
+            error = _check_fields(op, task_required=True)
+            if error is not None:
+                results[position] = {'status': 400, 'error': error}
+                continue
+            creates.append((op['task'], op.get('description', ''), g.user['id']))
+            created_positions.append(position)
+
+        elif kind in ('update', 'delete'):
+            id = op.get('id')
+            if not _is_id(id):
+                results[position] = {'status': 400, 'error': 'Todo id is required, as an integer.'}
+                continue
+            if id in elsewhere and elsewhere[id]['created_by'] == g.user['id']:
+                # Left behind in another database by a move of the user that is still running
+                results[position] = {'status': 503, 'error': 'The todo is being moved, try again in a moment.'}
+                continue
+            error = check_todo(existing.get(id, elsewhere.get(id)), id)
+            if error is not None:
+                results[position] = {'status': error[0], 'error': error[1] or 'Forbidden.'}
+                continue
+            if kind == 'delete':
+                deletes.append((id, g.user['id']))
+                # Later operations of the batch on the same todo will not find it
+                del existing[id]
+                results[position] = {'status': 200, 'id': id}
+                continue
+
+            error = _check_fields(op, task_required=False)
+            if error is not None:
+                results[position] = {'status': 400, 'error': error}
+                continue
+            todo = existing[id]
+            task = op.get('task', todo['task'])
+            completed = int(op['completed']) if 'completed' in op else todo['completed']
+            # The completion time is kept while the todo stays completed
+            completed_at = (todo['completed_at'] or now) if completed else None
+            description = op.get('description', todo['description'])
+            updates.append((task, description, completed, completed_at, id, g.user['id']))
+            # Later operations of the batch on the same todo start from this one
+            existing[id] = {
+                **dict(todo), 'task': task, 'description': description, 'completed': completed,
+                'completed_at': completed_at
+            }
+            results[position] = {'status': 200, 'id': id}
+
+        else:
+            results[position] = {'status': 400, 'error': 'Operation must be create, update or delete.'}
+
+    if creates:
+        db.executemany(
+            'INSERT INTO todo (task, description, created_by, completed) VALUES (?, ?, ?, 0)', creates
+        )
+        # Inside the transaction, the AUTOINCREMENT ids of the batch are consecutive and end at the last one
+        last_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+        for offset, position in enumerate(created_positions):
+            results[position] = {'status': 201, 'id': last_id - len(creates) + 1 + offset}
+    if updates:
+        db.executemany(
+            'UPDATE todo SET task = ?, description = ?, completed = ?, completed_at = ?'
+            ' WHERE id = ? AND created_by = ?',
+            updates
+        )
+    if deletes:
+        db.executemany('DELETE FROM todo WHERE id = ? AND created_by = ?', deletes)
+    return results, creates, updates, deletes
+
+
+# @bp.route associates the URL '/api/todos/bulk' with the 'bulk' view function
+@bp.route('/todos/bulk', methods=('POST',))
+@api_login_required
+def bulk():
+    """
+    Apply many operations on todos in a single transaction, so a batch of any size costs one commit.
+    The body is a JSON array of operations, each one being one of the following, with task and description as strings
+     and completed as boolean:
+        - {"op": "create", "task": "...", "description": "..."}
+        - {"op": "update", "id": 1, "task": "...", "description": "...", "completed": true}, all fields but id optional
+        - {"op": "delete", "id": 1}
+    Updates and deletes go through the same ownership checks as the update and delete views. The operations are
+     applied with one executemany per kind of operation, all or none: when any of them fails, the transaction is rolled
+     back, the failed operations are reported with their error, the others with 424, and the response takes the status
+     of the first failure.
+    Updates and deletes refer to todos that existed before the batch.
+    When sharded, the batch is applied to the shard of the user, where all their todos are.
+
+    :return: JSON with one result per operation, in the same order: {"status": <HTTP code>, "id": ...} or
+             {"status": <HTTP code>, "error": "..."}
+    """
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list):
+        abort(400, 'The body must be a JSON array of operations.')
+    max_items = current_app.config.get('API_BULK_MAX_ITEMS', 10000)
+    if len(operations) > max_items:
+        # 413 HTTP code means “Payload Too Large”
+        abort(413, f'A bulk request can have up to {max_items} operations.')
+
+    shard = user_shard(g.user['id'], pin=True)
+    db = get_db(shard)
+    # Take the write lock from the start, so the todos checked are the same ones changed
+    with fenced(g.user['id']):
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            results, creates, updates, deletes = _apply_bulk(db, shard, operations)
+            failures = [result['status'] for result in results if result['status'] >= 400]
+            if failures:
+                db.rollback()
+            else:
+                db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    if failures:
+        # 424 HTTP code means “Failed Dependency”: the operation was valid, but not applied with the rest
+        results = [
+            result if result['status'] >= 400
+            else {'status': 424, 'error': 'Not applied, as another operation of the batch failed.'}
+            for result in results
+        ]
+        return jsonify(results=results), failures[0]
+    if creates or updates or deletes:
+        bump_data_version()
+    return jsonify(results=results)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# datetime: this module supplies classes for manipulating dates and times.
+import datetime as dt
+
+# Operator: "attrgetter" gives the sort key of the todos merged from the shards
+from operator import attrgetter
+
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
+from flask import Blueprint, current_app, render_template, request
+
+from todoer.render_cache import bump_data_version
+from todoer.shards import merge_shards
+from todoer.todo import TODO_COLUMNS, decode_cursor, encode_cursor, fetch_todos
+
+# Create a Blueprint named 'archive', without url_prefix
+bp = Blueprint('archive', __name__)
+
+# Columns copied from the todo table to the archive
+_COLUMNS = 'id, created_by, created_at, task, description, completed, completed_at'
+
+
+def archive_completed(run) -> dict:
+    """
+    Maintenance job that moves the todos completed more than ARCHIVE_AFTER_DAYS ago from the todo table to todo_archive,
+     in batches of ARCHIVE_BATCH_SIZE, each one in its own short transaction, until none is left or the time budget is
+     spent. So the hot table, and its indexes, only keep the todos still worth listing.
+    The todos leave the list, the search index and the live updates as if deleted, while the statistics keep counting
+     them, see the triggers of todo_archive in schema.sql. The todos of the users being moved to another shard are left
+     to the move, see shards.move_user().
+
+    :param run: run of the job, see maintenance.JobRun
+
+    :return: counters of the run, also kept in run.result as they grow, so they survive an interrupted batch
+    """
+    # completed_at is stored in UTC
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=run.config.get('ARCHIVE_AFTER_DAYS', 30))
+    batch_size = min(run.config.get('ARCHIVE_BATCH_SIZE', 500), 500)
+    run.result.update(archived=0, batches=0)
+    while not run.expired():
+        with run.transaction() as db:
+            # The timestamps are stored as text, so the cutoff is compared as text too
+            ids = [row[0] for row in db.execute(
+                'SELECT id FROM todo WHERE completed = 1 AND completed_at < ?'
+                ' AND created_by NOT IN (SELECT user_id FROM shard_fence) LIMIT ?',
+                (cutoff.isoformat(sep=' '), batch_size)
+            )]
+            if ids:
+                placeholders = ', '.join('?' * len(ids))
+                db.execute(
+                    f'INSERT INTO todo_archive ({_COLUMNS}) SELECT {_COLUMNS} FROM todo WHERE id IN ({placeholders})',
+                    ids
+                )
+                db.execute(f'DELETE FROM todo WHERE id IN ({placeholders})', ids)
+        if not ids:
+            break
+        run.result['archived'] += len(ids)
+        run.result['batches'] += 1
+        bump_data_version()
+    return run.result
+
+
+def get_archive_page(before: str = None, per_page: int = None) -> dict:
+    """
+    Fetch one page of the archived todos, most recent first, with the same keyset pagination as the todo list, merging
+     the archives of the shards when sharded.
+
+    :param before: cursor of the last todo of the previous page
+    :param per_page: page size, defaults to the TODOS_PER_PAGE configuration key
+
+    :return: dict with the todos of the page and the cursor of the next page
+    """
+    per_page = per_page or current_app.config['TODOS_PER_PAGE']
+    condition, params = '', []
+    if before:
+        condition = ' WHERE (todo.created_at, todo.id) < (?, ?)'
+        params.extend(decode_cursor(before))
+    # The archive is aliased as todo, so it's read with the same columns and records as the todo list
+    todos = merge_shards(
+        lambda conn: fetch_todos(
+            conn,
+            f'SELECT {TODO_COLUMNS} FROM todo_archive AS todo{condition}'
+            ' ORDER BY todo.created_at DESC, todo.id DESC LIMIT ?',
+            params + [per_page + 1]
+        ),
+        key=attrgetter('created_at', 'id'), reverse=True, limit=per_page + 1
+    )
+    return {
+        'todos': todos[:per_page],
+        'next_cursor': encode_cursor(todos[per_page - 1]) if len(todos) > per_page else None,
+    }
+
+
+# @bp.route associates the URL '/archive' with the 'index' view function
+@bp.route('/archive')
+def index() -> str:
+    """
+    Browse the archived todos, most recent first, one page at a time. The query string argument 'before' carries the
+     cursor of the page to show. Archived todos can't be edited, so their cards have no "Edit" link.
+
+    :return: rendered html of the archived todos
+    """
+    return render_template('archive/index.html', **get_archive_page(before=request.args.get('before')))
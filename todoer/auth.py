@@ -5,6 +5,8 @@
 #               - Takes on or more functions as argument
 #               - Returns a function as its result
 import functools
+# SQLite3: support for SQLite
+import sqlite3
 # Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
 #        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
 #        - "flash" allows nice and simple way to send and display small messages to the users
@@ -12,18 +14,69 @@ import functools
 #          multiple functions during the request
 #        - "session" allows referring to the user in the current context, which interacts with the Flask application
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
-# Werkzeug: has inbuilt functions for password hashing
-from werkzeug.security import check_password_hash, generate_password_hash
+# Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
+from werkzeug.exceptions import abort
 
-from todoer.db import get_db
+from todoer.cache import LRUCache, MISSING
+from todoer.db import get_db, get_read_db
+from todoer.hashing import HasherBusyError, get_hasher, get_login_throttle
+from todoer.usernames import get_usernames
 
 # Create a Blueprint named 'auth'. Like the app object, the blueprint needs to know where it’s defined, so __name__ is
 #  passed as the 2º argument. The url_prefix will be prepended to all the URLs associated with the blueprint.
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
+def hash_password(password: str) -> str:
+    """
+    Hash a password in the worker pool of the password hasher.
+    When the pool is saturated the request is refused, instead of queueing without limit.
+
+    :param password: plain text password
+
+    :return: hashed password
+    """
+    try:
+        return get_hasher().hash(password)
+    except HasherBusyError:
+        # 503 HTTP code means “Service Unavailable”
+        abort(503, 'The server is busy, try again in a moment.')
+
+
+def verify_password(user, password: str) -> bool:
+    """
+    Check a password against the hash stored for a user, in the worker pool of the password hasher.
+    When the password matches but the hash was made with another method or cost than the configured ones, the password
+     is transparently hashed again and stored, so the hashes get upgraded as the users log in.
+
+    :param user: user row
+    :param password: plain text password
+
+    :return: whether the password matches
+    """
+    hasher = get_hasher()
+    try:
+        if not hasher.verify(user['password'], password):
+            return False
+    except HasherBusyError:
+        # 503 HTTP code means “Service Unavailable”
+        abort(503, 'The server is busy, try again in a moment.')
+
+    if hasher.needs_rehash(user['password']):
+        # Hashed before taking the writer connection, so the other writes don't wait for the hash
+        new_hash = hash_password(password)
+        db = get_db()
+        db.execute('UPDATE user SET password = ? WHERE id = ?', (new_hash, user['id']))
+        db.commit()
+        hasher.count_rehash()
+        # The cached user row holds the old hash
+        get_user_cache().invalidate(user['id'])
+
+    return True
+
+
 # @bp.route associates the URL '/auth/register' with the 'register' view function
 # When using BluePrint (bp), the difference is that instead of routing with respect to the app, it is routed with
 #  respect to the bp. That is to say: rather than registering views and other code directly with an app,  they are
@@ -43,8 +96,8 @@ def register() -> str:
         username = request.form['username']
         password = request.form['password']
 
-        # Initialize variables
-        db = get_db()
+        # Initialize variables. The checks only read, so they don't take the writer connection
+        db = get_read_db()
         error = None
 
         # Validate that username and password are not empty.
@@ -60,11 +113,24 @@ def register() -> str:
 
         if error is None:
             # There are not error, create user with hashed password, because if the password stored version is stolen,
-            #  it cannot be openly read.
-            db.execute(
-                'INSERT INTO user (username, password) VALUES (?, ?)', (username, generate_password_hash(password))
-            )
-            db.commit()
+            #  it cannot be openly read. It's hashed before taking the writer connection, so the other writes don't
+            #  wait for the hash.
+            password_hash = hash_password(password)
+            db = get_db()
+            try:
+                user_id = db.execute(
+                    'INSERT INTO user (username, password) VALUES (?, ?)', (username, password_hash)
+                ).lastrowid
+                db.commit()
+            except sqlite3.IntegrityError:
+                # Registered by another request while the password was being hashed
+                db.rollback()
+                error = f'User {username} is already registered.'
+
+        if error is None:
+            # Drop any stale copy of the user row, e.g. of a deleted user with the same id
+            get_user_cache().invalidate(user_id)
+            get_usernames().add(user_id, username)
             # After storing the user, they are redirected to the login page.
             # url_for() generates the URL for the login view based on its name. The blueprint name is prepended to
             #  the function name, so the endpoint for the login function is 'auth.login', because it is added to the
@@ -95,22 +161,33 @@ def login() -> str:
         username = request.form['username']
         password = request.form['password']
 
+        # Failed logins are throttled per username and per IP address, before spending any time hashing
+        throttle = get_login_throttle()
+        throttle_keys = (f'user:{username}', f'ip:{request.remote_addr}')
+        if throttle.is_blocked(*throttle_keys):
+            flash('Too many failed logins. Try again later.')
+            # 429 HTTP code means “Too Many Requests”
+            return render_template('auth/login.html'), 429
+
         # The user is queried first and stored in a variable for later use.
-        user = get_db().execute(
+        user = get_read_db().execute(
             'SELECT * FROM user WHERE username = ?', (username, )
         ).fetchone()
 
         # Validate:
         #   - that exist user
-        #   - check_password_hash() hashes the submitted password in the same way as the stored hash and compares them
-        if user is None or not check_password_hash(user['password'], password):
+        #   - verify_password() hashes the submitted password in the same way as the stored hash and compares them
+        if user is None or not verify_password(user, password):
             error = 'Invalid username or password.'
+            throttle.fail(*throttle_keys)
 
             # As the validation fails, the error is shown to the user.
             # flash() stores messages that can be retrieved when rendering the template.
             flash(error)
 
         else:
+            throttle.reset(throttle_keys[0])
+
             # There are no error, the user’s id is stored in a new session is a dict that stores data across requests
             session.clear()
 
@@ -143,6 +220,42 @@ def logout() -> str:
     return redirect(url_for('index'))
 
 
+def get_user_cache() -> LRUCache:
+    """
+    Get the cache of user rows of the current app, keyed by user id, creating it on first use.
+    Its size and time to live are set by the USER_CACHE_SIZE and USER_CACHE_TTL configuration keys.
+
+    :return: user cache
+    """
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault('user_cache', LRUCache(
+            maxsize=current_app.config.get('USER_CACHE_SIZE', 1024),
+            ttl=current_app.config.get('USER_CACHE_TTL', 300.0)
+        ))
+    return cache
+
+
+def load_user(user_id: int):
+    """
+    Get a user row, from the cache or else from the database.
+
+    :param user_id: user identifier
+
+    :return: user row, or None if the user does not exist
+    """
+    cache = get_user_cache()
+    user = cache.get(user_id)
+    if user is MISSING:
+        user = get_read_db().execute(
+            'SELECT * FROM user WHERE id = ?', (user_id,)
+        ).fetchone()
+        # Missing users are not cached, so a user registered later is found at once
+        if user is not None:
+            cache.set(user_id, user)
+    return user
+
+
 # At the beginning of each request, if a user is logged in their information should be loaded and made available
 #  to other views.
 @bp.before_app_request
@@ -152,10 +265,9 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        # User id is stored in the session and gets that user’s data from the database, storing it on g.user
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        # User id is stored in the session. The user’s data is lazily loaded into g.user, that is to say, only when a
+        #  view or a template reads g.user, and then it is mostly served from the cache instead of the database.
+        g.lazy('user', lambda: load_user(user_id))
 
 
 # Creating, editing, and deleting tasks will require a user to be logged in.
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Collections: the OrderedDict keeps the entries from the least to the most recently used
+from collections import OrderedDict
+# Threading: the cache is shared by the threads serving requests, so it is guarded by a lock
+import threading
+# Time: clock used to expire the entries
+import time
+
+# Returned by get() when the key is not cached, since None can be a cached value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache, with a limited number of entries and a time to live.
+    When it is full, the least recently used entry is evicted to make room for the new one.
+    """
+
+    def __init__(self,
+                 maxsize: int = 1024,
+                 ttl: float = 300.0):
+        """
+        :param maxsize: maximum number of entries
+        :param ttl: seconds an entry lives after it is stored, None or 0 to never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expiration time, value)
+        self._entries = OrderedDict()
+        self._stats = dict.fromkeys(('hits', 'misses', 'evictions', 'expirations', 'invalidations'), 0)
+
+    def get(self, key, default=MISSING):
+        """
+        :param key: key of the entry
+        :param default: value returned when the key is not cached or has expired
+
+        :return: cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                del self._entries[key]
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+            return default
+
+    def set(self, key, value):
+        """
+        :param key: key of the entry
+        :param value: value to cache
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """
+        Remove an entry, when the data it was made from has changed.
+
+        :param key: key of the entry
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        """
+        Remove all the entries.
+        """
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        :return: counters of the cache, and its number of entries
+        """
+        with self._lock:
+            return {**self._stats, 'size': len(self._entries), 'maxsize': self.maxsize}
@@ -15,23 +15,287 @@ from flask import current_app, g
 from flask.cli import with_appcontext
 # SQLite3: support for SQLite
 import sqlite3
+# Threading: locks and conditions to share the pool of connections between the threads serving requests
+import threading
+# Time: clock used to know how long a connection has been idle, and how long a request waited for it
+import time
+# Collections: the deque holds the idle connections, the most recently used one is handed out first
+from collections import deque
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# URLLib: converts the database path to the URI needed to open it in read-only mode
+from urllib.request import pathname2url
 
 
-def get_db():
+class PoolTimeoutError(sqlite3.OperationalError):
     """
-    Connect to the Database
+    Raised when no connection of the pool became available within the configured timeout.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of warm SQLite connections.
+    Opening a connection means opening the file, parsing the schema and applying the PRAGMAs, so each connection is
+     created once, set up once and then lent to one request at a time, instead of being opened on every request.
+    """
+
+    def __init__(self,
+                 database: str,
+                 max_size: int = 8,
+                 timeout: float = 10.0,
+                 ping_after: float = 30.0,
+                 pragmas: dict = None,
+                 connect_options: dict = None,
+                 readonly: bool = False):
+        """
+        :param database: path of the SQLite database file
+        :param max_size: maximum number of connections open at the same time
+        :param timeout: seconds to wait for a free connection when all of them are in use
+        :param ping_after: seconds a connection can stay idle before it is health checked on checkout
+        :param pragmas: PRAGMAs applied once to each new connection, e.g. {'journal_mode': 'WAL'}
+        :param connect_options: additional keyword arguments for sqlite3.connect
+        :param readonly: open the connections in read-only mode, so they can never take the write lock
+        """
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.pragmas = pragmas or {}
+        self.connect_options = connect_options or {}
+        self.readonly = readonly
+        # Functions called with each new connection, once it is set up, e.g. to install a trace callback
+        self.on_connect = []
+
+        self._condition = threading.Condition()
+        # Idle connections, with the time they were returned to the pool
+        self._idle = deque()
+        self._size = 0
+        # A pool inherited by a forked process must not share the parent's connections
+        self._pid = os.getpid()
+        self._stats = dict.fromkeys(
+            ('created', 'acquired', 'released', 'waits', 'timeouts', 'health_checks', 'discarded'), 0
+        )
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open and set up a new connection.
+
+        :return: database connection
+        """
+        options = {'detect_types': sqlite3.PARSE_DECLTYPES, **self.connect_options}
+        database = self.database
+        if self.readonly:
+            # The URI with mode=ro opens the file without write access
+            database, options['uri'] = f'file:{pathname2url(os.path.abspath(database))}?mode=ro', True
+        # The connection is lent to different threads along its life, but never to two of them at the same time
+        conn = sqlite3.connect(database, check_same_thread=False, **options)
+        # Tells the connection to return rows that behave like dicts. This allows accessing the columns by name
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            # The journal and auto-vacuum modes are stored in the database file, so only the writer can change them
+            if not (self.readonly and name in ('journal_mode', 'auto_vacuum')):
+                conn.execute(f'PRAGMA {name} = {value}')
+        if self.readonly:
+            # Besides, any attempt to change the database fails, even through a temporary table
+            conn.execute('PRAGMA query_only = ON')
+        for callback in self.on_connect:
+            callback(conn)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Take a connection from the pool, opening a new one while the pool is under its size limit,
+         or waiting for one to be released otherwise.
+
+        :return: database connection
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            self._check_pid()
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    if time.monotonic() - idle_since < self.ping_after or self._is_healthy(conn):
+                        self._stats['acquired'] += 1
+                        return conn
+                    # The connection is broken, so drop it and try with another one
+                    self._discard(conn)
+                    continue
+
+                if self._size < self.max_size:
+                    # The slot is reserved now, and the connection opened below, out of the lock, so opening it doesn't
+                    #  hold up the threads releasing or taking idle connections
+                    self._size += 1
+                    break
+
+                # All connections are in use, wait until one is released or the timeout expires
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f'No database connection available after {self.timeout} seconds.')
+                self._stats['waits'] += 1
+                self._condition.wait(remaining)
+
+        try:
+            conn = self.connect()
+        except Exception:
+            # Give the slot back, and let a waiting thread try to open it
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats['created'] += 1
+            self._stats['acquired'] += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """
+        Give a connection back to the pool, rolling back any transaction left open.
+
+        :param conn: connection obtained by acquire
+        """
+        with self._condition:
+            if os.getpid() != self._pid:
+                # The connection belongs to the parent process
+                return
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+                self._stats['released'] += 1
+            self._condition.notify()
+
+    def close(self):
+        """
+        Close the idle connections. The ones in use are closed when they are released.
+        """
+        with self._condition:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self) -> dict:
+        """
+        :return: counters of the pool, and the number of connections open, idle and in use
+        """
+        with self._condition:
+            return {
+                **self._stats,
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+            }
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        self._stats['health_checks'] += 1
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn: sqlite3.Connection):
+        self._size -= 1
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            # After a fork the inherited connections are abandoned, not closed, as they are still the parent's
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+
+# Creating the pools of the app is serialized, so that concurrent first requests don't create two of them
+_pool_lock = threading.Lock()
+
+
+def shard_path(shard: int) -> str:
+    """
+    :param shard: shard number, see shards.py
+
+    :return: path of the database file of the shard, in the SHARD_DIR directory
+    """
+    return os.path.join(current_app.config['SHARD_DIR'], f'shard-{shard}.db')
+
+
+def get_pool(readonly: bool = False, shard: int = None) -> ConnectionPool:
+    """
+    Get a pool of connections of the current app, creating it on first use with the app configuration.
+    There are two pools: the writer pool, whose size (DATABASE_WRITER_POOL_SIZE, 1 by default) serializes the
+     requests that change data, and the read-only pool (DATABASE_POOL_SIZE), whose connections read in parallel under
+     WAL without ever waiting for the writer. Each shard has its own two pools, so the writers of different shards
+     don't wait for each other.
+
+    :param readonly: get the read-only pool instead of the writer one
+    :param shard: get the pool of this shard instead of the one of the main database
+
+    :return: connection pool
+    """
+    key = ('db_read_pool' if readonly else 'db_pool') + ('' if shard is None else f'_{shard}')
+    pool = current_app.extensions.get(key)
+    if pool is None:
+        with _pool_lock:
+            pool = current_app.extensions.get(key)
+            if pool is None:
+                config = current_app.config
+                if shard is not None and not readonly:
+                    os.makedirs(config['SHARD_DIR'], exist_ok=True)
+                pool = current_app.extensions[key] = ConnectionPool(
+                    config['DATABASE'] if shard is None else shard_path(shard),
+                    max_size=config.get('DATABASE_POOL_SIZE', 8) if readonly
+                    else config.get('DATABASE_WRITER_POOL_SIZE', 1),
+                    timeout=config.get('DATABASE_POOL_TIMEOUT', 10.0),
+                    ping_after=config.get('DATABASE_POOL_PING_AFTER', 30.0),
+                    pragmas=config.get('DATABASE_PRAGMAS'),
+                    connect_options=config.get('DATABASE_CONNECT_OPTIONS'),
+                    readonly=readonly
+                )
+    return pool
+
+
+def _instrument(conn):
+    # When the instrumentation is enabled, the connections of the requests are wrapped to time their statements
+    instrumentation = current_app.extensions.get('instrumentation')
+    return conn if instrumentation is None else instrumentation.wrap(conn)
+
+
+def _get_shard_db(shard: int, readonly: bool):
+    # The connections of the shards are kept in g.shard_dbs, by shard and mode, as the ones of the main database
+    shard_dbs = g.setdefault('shard_dbs', {})
+    if (shard, False) in shard_dbs:
+        # The request reads its own changes
+        return shard_dbs[(shard, False)]
+    if (shard, readonly) not in shard_dbs:
+        shard_dbs[(shard, readonly)] = _instrument(get_pool(readonly, shard).acquire())
+    return shard_dbs[(shard, readonly)]
+
+
+def get_db(shard: int = None):
+    """
+    Connect to the Database, through the writer connection
+
+    :param shard: connect to this shard instead of the main database, see shards.py
 
     :return: database connection
     """
+    if shard is not None:
+        return _get_shard_db(shard, readonly=False)
+
     if 'db' not in g:
-        # Establish a connection to the file pointed at by the DATABASE configuration key,
+        # Borrow the warm writer connection to the file pointed at by the DATABASE configuration key from the pool,
         #  and add as a property of g object
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        # Tells the connection to return rows that behave like dicts. This allows accessing the columns by name
-        g.db.row_factory = sqlite3.Row
+        g.db = _instrument(get_pool().acquire())
 
         """
         # Alternatively for MySql
@@ -49,31 +313,72 @@ def get_db():
     return g.db
 
 
+def get_read_db(shard: int = None):
+    """
+    Connect to the Database, through a read-only connection.
+    Used by the views and functions that only read, so they never queue behind the writer. However, when the request
+     already holds the writer connection, that one is returned, so the request reads its own changes.
+
+    :param shard: connect to this shard instead of the main database, see shards.py
+
+    :return: database connection
+    """
+    if shard is not None:
+        return _get_shard_db(shard, readonly=True)
+
+    if 'db' in g:
+        return g.db
+
+    if 'read_db' not in g:
+        g.read_db = _instrument(get_pool(readonly=True).acquire())
+
+    return g.read_db
+
+
 def close_db(e=None):
     """
-    Close existing connection
+    Give back the existing connections to their pools
 
     :param e:
     """
-    # Remove "db" property of object g
-    db = g.pop('db', None)
+    # Remove "db" and "read_db" properties of object g
+    for key, readonly in (('db', False), ('read_db', True)):
+        db = g.pop(key, None)
 
-    if db is not None:
-        # If the connection exists, it is closed.
-        db.close()
+        if db is not None:
+            # If the connection exists, it is returned to the pool, to be reused by the next request.
+            get_pool(readonly).release(getattr(db, 'connection', db))
 
+    for (shard, readonly), db in g.pop('shard_dbs', {}).items():
+        get_pool(readonly, shard).release(getattr(db, 'connection', db))
 
-def init_db():
+
+def create_schema(db):
     """
     Open and execute a file with the SQL commands necessary to create empty tables, before storing and retrieving data.
-    """
-    # Connect to the Database
-    db = get_db()
 
+    :param db: database connection
+    """
     # open_resource() opens a file relative to the flaskr package,
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    # schema.sql creates the latest version of the schema, so there are no migrations to apply on it
+    from todoer.migrations import LATEST_VERSION
+    db.execute(f'PRAGMA user_version = {LATEST_VERSION}')
+
+
+def init_db():
+    """
+    Create the empty tables of the main database and, when SHARDS is enabled, of each shard.
+    """
+    # Connect to the Database
+    create_schema(get_db())
+
+    from todoer.shards import init_shard
+    for shard in range(current_app.config.get('SHARDS', 0)):
+        init_shard(shard)
+
 
 # click.command() defines a command line, command called init-db that calls the init_db function and shows a success
 #  message to the user. To invoke it, run in CLI: flask init-db
@@ -81,7 +386,7 @@ def init_db():
 @with_appcontext
 def init_db_command():
     """
-    Clear the existing data and create new tables.
+    Clear the existing data and create new tables. To upgrade an existing database keeping its data, use db-upgrade.
     """
     init_db()
     click.echo('Initialized the database.')
@@ -97,3 +402,25 @@ def init_app(app):
     app.teardown_appcontext(close_db)
     # Adds a new command that can be called with the flask command.
     app.cli.add_command(init_db_command)
+    # Command to upgrade the schema of an existing database
+    from todoer.migrations import db_upgrade_command
+    app.cli.add_command(db_upgrade_command)
+    # Commands to export and import the todos
+    from todoer.transfer import export_todos_command, import_todos_command
+    app.cli.add_command(export_todos_command)
+    app.cli.add_command(import_todos_command)
+    # Command to rebuild the full-text search index
+    from todoer.search import reindex_search_command
+    app.cli.add_command(reindex_search_command)
+    # Command to check that the filters of the todo list are backed by indexes
+    from todoer.todo import check_query_plans_command
+    app.cli.add_command(check_query_plans_command)
+    # Command to recompute the statistics of the todos of each user
+    from todoer.stats import rebuild_stats_command
+    app.cli.add_command(rebuild_stats_command)
+    # Command to delete the old changes of the change feed
+    from todoer.feed import prune_changes_command
+    app.cli.add_command(prune_changes_command)
+    # Command to move users between the shards, and the todos of the main database into them
+    from todoer.shards import rebalance_shards_command
+    app.cli.add_command(rebalance_shards_command)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Visit https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# JSON: the data of each event
+import json
+# Threading: limits the streams open at the same time
+import threading
+# Time: clocks used to end the streams and to send the keep-alive comments
+import time
+
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
+#        - "Response" with a generator as body streams it to the client chunk by chunk
+#        - "stream_with_context" keeps the request context while the generator runs, as rendering the cards needs it
+from flask import Blueprint, Response, current_app, g, request, stream_with_context
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+# Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
+from werkzeug.exceptions import abort
+
+from todoer.db import close_db, get_db, get_pool
+from todoer.render_cache import data_version, render_card, wait_for_data_change
+from todoer.shards import shard_count
+from todoer.todo import TODO_COLUMNS, fetch_todos, last_change, live_update_streams
+
+# Create a Blueprint named 'feed', without url_prefix
+bp = Blueprint('feed', __name__)
+
+# Maximum number of ids bound to a single "IN (...)" query, below the SQLite limit of host parameters
+_IDS_PER_QUERY = 500
+
+# Streams open in each process, per app
+_streams_lock = threading.Lock()
+
+
+def read_changes(conn, since: int, limit: int = 500) -> list:
+    """
+    Read the changes of the todos after a sequence number. The change feed is filled by the triggers of schema.sql.
+
+    :param conn: database connection
+    :param since: sequence number of the last change already seen
+    :param limit: maximum number of changes
+
+    :return: list of tuples (seq, todo_id, op), op being 'insert', 'update' or 'delete', in order
+    """
+    return conn.execute(
+        'SELECT seq, todo_id, op FROM todo_change WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit)
+    ).fetchall()
+
+
+def _event(name: str, seq: int, data: dict) -> str:
+    # The browser keeps the id of the last event, and sends it back as Last-Event-ID when it reconnects
+    return f'event: {name}\nid: {seq}\ndata: {json.dumps(data)}\n\n'
+
+
+def _change_events(conn, changes: list, user_id) -> str:
+    # Only the last change of each todo matters, but a todo inserted and then updated is still new to the client
+    latest = {}
+    for seq, todo_id, op in changes:
+        if op == 'update' and latest.get(todo_id, (None, None))[1] == 'insert':
+            op = 'insert'
+        latest[todo_id] = (seq, op)
+
+    # The cards are rendered from the todos as they are now, the same for a change that was followed by others
+    ids = [todo_id for todo_id, (_, op) in latest.items() if op != 'delete']
+    todos = {}
+    for start in range(0, len(ids), _IDS_PER_QUERY):
+        chunk = ids[start:start + _IDS_PER_QUERY]
+        for todo in fetch_todos(
+            conn, f'SELECT {TODO_COLUMNS} FROM todo WHERE todo.id IN ({", ".join("?" * len(chunk))})', chunk
+        ):
+            todos[todo.id] = todo
+
+    events = []
+    for todo_id, (seq, op) in sorted(latest.items(), key=lambda item: item[1][0]):
+        todo = todos.get(todo_id)
+        if todo is None:
+            # Deleted, maybe by a later change than the one read
+            events.append(_event('delete', seq, {'id': todo_id}))
+        else:
+            events.append(_event('upsert', seq, {'id': todo_id, 'op': op, 'html': str(render_card(todo, user_id))}))
+    return ''.join(events)
+
+
+# @bp.route associates the URL '/changes' with the 'changes' view function
+@bp.route('/changes')
+def changes():
+    """
+    Stream the changes of the todos as Server-Sent Events, so the index patches its list instead of reloading it:
+        - upsert: a todo was created or updated, with its card rendered for the user
+        - delete: a todo was deleted
+        - reset: the client is too far behind, or the feed was pruned past it, and it should reload the page
+    The stream starts after the sequence number in the Last-Event-ID header, sent by the browser when it reconnects, or
+     else in the query string argument 'since'. As every open stream holds a thread of the server, the streams of each
+     process are limited by LIVE_UPDATES_MAX_STREAMS and the threads of the server, see todo.live_update_streams(),
+     and each one ends after LIVE_UPDATES_STREAM_SECONDS, the browser reconnecting from its last event.
+    Each shard has its own change feed, so there are no live updates when SHARDS is enabled.
+
+    :return: streamed response with the events
+    """
+    config = current_app.config
+    if not config.get('LIVE_UPDATES', True) or shard_count():
+        # 404 HTTP code means “Not Found”
+        abort(404)
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', ''))
+    except ValueError:
+        # 400 HTTP code means “Bad Request”
+        abort(400, 'Argument since must be the sequence number of a change.')
+
+    # The cards show the "Edit" link to their creator
+    user_id = g.user['id'] if g.user else None
+    # The connections used so far go back to their pools, the stream borrows one only while it reads the changes
+    close_db()
+    pool = get_pool(readonly=True)
+    stream_seconds = config.get('LIVE_UPDATES_STREAM_SECONDS', 30.0)
+    poll_interval = config.get('LIVE_UPDATES_POLL_INTERVAL', 1.0)
+    batch_size = config.get('LIVE_UPDATES_BATCH_SIZE', 500)
+    max_backlog = config.get('LIVE_UPDATES_MAX_BACKLOG', 1000)
+
+    def read(seq: int) -> tuple:
+        # Events of the changes after seq, and the sequence number they reach, or a reset event and None
+        conn = pool.acquire()
+        try:
+            last = last_change(conn)
+            first = conn.execute('SELECT MIN(seq) FROM todo_change').fetchone()[0]
+            if seq > last or last - seq > max_backlog or (first is not None and seq < first - 1):
+                # The database was replaced, applying the changes would cost more than reloading, or some of them were
+                #  pruned
+                return _event('reset', last, {}), None
+            events = []
+            while seq < last:
+                batch = read_changes(conn, seq, batch_size)
+                if not batch:
+                    break
+                events.append(_change_events(conn, batch, user_id))
+                seq = batch[-1][0]
+            return ''.join(events), seq
+        finally:
+            pool.release(conn)
+
+    @stream_with_context
+    def generate():
+        # Milliseconds the browser waits before reconnecting, once the stream ends
+        yield 'retry: 1000\n\n'
+        seq = since
+        seen = None
+        sent = started = time.monotonic()
+        while True:
+            version = data_version()
+            if version != seen:
+                # Taken before reading, so a change made meanwhile is read again on the next turn
+                seen = version
+                events, seq = read(seq)
+                if events:
+                    yield events
+                    sent = time.monotonic()
+                if seq is None:
+                    return
+
+            now = time.monotonic()
+            if now - started >= stream_seconds:
+                return
+            if now - sent >= 15:
+                # A comment, ignored by the browser, so a closed connection is noticed and its thread released
+                yield ': keep-alive\n\n'
+                sent = now
+            # Changes made by this process wake the stream right away, the ones of other processes are polled
+            wait_for_data_change(version, min(poll_interval, stream_seconds - (now - started)))
+
+    def release_stream():
+        with _streams_lock:
+            streams[0] -= 1
+
+    # Counted until the response is closed
+    with _streams_lock:
+        streams = current_app.extensions.setdefault('feed_streams', [0])
+        if streams[0] >= live_update_streams():
+            # 503 HTTP code means “Service Unavailable”
+            abort(503, 'Too many live update streams, try again later.')
+        streams[0] += 1
+
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # Called when the response is closed, whether the stream ended, the client left, or it never started
+    response.call_on_close(release_stream)
+    return response
+
+
+def prune_changes(db, keep_seconds: float) -> int:
+    """
+    Delete the changes older than a time. The clients that were behind them reload their page.
+
+    :param db: database connection
+    :param keep_seconds: age, in seconds, of the oldest change kept
+
+    :return: number of changes deleted
+    """
+    deleted = db.execute(
+        "DELETE FROM todo_change WHERE changed_at < datetime('now', ?)", (f'-{float(keep_seconds)} seconds', )
+    ).rowcount
+    db.commit()
+    return deleted
+
+
+# click.command() defines a command line, command called prune-changes. To invoke it, run in CLI: flask prune-changes
+@click.command('prune-changes')
+@click.option('--keep-seconds', type=float, default=None,
+              help='Age of the oldest change kept, defaults to the LIVE_UPDATES_RETENTION configuration key.')
+@with_appcontext
+def prune_changes_command(keep_seconds):
+    """
+    Delete the old changes of the todo change feed.
+    """
+    if keep_seconds is None:
+        keep_seconds = current_app.config.get('LIVE_UPDATES_RETENTION', 86400.0)
+    deleted = prune_changes(get_db(), keep_seconds)
+    click.echo(f'Deleted {deleted} changes.')
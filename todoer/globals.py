@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Flask: "_AppCtxGlobals" is the class of the "g" object, the namespace unique for each request
+from flask.ctx import _AppCtxGlobals
+
+
+class LazyAppGlobals(_AppCtxGlobals):
+    """
+    Class of the "g" object that, besides plain attributes, supports lazy ones: an attribute registered with lazy()
+     is only loaded the first time it is read, and then stored as a plain attribute for the rest of the request.
+    So work such as querying the logged-in user is skipped by the requests that never need it.
+    """
+
+    def lazy(self, name: str, loader):
+        """
+        Register a lazy attribute.
+
+        :param name: attribute name
+        :param loader: function without arguments that returns the value of the attribute
+        """
+        self.__dict__.pop(name, None)
+        self.__dict__.setdefault('_lazy_loaders', {})[name] = loader
+
+    def _load(self, name: str):
+        loader = self.__dict__.get('_lazy_loaders', {}).pop(name)
+        value = self.__dict__[name] = loader()
+        return value
+
+    def __getattr__(self, name: str):
+        # Only called when the attribute is not already stored
+        if name in self.__dict__.get('_lazy_loaders', ()):
+            return self._load(name)
+        raise AttributeError(name)
+
+    def __contains__(self, name: str) -> bool:
+        return super().__contains__(name) or name in self.__dict__.get('_lazy_loaders', ())
+
+    def get(self, name: str, default=None):
+        if name in self.__dict__.get('_lazy_loaders', ()):
+            return self._load(name)
+        return super().get(name, default)
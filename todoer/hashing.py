@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent.futures: the process pool runs the CPU-heavy hashing outside of the threads serving requests
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+# Collections: the deque holds the times of the recent failed logins of a username or IP address
+from collections import deque
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Threading: locks and semaphores shared by the threads serving requests
+import threading
+# Time: clocks used to measure the hashing time and to throttle the logins
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Werkzeug: has inbuilt functions for password hashing
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from todoer.cache import LRUCache
+
+
+class HasherBusyError(RuntimeError):
+    """
+    Raised when the queue of hashing jobs is full, instead of letting the requests pile up behind it, or when a job
+     takes longer than the timeout.
+    """
+
+
+def _normalize_method(method: str) -> tuple:
+    # Method and cost of a hash, filling in the iterations that Werkzeug uses when pbkdf2 is given without them
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return tuple(parts)
+
+
+def _timed(function, *args) -> tuple:
+    # Runs in the worker process, so the time measured is only the hashing time, without the time in the queue
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords in a dedicated, size-bounded pool of worker processes.
+    The password hashing is deliberately slow, so running it inline would saturate the threads serving requests during
+     a burst of logins. With the pool, the bursts queue in front of a few processes, up to a limit, and the rest of the
+     routes keep their latency.
+    """
+
+    def __init__(self,
+                 method: str = 'pbkdf2:sha256:260000',
+                 workers: int = 2,
+                 max_pending: int = 16,
+                 timeout: float = 10.0):
+        """
+        :param method: hash method, with its cost, for the new hashes, e.g. 'pbkdf2:sha256:260000'
+        :param workers: number of worker processes, 0 to hash in the calling thread
+        :param max_pending: maximum number of jobs running or waiting in the queue
+        :param timeout: seconds to wait for the result of a job
+        """
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._stats = dict.fromkeys(('hashes', 'verifications', 'rejected', 'rehashes'), 0)
+        self._stats.update(dict.fromkeys(('hash_seconds_total', 'hash_seconds_max', 'wait_seconds_total'), 0.0))
+
+    def hash(self, password: str) -> str:
+        """
+        :param password: plain text password
+
+        :return: hashed password
+        """
+        return self._run('hashes', generate_password_hash, password, self.method)
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        """
+        :param pwhash: hashed password, as stored in the database
+        :param password: plain text password to check
+
+        :return: whether the password matches the hash
+        """
+        return self._run('verifications', check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        """
+        :param pwhash: hashed password, as stored in the database
+
+        :return: whether the hash was made with another method or cost than the configured ones
+        """
+        return _normalize_method(pwhash.split('$', 1)[0]) != _normalize_method(self.method)
+
+    def count_rehash(self):
+        with self._lock:
+            self._stats['rehashes'] += 1
+
+    def stats(self) -> dict:
+        """
+        :return: counters and timings of the hashing jobs, and the current queue depth
+        """
+        with self._lock:
+            return {**self._stats, 'queue_depth': self._pending, 'max_pending': self.max_pending}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # A pool inherited by a forked process is unusable, so each process starts its own
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _run(self, counter: str, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HasherBusyError('Too many password hashing jobs in progress.')
+
+        with self._lock:
+            self._pending += 1
+        started = time.perf_counter()
+        if self.workers:
+            try:
+                future = self._get_executor().submit(_timed, function, *args)
+            except BaseException:
+                self._release()
+                raise
+            # The slot is freed once the job leaves the pool, so the jobs given up on still count while they run
+            future.add_done_callback(self._release)
+            try:
+                result, elapsed = future.result(self.timeout)
+            except FutureTimeoutError:
+                # Dropped from the queue if it didn't start yet, a running job can't be stopped
+                future.cancel()
+                raise HasherBusyError(f'Password hashing took longer than {self.timeout} seconds.') from None
+        else:
+            try:
+                result, elapsed = _timed(function, *args)
+            finally:
+                self._release()
+
+        with self._lock:
+            self._stats[counter] += 1
+            self._stats['hash_seconds_total'] += elapsed
+            self._stats['hash_seconds_max'] = max(self._stats['hash_seconds_max'], elapsed)
+            self._stats['wait_seconds_total'] += time.perf_counter() - started - elapsed
+        return result
+
+
+class LoginThrottle:
+    """
+    Counts the failed logins of each key (a username or an IP address) in a sliding window, so the keys with too many
+     recent failures are refused before spending any time hashing.
+    """
+
+    def __init__(self,
+                 max_failures: int = 5,
+                 window: float = 300.0,
+                 max_keys: int = 10000):
+        """
+        :param max_failures: failed logins allowed within the window
+        :param window: seconds a failed login is remembered
+        :param max_keys: maximum number of keys tracked, the least recently failed ones are forgotten first
+        """
+        self.max_failures = max_failures
+        self.window = window
+        self._lock = threading.Lock()
+        self._failures = LRUCache(maxsize=max_keys, ttl=window)
+
+    def is_blocked(self, *keys) -> bool:
+        """
+        :param keys: keys of the login attempt
+
+        :return: whether any of the keys reached the limit of failures
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._failures.get(key, None)
+                if failures is not None:
+                    while failures and failures[0] <= now - self.window:
+                        failures.popleft()
+                    if len(failures) >= self.max_failures:
+                        return True
+        return False
+
+    def fail(self, *keys):
+        """
+        :param keys: keys of the failed login attempt
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._failures.get(key, None) or deque(maxlen=self.max_failures)
+                failures.append(now)
+                self._failures.set(key, failures)
+
+    def reset(self, *keys):
+        """
+        :param keys: keys of the successful login
+        """
+        with self._lock:
+            for key in keys:
+                self._failures.invalidate(key)
+
+
+def get_hasher() -> PasswordHasher:
+    """
+    Get the password hasher of the current app, created on first use with the PASSWORD_HASH_* configuration keys.
+
+    :return: password hasher
+    """
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        config = current_app.config
+        hasher = current_app.extensions.setdefault('password_hasher', PasswordHasher(
+            method=config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000'),
+            workers=config.get('PASSWORD_HASH_WORKERS', 2),
+            max_pending=config.get('PASSWORD_HASH_MAX_PENDING', 16),
+            timeout=config.get('PASSWORD_HASH_TIMEOUT', 10.0)
+        ))
+    return hasher
+
+
+def get_login_throttle() -> LoginThrottle:
+    """
+    Get the login throttle of the current app, created on first use with the LOGIN_* configuration keys.
+
+    :return: login throttle
+    """
+    throttle = current_app.extensions.get('login_throttle')
+    if throttle is None:
+        throttle = current_app.extensions.setdefault('login_throttle', LoginThrottle(
+            max_failures=current_app.config.get('LOGIN_MAX_FAILURES', 5),
+            window=current_app.config.get('LOGIN_FAILURE_WINDOW', 300.0)
+        ))
+    return throttle
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# Visit https://www.w3.org/TR/server-timing/ and https://prometheus.io/docs/instrumenting/exposition_formats/
+
+# Bisect: finds the bucket of each observation of a histogram
+import bisect
+# Threading: the histograms are shared by the threads serving requests
+import threading
+# Time: clock used to time the statements, the rendering and the requests
+import time
+
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - "g" is a special object that is unique for each request. It holds the measures of the request
+#        - "has_request_context" tells whether the connections are used by a request, or by a command
+from flask import Response, current_app, g, has_request_context, request
+# Jinja2: templates of the app are instances of the template class of its environment
+from jinja2 import Template
+
+# Statements whose plan EXPLAIN QUERY PLAN can show
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+class RequestStats:
+    """
+    Measures of a request: the statements run, with their time, and the time spent rendering templates.
+    """
+    __slots__ = ('started', 'statements', 'render_time', 'render_depth')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # Lists [sql, parameters, seconds, connection], the time including the fetches of the rows
+        self.statements = []
+        self.render_time = 0.0
+        # Templates rendered inside another one, e.g. the cards of the todo list, are timed by the outermost one
+        self.render_depth = 0
+
+    @property
+    def sql_time(self) -> float:
+        return sum(statement[2] for statement in self.statements)
+
+
+class InstrumentedCursor:
+    """
+    Cursor that adds the time spent fetching its rows to the time of its statement.
+    """
+    __slots__ = ('_cursor', '_statement')
+
+    def __init__(self, cursor, statement: list):
+        self._cursor = cursor
+        self._statement = statement
+
+    def _timed(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._statement[2] += time.perf_counter() - started
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._timed(self._cursor.__next__)
+
+    def __getattr__(self, name: str):
+        # lastrowid, rowcount, description, close()...
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """
+    Connection that times every statement run through it, recording them in the measures of the request.
+    Only the statements are wrapped, any other attribute is the one of the connection.
+    """
+    __slots__ = ('connection', '_stats')
+
+    def __init__(self, connection, stats: RequestStats):
+        self.connection = connection
+        self._stats = stats
+
+    def _run(self, sql: str, parameters, run) -> tuple:
+        statement = [sql, parameters, 0.0, self.connection]
+        self._stats.statements.append(statement)
+        started = time.perf_counter()
+        try:
+            return run(), statement
+        finally:
+            statement[2] = time.perf_counter() - started
+
+    def execute(self, sql: str, parameters=()):
+        cursor, statement = self._run(sql, parameters, lambda: self.connection.execute(sql, parameters))
+        return InstrumentedCursor(cursor, statement)
+
+    def executemany(self, sql: str, parameters):
+        # The parameters may be a generator, consumed by the statement, so they are not kept to explain it
+        return self._run(sql, None, lambda: self.connection.executemany(sql, parameters))[0]
+
+    def executescript(self, script: str):
+        return self._run(script, None, lambda: self.connection.executescript(script))[0]
+
+    def commit(self):
+        self._run('COMMIT', None, self.connection.commit)
+
+    def rollback(self):
+        self._run('ROLLBACK', None, self.connection.rollback)
+
+    def __getattr__(self, name: str):
+        return getattr(self.connection, name)
+
+
+class TimedTemplate(Template):
+    """
+    Template that adds its rendering time to the measures of the request.
+    """
+
+    def render(self, *args, **kwargs):
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is None:
+            return super().render(*args, **kwargs)
+
+        stats.render_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats.render_depth -= 1
+            if not stats.render_depth:
+                stats.render_time += time.perf_counter() - started
+
+
+class Histogram:
+    """
+    Histogram of observations by label, with cumulative buckets as the Prometheus histograms.
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # {label: [counts of each bucket and of +Inf, sum]}
+        self._series = {}
+
+    def observe(self, label: str, value: float):
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def exposition(self) -> list:
+        """
+        :return: lines of the histogram in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((label, list(values)) for label, values in self._series.items())
+        for label, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{endpoint="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{endpoint="{label}"}} {values[-1]}')
+            lines.append(f'{self.name}_count{{endpoint="{label}"}} {cumulative}')
+        return lines
+
+
+class Instrumentation:
+    """
+    Per-request measures of the app, aggregated in histograms by endpoint.
+    The histograms are kept in memory by each process, so under several worker processes each one reports its own.
+    """
+
+    def __init__(self, slow_query_threshold: float = None, buckets: tuple = None):
+        """
+        :param slow_query_threshold: seconds from which a statement is logged with its query plan, None to log none
+        :param buckets: upper bounds, in seconds, of the buckets of the time histograms
+        """
+        self.slow_query_threshold = slow_query_threshold
+        buckets = buckets or (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+        self.histograms = (
+            Histogram('todoer_request_duration_seconds', 'Time to handle the requests, by endpoint.', buckets),
+            Histogram('todoer_request_sql_seconds', 'Time spent in SQL statements per request, by endpoint.',
+                      buckets),
+            Histogram('todoer_request_render_seconds', 'Time spent rendering templates per request, by endpoint.',
+                      buckets),
+            Histogram('todoer_request_statements', 'SQL statements per request, by endpoint.',
+                      (1, 2, 5, 10, 20, 50, 100, 200, 500)),
+        )
+
+    def wrap(self, connection):
+        """
+        :param connection: database connection borrowed from a pool
+
+        :return: the connection, timed for the current request, or as it is outside requests
+        """
+        stats = g.get('request_stats') if has_request_context() else None
+        return connection if stats is None else InstrumentedConnection(connection, stats)
+
+    def record(self, endpoint: str, stats: RequestStats, duration: float):
+        for histogram, value in zip(
+            self.histograms, (duration, stats.sql_time, stats.render_time, len(stats.statements))
+        ):
+            histogram.observe(endpoint, value)
+
+    def log_slow_statements(self, stats: RequestStats):
+        if self.slow_query_threshold is None:
+            return
+        for sql, parameters, seconds, connection in stats.statements:
+            if seconds < self.slow_query_threshold:
+                continue
+            plan = ''
+            if parameters is not None and sql.lstrip()[:7].upper().startswith(_EXPLAINABLE):
+                try:
+                    plan = '\n'.join(
+                        f'  {row[3]}' for row in connection.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)
+                    )
+                except Exception as e:
+                    plan = f'  (no plan: {e})'
+            current_app.logger.warning(
+                'Slow query, %.1f ms on %s: %s\n%s', seconds * 1000, request.endpoint, sql, plan
+            )
+
+    def exposition(self) -> str:
+        """
+        :return: all the histograms in the Prometheus text format
+        """
+        return '\n'.join(line for histogram in self.histograms for line in histogram.exposition()) + '\n'
+
+
+def get_instrumentation() -> Instrumentation:
+    """
+    :return: instrumentation of the current app, or None when it is disabled
+    """
+    return current_app.extensions.get('instrumentation')
+
+
+def _start_request():
+    g.request_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    instrumentation = get_instrumentation()
+    duration = time.perf_counter() - stats.started
+    instrumentation.log_slow_statements(stats)
+    instrumentation.record(request.endpoint or 'unknown', stats, duration)
+    # Visible in the network panel of the browser developer tools
+    response.headers['Server-Timing'] = (
+        f'sql;desc="{len(stats.statements)} statements";dur={stats.sql_time * 1000:.2f}, '
+        f'render;dur={stats.render_time * 1000:.2f}, '
+        f'app;dur={duration * 1000:.2f}'
+    )
+    return response
+
+
+def metrics():
+    """
+    :return: per-endpoint histograms of the requests, in the Prometheus text format
+    """
+    return Response(get_instrumentation().exposition(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """
+    Enable the instrumentation when the INSTRUMENTATION configuration key is set. Otherwise nothing is registered, and
+     the only cost left is one dictionary lookup per connection borrowed by a request.
+
+    :param app: application
+    """
+    if not app.config.get('INSTRUMENTATION', False):
+        return
+
+    app.extensions['instrumentation'] = Instrumentation(
+        app.config.get('SLOW_QUERY_THRESHOLD', 0.1), app.config.get('METRICS_BUCKETS')
+    )
+    # Must be set before any template is loaded, so all of them are timed
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
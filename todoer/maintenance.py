@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# Visit https://www.sqlite.org/lang_analyze.html, https://www.sqlite.org/pragma.html#pragma_incremental_vacuum and
+#  https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# Contextlib: the connections lent to the jobs are context managers
+import contextlib
+# JSON: the result of the last run of each job is stored as JSON
+import json
+# Logging: the duration and result of every run are logged
+import logging
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# SQLite3: support for SQLite
+import sqlite3
+# Threading: the scheduler thread, and the lock of its state
+import threading
+# Time: clocks of the periods, the quiet periods and the time budgets
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+
+from todoer.archive import archive_completed
+from todoer.db import get_pool
+from todoer.feed import prune_changes
+from todoer.render_cache import data_version
+from todoer.shards import database_ids, shard_count
+
+logger = logging.getLogger('todoer.maintenance')
+
+# Modes of PRAGMA wal_checkpoint
+_CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+class JobRun:
+    """
+    Context of one run of a maintenance job: the configuration, the time budget, the counters of the run, and the
+     helpers to borrow the writer connection for short periods, with any statement interrupted once the budget is spent.
+    """
+
+    def __init__(self, pool, config, budget: float):
+        """
+        :param pool: writer connection pool
+        :param config: configuration of the app
+        :param budget: seconds the run may take
+        """
+        self.pool = pool
+        self.config = config
+        self.deadline = time.monotonic() + budget
+        self.result = {}
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow the writer connection, so the requests only wait for it while a step of the job runs.
+        """
+        conn = self.pool.acquire()
+        # Called every few thousand instructions of the SQLite virtual machine, a true value interrupts the statement
+        conn.set_progress_handler(self.expired, 10000)
+        try:
+            yield conn
+        finally:
+            conn.set_progress_handler(None, 0)
+            self.pool.release(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Borrow the writer connection for one short write transaction, committed at the end of the block.
+        """
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+
+def _archive(run: JobRun):
+    archive_completed(run)
+
+
+def _prune_changes(run: JobRun):
+    with run.connection() as conn:
+        run.result['deleted'] = prune_changes(conn, run.config.get('LIVE_UPDATES_RETENTION', 86400.0))
+
+
+def _analyze(run: JobRun):
+    # ANALYZE only samples this many rows of each index, so it takes about the same time whatever the size of the tables
+    limit = int(run.config.get('ANALYSIS_LIMIT', 1000))
+    with run.connection() as conn:
+        conn.execute(f'PRAGMA analysis_limit = {limit}')
+        conn.execute('ANALYZE')
+    run.result['analysis_limit'] = limit
+
+
+def _incremental_vacuum(run: JobRun):
+    # Give the free pages back to the file system, a step at a time, each one in its own short transaction
+    with run.connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            run.result['skipped'] = 'auto_vacuum is not INCREMENTAL'
+            return
+    step = int(run.config.get('VACUUM_PAGES_PER_STEP', 256))
+    run.result['freed_pages'] = 0
+    while not run.expired():
+        with run.connection() as conn:
+            pages = min(conn.execute('PRAGMA freelist_count').fetchone()[0], step)
+            if not pages:
+                break
+            conn.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+        run.result['freed_pages'] += pages
+
+
+def _checkpoint(run: JobRun):
+    mode = run.config.get('CHECKPOINT_MODE', 'PASSIVE').upper()
+    if mode not in _CHECKPOINT_MODES:
+        raise ValueError(f'CHECKPOINT_MODE must be one of {", ".join(_CHECKPOINT_MODES)}.')
+    with run.connection() as conn:
+        busy, wal_pages, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+    run.result.update(busy=bool(busy), wal_pages=wal_pages, checkpointed_pages=checkpointed)
+
+
+# The maintenance jobs, in the order they run: the archive frees pages that the vacuum then gives back, and the
+#  checkpoint goes last, to copy into the database what the others wrote to the WAL
+JOBS = {
+    'archive': _archive,
+    'prune_changes': _prune_changes,
+    'incremental_vacuum': _incremental_vacuum,
+    'analyze': _analyze,
+    'checkpoint': _checkpoint,
+}
+
+
+def run_job(name: str, budget: float) -> dict:
+    """
+    Run a maintenance job within a time budget, log its duration and result, and record them in maintenance_job.
+    A job that runs out of budget stops, keeping the work of the steps already committed.
+    When sharded, the job runs on the main database and then on each shard, sharing the budget, and its result has the
+     one of each database.
+
+    :param name: name of the job, one of JOBS
+    :param budget: seconds the job may take
+
+    :return: result of the run, with the seconds taken and whether the budget interrupted it
+    """
+    deadline = time.monotonic() + budget
+    started_at = time.time()
+    started = time.perf_counter()
+    results = {}
+    interrupted = False
+    for database in database_ids():
+        run = JobRun(get_pool(shard=database), current_app.config, deadline - time.monotonic())
+        results['main' if database is None else f'shard {database}'] = run.result
+        try:
+            JOBS[name](run)
+        except sqlite3.OperationalError:
+            if not run.expired():
+                raise
+            # The progress handler interrupted a statement at the deadline
+            interrupted = True
+        if run.expired():
+            break
+    seconds = time.perf_counter() - started
+    result = {**(results if shard_count() else results['main']), 'seconds': seconds, 'interrupted': interrupted}
+
+    logger.info('Maintenance job %s done in %.0f ms%s: %s', name, seconds * 1000,
+                ' (budget spent)' if interrupted else '', results if shard_count() else results['main'])
+    # Recorded in the main database, out of the time budget, which may be spent by now
+    conn = get_pool().acquire()
+    try:
+        conn.execute(
+            'INSERT INTO maintenance_job (name, last_run_at, last_seconds, last_result) VALUES (?, ?, ?, ?)'
+            ' ON CONFLICT (name) DO UPDATE SET'
+            ' last_run_at = excluded.last_run_at, last_seconds = excluded.last_seconds,'
+            ' last_result = excluded.last_result',
+            (name, started_at, seconds, json.dumps(result))
+        )
+        conn.commit()
+    finally:
+        get_pool().release(conn)
+    return result
+
+
+class Scheduler:
+    """
+    Background thread that runs the maintenance jobs when they are due, during quiet periods: no request served by the
+     process and no change of the data for a while. A job that stays due through a busy time runs anyway once it is
+     overdue by another whole period.
+    The processes sharing the database take turns through the maintenance_job table: each one claims a due job there
+     before running it, so each job runs once per period whatever the number of processes.
+    """
+
+    def __init__(self,
+                 app,
+                 jobs: dict,
+                 check_interval: float = 10.0,
+                 quiet_seconds: float = 5.0):
+        """
+        :param app: application, whose writer pool the jobs use
+        :param jobs: period ('every') and time budget ('budget'), in seconds, of each job of JOBS to schedule
+        :param check_interval: seconds between checks for due jobs
+        :param quiet_seconds: seconds without requests nor changes that make a quiet period
+        """
+        self.app = app
+        self.jobs = {name: settings for name, settings in jobs.items() if name in JOBS}
+        self.check_interval = check_interval
+        self.quiet_seconds = quiet_seconds
+        self.last_request = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._runs = {}
+
+    def touch(self):
+        """
+        Record a request, which delays the jobs until the next quiet period, and start the thread if needed.
+        """
+        self.last_request = time.monotonic()
+        self.start()
+
+    def start(self):
+        # The thread doesn't survive a fork, so each worker process starts its own
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='todoer-maintenance', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'jobs': self.jobs, 'last_runs': dict(self._runs)}
+
+    def _claim(self, name: str, every: float, quiet: bool) -> bool:
+        # Due after its period, or after two when the app is busy. Only one process gets to update the row
+        now = time.time()
+        conn = get_pool().acquire()
+        try:
+            claimed = conn.execute(
+                'INSERT INTO maintenance_job (name, last_run_at) VALUES (?, ?)'
+                ' ON CONFLICT (name) DO UPDATE SET last_run_at = excluded.last_run_at WHERE last_run_at <= ?',
+                (name, now, now - (every if quiet else 2 * every))
+            ).rowcount == 1
+            conn.commit()
+        finally:
+            get_pool().release(conn)
+        return claimed
+
+    def run_pending(self, quiet: bool = True):
+        """
+        Run the jobs that are due, claiming each one first.
+
+        :param quiet: whether the app is quiet, otherwise only the overdue jobs run
+        """
+        for name, settings in self.jobs.items():
+            try:
+                if self._claim(name, settings['every'], quiet):
+                    result = run_job(name, settings['budget'])
+                    with self._lock:
+                        self._runs[name] = {'at': time.time(), **result}
+            except Exception:
+                logger.exception('Maintenance job %s failed', name)
+
+    def _run(self):
+        with self.app.app_context():
+            version, changed = None, time.monotonic()
+            while True:
+                time.sleep(self.check_interval)
+                current = data_version()
+                now = time.monotonic()
+                if current != version:
+                    version, changed = current, now
+                self.run_pending(quiet=now - max(self.last_request, changed) >= self.quiet_seconds)
+
+
+def get_scheduler() -> Scheduler:
+    """
+    :return: maintenance scheduler of the current app, or None when MAINTENANCE is disabled
+    """
+    return current_app.extensions.get('maintenance')
+
+
+# click.command() defines a command line, command called maintenance. To invoke it, run in CLI: flask maintenance
+@click.command('maintenance')
+@click.option('--job', 'jobs', type=click.Choice(tuple(JOBS)), multiple=True,
+              help='Job to run, can be repeated. Defaults to all of them.')
+@click.option('--budget', type=float, default=None,
+              help='Seconds each job may take, defaults to its budget in MAINTENANCE_JOBS.')
+@click.option('--schedule', is_flag=True,
+              help='Instead of running the jobs once, keep running them when due, as the scheduler of the app does.')
+@with_appcontext
+def maintenance_command(jobs, budget, schedule):
+    """
+    Run the maintenance jobs of the database: archive, prune_changes, incremental_vacuum, analyze and checkpoint.
+    """
+    settings = current_app.config.get('MAINTENANCE_JOBS', {})
+    if schedule:
+        scheduler = Scheduler(
+            current_app._get_current_object(),
+            {name: settings[name] for name in jobs or settings},
+            check_interval=current_app.config.get('MAINTENANCE_CHECK_INTERVAL', 10.0),
+            quiet_seconds=current_app.config.get('MAINTENANCE_QUIET_SECONDS', 5.0)
+        )
+        logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+        click.echo('Running the maintenance jobs when due, press Ctrl+C to stop.')
+        scheduler.start()
+        try:
+            scheduler._thread.join()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    for name in jobs or JOBS:
+        result = run_job(name, budget if budget is not None else settings.get(name, {}).get('budget', 5.0))
+        seconds = result.pop('seconds')
+        interrupted = result.pop('interrupted')
+        click.echo(f'{name}: {seconds * 1000:.0f} ms{" (budget spent)" if interrupted else ""} {result}')
+
+
+def init_app(app):
+    """
+    Register the maintenance command and, when MAINTENANCE is enabled, the scheduler of the jobs of MAINTENANCE_JOBS.
+    Its thread starts with the first request of each process, so the commands of the CLI don't start it.
+
+    :param app: application
+    """
+    app.cli.add_command(maintenance_command)
+    if not app.config.get('MAINTENANCE', False):
+        return
+
+    scheduler = app.extensions['maintenance'] = Scheduler(
+        app,
+        app.config.get('MAINTENANCE_JOBS', {}),
+        check_interval=app.config.get('MAINTENANCE_CHECK_INTERVAL', 10.0),
+        quiet_seconds=app.config.get('MAINTENANCE_QUIET_SECONDS', 5.0)
+    )
+    app.before_request(scheduler.touch)
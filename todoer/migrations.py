@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+# Visit https://www.sqlite.org/pragma.html#pragma_user_version
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Time: clock used to time the migrations, and to pause between batches
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+
+from todoer.db import get_db, shard_path
+from todoer.shards import database_ids, ensure_shards
+from todoer.stats import COUNT_TODOS, STATS_COLUMNS
+
+# Triggers that keep the full-text search index in sync with the todo table, as in schema.sql.
+# During the backfill of the index, the triggers only touch the todos already indexed, so {guard} is replaced by a
+#  WHEN clause, and then by nothing once the backfill is complete.
+_FTS_TRIGGERS = (
+    """CREATE TRIGGER todo_fts_insert AFTER INSERT ON todo BEGIN
+  INSERT INTO todo_fts (rowid, task, description) VALUES (new.id, new.task, new.description);
+END""",
+    """CREATE TRIGGER todo_fts_delete AFTER DELETE ON todo {guard}BEGIN
+  INSERT INTO todo_fts (todo_fts, rowid, task, description) VALUES ('delete', old.id, old.task, old.description);
+END""",
+    """CREATE TRIGGER todo_fts_update AFTER UPDATE OF task, description ON todo {guard}BEGIN
+  INSERT INTO todo_fts (todo_fts, rowid, task, description) VALUES ('delete', old.id, old.task, old.description);
+  INSERT INTO todo_fts (rowid, task, description) VALUES (new.id, new.task, new.description);
+END""",
+)
+
+# Triggers that keep the counters of user_stats up to date, as in schema.sql. {guard} works as in _FTS_TRIGGERS, while
+#  the counters are backfilled
+_STATS_ADD = """  INSERT INTO user_stats (user_id, open_todos, completed_todos, timed_todos, completion_seconds)
+  VALUES (
+    new.created_by, new.completed = 0, new.completed <> 0, new.completed <> 0 AND new.completed_at IS NOT NULL,
+    CASE WHEN new.completed <> 0 THEN IFNULL((julianday(new.completed_at) - julianday(new.created_at)) * 86400, 0) ELSE 0 END
+  )
+  ON CONFLICT (user_id) DO UPDATE SET
+    open_todos = open_todos + excluded.open_todos,
+    completed_todos = completed_todos + excluded.completed_todos,
+    timed_todos = timed_todos + excluded.timed_todos,
+    completion_seconds = completion_seconds + excluded.completion_seconds;"""
+_STATS_SUBTRACT = """  UPDATE user_stats SET
+    open_todos = open_todos - (old.completed = 0),
+    completed_todos = completed_todos - (old.completed <> 0),
+    timed_todos = timed_todos - (old.completed <> 0 AND old.completed_at IS NOT NULL),
+    completion_seconds = completion_seconds
+      - CASE WHEN old.completed <> 0 THEN IFNULL((julianday(old.completed_at) - julianday(old.created_at)) * 86400, 0) ELSE 0 END
+  WHERE user_id = old.created_by;"""
+_STATS_TRIGGERS = (
+    f"""CREATE TRIGGER user_stats_insert AFTER INSERT ON todo BEGIN
+{_STATS_ADD}
+END""",
+    f"""CREATE TRIGGER user_stats_delete AFTER DELETE ON todo {{guard}}BEGIN
+{_STATS_SUBTRACT}
+END""",
+    f"""CREATE TRIGGER user_stats_update AFTER UPDATE OF created_by, created_at, completed, completed_at ON todo {{guard}}BEGIN
+{_STATS_SUBTRACT}
+{_STATS_ADD}
+END""",
+)
+
+# Triggers that refuse the changes of the todos of the users moved to another shard, as in schema.sql
+_FENCE_TRIGGERS = tuple(
+    f'CREATE TRIGGER IF NOT EXISTS shard_fence_{op} BEFORE {op.upper()} ON todo'
+    f' WHEN EXISTS (SELECT 1 FROM shard_fence WHERE user_id = {row}.created_by{condition}) BEGIN'
+    " SELECT RAISE(ABORT, 'todoer: the user moved to another shard');"
+    ' END'
+    for op, row, condition in (('insert', 'new', ''), ('update', 'old', ''), ('delete', 'old', ' AND NOT draining'))
+)
+
+
+class Migration:
+    """
+    Context of a running migration: the connection, the batch settings, and the helpers to run work in batches that
+     yield to live traffic.
+    """
+
+    def __init__(self,
+                 db,
+                 batch_size: int = 5000,
+                 pause: float = 0.05,
+                 echo=None):
+        """
+        :param db: database connection
+        :param batch_size: rows per batch, each one in its own short transaction
+        :param pause: seconds slept between batches, letting the requests take the write lock
+        :param echo: function called with the progress messages
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        self.echo = echo or (lambda message: None)
+
+    def execute(self, *statements):
+        """
+        Run statements in one short write transaction, and then pause.
+
+        :param statements: SQL statements, or tuples (statement, params)
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                if isinstance(statement, tuple):
+                    self.db.execute(*statement)
+                else:
+                    self.db.execute(statement)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        time.sleep(self.pause)
+
+    def backfill(self,
+                 label: str,
+                 statement: str,
+                 start: int,
+                 end: int,
+                 checkpoint: str = None):
+        """
+        Run a statement over a range of ids, batch by batch, each batch in its own transaction.
+
+        :param label: name shown in the progress messages
+        :param statement: SQL statement with two parameters: the ids above the first one and up to the second one
+        :param start: id where the backfill starts, excluded
+        :param end: id where the backfill ends, included
+        :param checkpoint: SQL statement that records the last id done, in the same transaction as the batch, so an
+                           interrupted backfill resumes where it stopped
+        """
+        started = time.perf_counter()
+        low = start
+        while low < end:
+            high = min(low + self.batch_size, end)
+            statements = [(statement, (low, high))]
+            if checkpoint:
+                statements.append((checkpoint, (high, )))
+            self.execute(*statements)
+            low = high
+            elapsed = time.perf_counter() - started
+            self.echo(f'  {label}: {low - start}/{end - start} ids ({(low - start) / elapsed:.0f} ids/s)')
+
+
+def _table_exists(db, name: str) -> bool:
+    return db.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name, )).fetchone() is not None
+
+
+def _create_tables(m: Migration):
+    # Tables of the original schema, for databases created before the migrations
+    m.execute(
+        'CREATE TABLE IF NOT EXISTS user ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' username TEXT UNIQUE NOT NULL COLLATE RTRIM,'
+        ' password TEXT NOT NULL'
+        ')',
+        'CREATE TABLE IF NOT EXISTS todo ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' created_by INTEGER NOT NULL,'
+        ' created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,'
+        ' task TEXT NOT NULL COLLATE NOCASE,'
+        ' description TEXT NOT NULL COLLATE NOCASE,'
+        ' completed INTEGER NOT NULL DEFAULT 0,'
+        ' completed_at TIMESTAMP,'
+        ' FOREIGN KEY (created_by) REFERENCES user (id)'
+        ')'
+    )
+
+
+def _create_indexes(*indexes):
+    # Each index is built in its own transaction, so the requests get the write lock in between
+    def migrate(m: Migration):
+        for name, definition in indexes:
+            started = time.perf_counter()
+            m.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+            m.echo(f'  {name} built in {time.perf_counter() - started:.2f} seconds')
+    return migrate
+
+
+def _create_search_index(m: Migration):
+    # The search index is backfilled in batches while the todos keep changing. Until it is complete, the triggers only
+    #  keep in sync the todos already indexed: the ones up to the backfill progress, and the ones created after it
+    #  started. The rest get indexed with their current text when the backfill reaches them.
+    if _table_exists(m.db, 'todo_fts') and not (
+        _table_exists(m.db, 'migration_progress')
+        and m.db.execute("SELECT 1 FROM migration_progress WHERE name = 'todo_fts'").fetchone()
+    ):
+        # Already created, with its data, by schema.sql
+        return
+
+    m.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS todo_fts USING fts5("
+        " task, description, content = 'todo', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'"
+        ")",
+        'CREATE TABLE IF NOT EXISTS migration_progress ('
+        ' name TEXT PRIMARY KEY, done_to INTEGER NOT NULL, last_id INTEGER NOT NULL'
+        ')',
+        "INSERT OR IGNORE INTO migration_progress (name, done_to, last_id)"
+        " SELECT 'todo_fts', 0, IFNULL(MAX(id), 0) FROM todo",
+        'DROP TRIGGER IF EXISTS todo_fts_insert',
+        'DROP TRIGGER IF EXISTS todo_fts_delete',
+        'DROP TRIGGER IF EXISTS todo_fts_update',
+        *(trigger.format(guard=(
+            "WHEN old.id <= (SELECT done_to FROM migration_progress WHERE name = 'todo_fts')"
+            " OR old.id > (SELECT last_id FROM migration_progress WHERE name = 'todo_fts') "
+        )) for trigger in _FTS_TRIGGERS)
+    )
+
+    done_to, last_id = m.db.execute(
+        "SELECT done_to, last_id FROM migration_progress WHERE name = 'todo_fts'"
+    ).fetchone()
+    m.backfill(
+        'todo_fts',
+        'INSERT INTO todo_fts (rowid, task, description)'
+        ' SELECT id, task, description FROM todo WHERE id > ? AND id <= ?',
+        done_to, last_id,
+        checkpoint="UPDATE migration_progress SET done_to = ? WHERE name = 'todo_fts'"
+    )
+
+    m.execute(
+        'DROP TRIGGER todo_fts_delete',
+        'DROP TRIGGER todo_fts_update',
+        *(trigger.format(guard='') for trigger in _FTS_TRIGGERS[1:]),
+        "DELETE FROM migration_progress WHERE name = 'todo_fts'"
+    )
+
+
+def _create_user_stats(m: Migration):
+    # The counters are backfilled in batches, as the search index: until the backfill is complete, the triggers only
+    #  take into account the changes of the todos already counted
+    if _table_exists(m.db, 'user_stats') and not (
+        _table_exists(m.db, 'migration_progress')
+        and m.db.execute("SELECT 1 FROM migration_progress WHERE name = 'user_stats'").fetchone()
+    ):
+        # Already created, with its data, by schema.sql
+        return
+
+    m.execute(
+        'CREATE TABLE IF NOT EXISTS user_stats ('
+        ' user_id INTEGER PRIMARY KEY,'
+        ' open_todos INTEGER NOT NULL DEFAULT 0,'
+        ' completed_todos INTEGER NOT NULL DEFAULT 0,'
+        ' timed_todos INTEGER NOT NULL DEFAULT 0,'
+        ' completion_seconds REAL NOT NULL DEFAULT 0,'
+        ' FOREIGN KEY (user_id) REFERENCES user (id)'
+        ')',
+        'CREATE TABLE IF NOT EXISTS migration_progress ('
+        ' name TEXT PRIMARY KEY, done_to INTEGER NOT NULL, last_id INTEGER NOT NULL'
+        ')',
+        "INSERT OR IGNORE INTO migration_progress (name, done_to, last_id)"
+        " SELECT 'user_stats', 0, IFNULL(MAX(id), 0) FROM todo",
+        'DROP TRIGGER IF EXISTS user_stats_insert',
+        'DROP TRIGGER IF EXISTS user_stats_delete',
+        'DROP TRIGGER IF EXISTS user_stats_update',
+        *(trigger.format(guard=(
+            "WHEN old.id <= (SELECT done_to FROM migration_progress WHERE name = 'user_stats')"
+            " OR old.id > (SELECT last_id FROM migration_progress WHERE name = 'user_stats') "
+        )) for trigger in _STATS_TRIGGERS)
+    )
+
+    done_to, last_id = m.db.execute(
+        "SELECT done_to, last_id FROM migration_progress WHERE name = 'user_stats'"
+    ).fetchone()
+    m.backfill(
+        'user_stats',
+        f'INSERT INTO user_stats (user_id, {", ".join(STATS_COLUMNS)})'
+        f' {COUNT_TODOS.format(source="todo", where=" WHERE id > ? AND id <= ?")}'
+        ' ON CONFLICT (user_id) DO UPDATE SET '
+        + ', '.join(f'{column} = {column} + excluded.{column}' for column in STATS_COLUMNS),
+        done_to, last_id,
+        checkpoint="UPDATE migration_progress SET done_to = ? WHERE name = 'user_stats'"
+    )
+
+    m.execute(
+        'DROP TRIGGER user_stats_delete',
+        'DROP TRIGGER user_stats_update',
+        *(trigger.format(guard='') for trigger in _STATS_TRIGGERS[1:]),
+        "DELETE FROM migration_progress WHERE name = 'user_stats'"
+    )
+
+
+def _create_change_feed(m: Migration):
+    # The feed starts empty, with the changes made from now on, so there is nothing to backfill
+    m.execute(
+        'CREATE TABLE IF NOT EXISTS todo_change ('
+        ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' todo_id INTEGER NOT NULL,'
+        ' op TEXT NOT NULL,'
+        ' changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP'
+        ')',
+        *(
+            f'CREATE TRIGGER IF NOT EXISTS todo_change_{op} AFTER {op.upper()} ON todo BEGIN'
+            f" INSERT INTO todo_change (todo_id, op) VALUES ({'old' if op == 'delete' else 'new'}.id, '{op}');"
+            ' END'
+            for op in ('insert', 'update', 'delete')
+        )
+    )
+
+
+def _create_archive(m: Migration):
+    # The archive starts empty, filled by the maintenance job "archive", and its triggers add the archived todos back to
+    #  the counters of user_stats, as in schema.sql
+    m.execute(
+        'CREATE TABLE IF NOT EXISTS todo_archive ('
+        ' id INTEGER PRIMARY KEY,'
+        ' created_by INTEGER NOT NULL,'
+        ' created_at TIMESTAMP NOT NULL,'
+        ' task TEXT NOT NULL COLLATE NOCASE,'
+        ' description TEXT NOT NULL COLLATE NOCASE,'
+        ' completed INTEGER NOT NULL,'
+        ' completed_at TIMESTAMP,'
+        ' archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,'
+        ' FOREIGN KEY (created_by) REFERENCES user (id)'
+        ')',
+        'CREATE INDEX IF NOT EXISTS todo_archive_created_at_id_idx ON todo_archive (created_at, id)',
+        f'CREATE TRIGGER IF NOT EXISTS user_stats_archive_insert AFTER INSERT ON todo_archive BEGIN\n'
+        f'{_STATS_ADD}\nEND',
+        f'CREATE TRIGGER IF NOT EXISTS user_stats_archive_delete AFTER DELETE ON todo_archive BEGIN\n'
+        f'{_STATS_SUBTRACT}\nEND',
+        'CREATE TABLE IF NOT EXISTS maintenance_job ('
+        ' name TEXT PRIMARY KEY,'
+        ' last_run_at REAL NOT NULL,'
+        ' last_seconds REAL,'
+        ' last_result TEXT'
+        ')'
+    )
+
+
+def _create_shard_tables(m: Migration):
+    # Both tables start empty: the users are routed to the shards once SHARDS is enabled
+    m.execute(
+        'CREATE TABLE IF NOT EXISTS user_shard ('
+        ' user_id INTEGER PRIMARY KEY,'
+        ' shard INTEGER NOT NULL,'
+        ' FOREIGN KEY (user_id) REFERENCES user (id)'
+        ')',
+        'CREATE TABLE IF NOT EXISTS shard_fence ('
+        ' user_id INTEGER PRIMARY KEY,'
+        ' draining INTEGER NOT NULL DEFAULT 0'
+        ')',
+        *_FENCE_TRIGGERS
+    )
+
+
+# The migrations, in order. The version of a database is the number of migrations applied to it, and it is stored in
+#  PRAGMA user_version. schema.sql always creates the latest version, so any change to it needs a migration here.
+MIGRATIONS = (
+    ('Create the user and todo tables', _create_tables),
+    ('Index the todo list by (created_at, id)', _create_indexes(
+        ('todo_created_at_id_idx', 'todo (created_at, id)'),
+    )),
+    ('Create the full-text search index of the todos', _create_search_index),
+    ('Index the filters of the todo list', _create_indexes(
+        ('todo_created_by_completed_created_at_idx', 'todo (created_by, completed, created_at, id)'),
+        ('todo_created_by_created_at_idx', 'todo (created_by, created_at, id)'),
+        ('todo_completed_created_at_idx', 'todo (completed, created_at, id)'),
+        ('todo_completed_at_idx', 'todo (completed_at)'),
+    )),
+    ('Count the todos of each user in user_stats', _create_user_stats),
+    ('Create the change feed of the todos', _create_change_feed),
+    ('Create the archive of the todos and the maintenance jobs', _create_archive),
+    ('Create the shard map of the users and the fences of the shards', _create_shard_tables),
+)
+
+# Version of the schema created by schema.sql
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(db) -> int:
+    """
+    :param db: database connection
+
+    :return: schema version of the database
+    """
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def upgrade(db,
+            batch_size: int = 5000,
+            pause: float = 0.05,
+            echo=None) -> list:
+    """
+    Apply the pending migrations, in order. Each one records the new version as soon as it is complete, so an upgrade
+     that is interrupted resumes from the migration where it stopped.
+
+    :param db: database connection
+    :param batch_size: rows per batch of the backfills
+    :param pause: seconds slept between batches
+    :param echo: function called with the progress messages
+
+    :return: list of tuples (version, description, seconds) of the migrations applied
+    """
+    echo = echo or (lambda message: None)
+    m = Migration(db, batch_size, pause, echo)
+    applied = []
+    for version in range(get_version(db) + 1, LATEST_VERSION + 1):
+        description, migrate = MIGRATIONS[version - 1]
+        echo(f'Migration {version}: {description}...')
+        started = time.perf_counter()
+        migrate(m)
+        # PRAGMA doesn't accept parameters, the version is an int
+        m.execute(f'PRAGMA user_version = {int(version)}')
+        seconds = time.perf_counter() - started
+        echo(f'Migration {version} done in {seconds:.2f} seconds.')
+        applied.append((version, description, seconds))
+    return applied
+
+
+# click.command() defines a command line, command called db-upgrade. To invoke it, run in CLI: flask db-upgrade
+@click.command('db-upgrade')
+@click.option('--batch-size', type=int, default=None,
+              help='Rows per batch, defaults to the MIGRATION_BATCH_SIZE configuration key.')
+@click.option('--pause', type=float, default=None,
+              help='Seconds between batches, defaults to the MIGRATION_PAUSE configuration key.')
+@click.option('--dry-run', is_flag=True, help='Only list the pending migrations.')
+@with_appcontext
+def db_upgrade_command(batch_size, pause, dry_run):
+    """
+    Upgrade the database schema, keeping the data, while the app keeps serving requests. When sharded, the main
+     database and then every shard, creating the shards missing.
+    """
+    if not dry_run:
+        ensure_shards(click.echo)
+    for database in database_ids():
+        name = 'The database' if database is None else f'Shard {database}'
+        if database is not None and not os.path.exists(shard_path(database)):
+            click.echo(f'{name} is missing, it will be created at version {LATEST_VERSION}.')
+            continue
+        db = get_db(database)
+        version = get_version(db)
+        if version >= LATEST_VERSION:
+            click.echo(f'{name} is up to date, at version {version}.')
+            continue
+
+        if dry_run:
+            for pending in range(version + 1, LATEST_VERSION + 1):
+                click.echo(f'{name}, migration {pending}: {MIGRATIONS[pending - 1][0]}')
+            continue
+
+        started = time.perf_counter()
+        applied = upgrade(
+            db,
+            batch_size or current_app.config.get('MIGRATION_BATCH_SIZE', 5000),
+            current_app.config.get('MIGRATION_PAUSE', 0.05) if pause is None else pause,
+            click.echo
+        )
+        click.echo(
+            f'Upgraded {name[0].lower() + name[1:]} from version {version} to {applied[-1][0]}'
+            f' in {time.perf_counter() - started:.2f} seconds.'
+        )
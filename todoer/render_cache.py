@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Hashlib: digests the cache key of a page into its ETag
+import hashlib
+# OS: the held connections are reopened after a fork
+import os
+# SQLite3: the data version is read from the databases
+import sqlite3
+# Threading: the data version is shared by the threads serving requests
+import threading
+
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - "current_app" is a special object that points to the Flask application handling the request
+#        - "render_template" renders the card partial when it is not cached
+from flask import current_app, render_template
+# MarkupSafe: marks the cached html as safe, so Jinja doesn't escape it again
+from markupsafe import Markup
+
+from todoer.cache import LRUCache, MISSING
+from todoer.db import get_pool
+from todoer.shards import database_ids
+
+# Last sequence number of the change feed, see feed.py. As the sequence is AUTOINCREMENT, it never goes back, even when
+#  the changes are pruned
+_LAST_CHANGE = "SELECT IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'todo_change'), 0)"
+
+
+class DataVersion:
+    """
+    Version of the todos, so anything rendered from them can be keyed by the version of the data it was rendered from,
+     and simply stops being used when the data changes.
+    The version is the last sequence number of the change feed of each database, written by the triggers of schema.sql
+     whichever process changes the todos, so every process of the server agrees on it, and an ETag given by one of them
+     is validated by the others. Each database is read through a connection held for it, that only reads the sequence
+     again when its PRAGMA data_version tells that another connection committed meanwhile.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._lock = threading.Lock()
+        # Held connection of each database, with the last PRAGMA data_version and sequence number read through it
+        self._readers = {}
+        # A forked process must not share the parent's connections
+        self._pid = os.getpid()
+
+    def bump(self):
+        """
+        Wake up the waiters of this process, once the todos changed.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, value: tuple, timeout: float) -> bool:
+        """
+        Wait until the version moves past a value, e.g. for the change feed to push the change as soon as it's made.
+        Only the changes made by this process wake the waiter up before the timeout.
+
+        :param value: version already seen
+        :param timeout: maximum seconds to wait
+
+        :return: whether the version changed
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.value() != value, timeout)
+
+    def value(self) -> tuple:
+        """
+        :return: last change of each database of the app
+        """
+        with self._lock:
+            if os.getpid() != self._pid:
+                # The inherited connections are abandoned, not closed, as they are still the parent's
+                self._readers.clear()
+                self._pid = os.getpid()
+            return tuple(self._read(database) for database in database_ids())
+
+    def _read(self, database) -> int:
+        reader = self._readers.get(database)
+        try:
+            if reader is None:
+                reader = self._readers[database] = [get_pool(readonly=True, shard=database).connect(), None, 0]
+            conn = reader[0]
+            # Read before the sequence, so a change committed in between is read on the next call
+            changes = conn.execute('PRAGMA data_version').fetchone()[0]
+            if changes != reader[1]:
+                reader[1:] = changes, conn.execute(_LAST_CHANGE).fetchone()[0]
+            return reader[2]
+        except sqlite3.Error:
+            # The database is not created or upgraded yet, it is opened again on the next call
+            self._readers.pop(database, None)
+            if reader is not None:
+                reader[0].close()
+            return 0
+
+
+def _get_extension(name: str, factory):
+    extension = current_app.extensions.get(name)
+    if extension is None:
+        extension = current_app.extensions.setdefault(name, factory())
+    return extension
+
+
+def get_page_cache() -> LRUCache:
+    """
+    :return: cache of whole rendered pages of the todo list, sized by PAGE_CACHE_SIZE and PAGE_CACHE_TTL
+    """
+    return _get_extension('page_cache', lambda: LRUCache(
+        maxsize=current_app.config.get('PAGE_CACHE_SIZE', 256),
+        ttl=current_app.config.get('PAGE_CACHE_TTL', 300.0)
+    ))
+
+
+def get_card_cache() -> LRUCache:
+    """
+    :return: cache of rendered todo cards, sized by CARD_CACHE_SIZE and CARD_CACHE_TTL
+    """
+    return _get_extension('card_cache', lambda: LRUCache(
+        maxsize=current_app.config.get('CARD_CACHE_SIZE', 4096),
+        ttl=current_app.config.get('CARD_CACHE_TTL', 3600.0)
+    ))
+
+
+def bump_data_version():
+    """
+    Record that the todos changed. Called by the views after they commit a change, so the change feeds of this process
+     push it right away.
+    """
+    _get_extension('data_version', DataVersion).bump()
+
+
+def wait_for_data_change(version: tuple, timeout: float) -> bool:
+    """
+    Wait until the todos change after the given version was taken, up to a timeout. Only the changes made by this
+     process wake it up before the timeout, the caller checks data_version() again after it for the changes made by
+     other processes.
+
+    :param version: data version, as returned by data_version()
+    :param timeout: maximum seconds to wait
+
+    :return: whether the todos changed
+    """
+    return _get_extension('data_version', DataVersion).wait(version, timeout)
+
+
+def data_version() -> tuple:
+    """
+    Get the current version of the data, the same in every process sharing the databases, see DataVersion.
+    It costs a PRAGMA data_version per database, plus a lookup of the change feed sequence when the database changed.
+
+    :return: data version
+    """
+    return _get_extension('data_version', DataVersion).value()
+
+
+def make_etag(key: tuple) -> str:
+    """
+    :param key: cache key of a page
+
+    :return: entity tag of the page
+    """
+    return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+
+def render_card(todo, user_id) -> Markup:
+    """
+    Render the card of a todo, or get it from the cache.
+    The card is keyed by the todo record itself, a tuple of its values, so it's rendered again only when that todo
+     changes, and by whether the viewer created the todo, as only the creator gets the "Edit" link.
+
+    :param todo: todo, as a todo.TodoRecord
+    :param user_id: identifier of the logged-in user, or None
+
+    :return: html of the card
+    """
+    cache = get_card_cache()
+    key = (todo, todo.created_by == user_id)
+    card = cache.get(key)
+    if card is MISSING:
+        card = Markup(render_template('todo/_card.html', todo=todo, is_creator=key[1]))
+        cache.set(key, card)
+    return card
@@ -1,6 +1,17 @@
+-- This script creates the latest version of the schema, dropping any data. Existing databases are upgraded keeping their
+--  data by the migrations of migrations.py, with: flask db-upgrade. So any change here needs a migration there.
+
 -- Disable the enforcement of foreign key constraints.
 PRAGMA foreign_keys = OFF;
 
+DROP TABLE IF EXISTS shard_fence;
+DROP TABLE IF EXISTS user_shard;
+DROP TABLE IF EXISTS maintenance_job;
+DROP TABLE IF EXISTS todo_archive;
+DROP TABLE IF EXISTS migration_progress;
+DROP TABLE IF EXISTS user_stats;
+DROP TABLE IF EXISTS todo_change;
+DROP TABLE IF EXISTS todo_fts;
 DROP TABLE IF EXISTS todo;
 DROP TABLE IF EXISTS user;
 
@@ -24,3 +35,197 @@ CREATE TABLE todo (
   completed_at TIMESTAMP,
   FOREIGN KEY (created_by) REFERENCES user (id)
 );
+
+-- Keyset pagination of the todo list, most recent first, walks this index from the page cursor (created_at, id).
+CREATE INDEX todo_created_at_id_idx ON todo (created_at, id);
+
+-- Filters of the todo list. Each index ends with (created_at, id), so the filtered page is still read in order straight
+--  from the index, starting at the page cursor, and without sorting.
+CREATE INDEX todo_created_by_completed_created_at_idx ON todo (created_by, completed, created_at, id);
+CREATE INDEX todo_created_by_created_at_idx ON todo (created_by, created_at, id);
+CREATE INDEX todo_completed_created_at_idx ON todo (completed, created_at, id);
+-- The range of completion dates is searched on its own index, and only the todos within it are sorted.
+CREATE INDEX todo_completed_at_idx ON todo (completed_at);
+
+-- Full-text search index of the task and description of the todos. It is an external content FTS5 table: it stores
+--  only the index, and reads the text from the todo table. Visit https://www.sqlite.org/fts5.html
+CREATE VIRTUAL TABLE todo_fts USING fts5(
+  task,
+  description,
+  content = 'todo',
+  content_rowid = 'id',
+  tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- The triggers keep the search index in sync with the todo table.
+CREATE TRIGGER todo_fts_insert AFTER INSERT ON todo BEGIN
+  INSERT INTO todo_fts (rowid, task, description) VALUES (new.id, new.task, new.description);
+END;
+
+CREATE TRIGGER todo_fts_delete AFTER DELETE ON todo BEGIN
+  INSERT INTO todo_fts (todo_fts, rowid, task, description) VALUES ('delete', old.id, old.task, old.description);
+END;
+
+CREATE TRIGGER todo_fts_update AFTER UPDATE OF task, description ON todo BEGIN
+  INSERT INTO todo_fts (todo_fts, rowid, task, description) VALUES ('delete', old.id, old.task, old.description);
+  INSERT INTO todo_fts (rowid, task, description) VALUES (new.id, new.task, new.description);
+END;
+
+-- Counters of the todos of each user, so the statistics are read in O(users) instead of scanning the todo table. The
+--  triggers below keep them up to date on every change of the todos, and flask rebuild-stats recomputes them from scratch.
+--  The average completion time is completion_seconds / timed_todos: the completed todos with a completion time.
+CREATE TABLE user_stats (
+  user_id INTEGER PRIMARY KEY,
+  open_todos INTEGER NOT NULL DEFAULT 0,
+  completed_todos INTEGER NOT NULL DEFAULT 0,
+  timed_todos INTEGER NOT NULL DEFAULT 0,
+  completion_seconds REAL NOT NULL DEFAULT 0,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE TRIGGER user_stats_insert AFTER INSERT ON todo BEGIN
+  INSERT INTO user_stats (user_id, open_todos, completed_todos, timed_todos, completion_seconds)
+  VALUES (
+    new.created_by, new.completed = 0, new.completed <> 0, new.completed <> 0 AND new.completed_at IS NOT NULL,
+    CASE WHEN new.completed <> 0 THEN IFNULL((julianday(new.completed_at) - julianday(new.created_at)) * 86400, 0) ELSE 0 END
+  )
+  ON CONFLICT (user_id) DO UPDATE SET
+    open_todos = open_todos + excluded.open_todos,
+    completed_todos = completed_todos + excluded.completed_todos,
+    timed_todos = timed_todos + excluded.timed_todos,
+    completion_seconds = completion_seconds + excluded.completion_seconds;
+END;
+
+CREATE TRIGGER user_stats_delete AFTER DELETE ON todo BEGIN
+  UPDATE user_stats SET
+    open_todos = open_todos - (old.completed = 0),
+    completed_todos = completed_todos - (old.completed <> 0),
+    timed_todos = timed_todos - (old.completed <> 0 AND old.completed_at IS NOT NULL),
+    completion_seconds = completion_seconds
+      - CASE WHEN old.completed <> 0 THEN IFNULL((julianday(old.completed_at) - julianday(old.created_at)) * 86400, 0) ELSE 0 END
+  WHERE user_id = old.created_by;
+END;
+
+-- An update takes the old values of the todo out of the counters, and adds the new ones.
+CREATE TRIGGER user_stats_update AFTER UPDATE OF created_by, created_at, completed, completed_at ON todo BEGIN
+  UPDATE user_stats SET
+    open_todos = open_todos - (old.completed = 0),
+    completed_todos = completed_todos - (old.completed <> 0),
+    timed_todos = timed_todos - (old.completed <> 0 AND old.completed_at IS NOT NULL),
+    completion_seconds = completion_seconds
+      - CASE WHEN old.completed <> 0 THEN IFNULL((julianday(old.completed_at) - julianday(old.created_at)) * 86400, 0) ELSE 0 END
+  WHERE user_id = old.created_by;
+  INSERT INTO user_stats (user_id, open_todos, completed_todos, timed_todos, completion_seconds)
+  VALUES (
+    new.created_by, new.completed = 0, new.completed <> 0, new.completed <> 0 AND new.completed_at IS NOT NULL,
+    CASE WHEN new.completed <> 0 THEN IFNULL((julianday(new.completed_at) - julianday(new.created_at)) * 86400, 0) ELSE 0 END
+  )
+  ON CONFLICT (user_id) DO UPDATE SET
+    open_todos = open_todos + excluded.open_todos,
+    completed_todos = completed_todos + excluded.completed_todos,
+    timed_todos = timed_todos + excluded.timed_todos,
+    completion_seconds = completion_seconds + excluded.completion_seconds;
+END;
+
+-- Change feed of the todos: an append-only sequence of their changes, filled by the triggers below, that the index
+--  follows through Server-Sent Events to patch its list, see feed.py. AUTOINCREMENT never reuses a sequence number,
+--  even after the old changes are pruned with flask prune-changes.
+CREATE TABLE todo_change (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  todo_id INTEGER NOT NULL,
+  op TEXT NOT NULL,   -- 'insert', 'update' or 'delete'
+  changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER todo_change_insert AFTER INSERT ON todo BEGIN
+  INSERT INTO todo_change (todo_id, op) VALUES (new.id, 'insert');
+END;
+
+CREATE TRIGGER todo_change_update AFTER UPDATE ON todo BEGIN
+  INSERT INTO todo_change (todo_id, op) VALUES (new.id, 'update');
+END;
+
+CREATE TRIGGER todo_change_delete AFTER DELETE ON todo BEGIN
+  INSERT INTO todo_change (todo_id, op) VALUES (old.id, 'delete');
+END;
+
+-- Todos completed long ago, moved out of the todo table by the maintenance job "archive", so the list, its indexes and
+--  the search index only keep the todos still worth listing, see archive.py. Browsed at /archive.
+CREATE TABLE todo_archive (
+  id INTEGER PRIMARY KEY,
+  created_by INTEGER NOT NULL,
+  created_at TIMESTAMP NOT NULL,
+  task TEXT NOT NULL COLLATE NOCASE,
+  description TEXT NOT NULL COLLATE NOCASE,
+  completed INTEGER NOT NULL,
+  completed_at TIMESTAMP,
+  archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (created_by) REFERENCES user (id)
+);
+
+CREATE INDEX todo_archive_created_at_id_idx ON todo_archive (created_at, id);
+
+-- The statistics keep counting the archived todos: moving a todo to the archive subtracts it from the counters as a
+--  deletion of the todo table, and these triggers add it back.
+CREATE TRIGGER user_stats_archive_insert AFTER INSERT ON todo_archive BEGIN
+  INSERT INTO user_stats (user_id, open_todos, completed_todos, timed_todos, completion_seconds)
+  VALUES (
+    new.created_by, new.completed = 0, new.completed <> 0, new.completed <> 0 AND new.completed_at IS NOT NULL,
+    CASE WHEN new.completed <> 0 THEN IFNULL((julianday(new.completed_at) - julianday(new.created_at)) * 86400, 0) ELSE 0 END
+  )
+  ON CONFLICT (user_id) DO UPDATE SET
+    open_todos = open_todos + excluded.open_todos,
+    completed_todos = completed_todos + excluded.completed_todos,
+    timed_todos = timed_todos + excluded.timed_todos,
+    completion_seconds = completion_seconds + excluded.completion_seconds;
+END;
+
+CREATE TRIGGER user_stats_archive_delete AFTER DELETE ON todo_archive BEGIN
+  UPDATE user_stats SET
+    open_todos = open_todos - (old.completed = 0),
+    completed_todos = completed_todos - (old.completed <> 0),
+    timed_todos = timed_todos - (old.completed <> 0 AND old.completed_at IS NOT NULL),
+    completion_seconds = completion_seconds
+      - CASE WHEN old.completed <> 0 THEN IFNULL((julianday(old.completed_at) - julianday(old.created_at)) * 86400, 0) ELSE 0 END
+  WHERE user_id = old.created_by;
+END;
+
+-- Last run of each maintenance job. The processes of the app claim a due job here before running it, so each job runs
+--  once per period whatever their number, see maintenance.py.
+CREATE TABLE maintenance_job (
+  name TEXT PRIMARY KEY,
+  last_run_at REAL NOT NULL,  -- Unix time
+  last_seconds REAL,
+  last_result TEXT            -- JSON
+);
+
+-- Shard of the todos of each user, when SHARDS is enabled, see shards.py. Only used in the main database, that keeps the
+--  users, while the shards keep the todos.
+CREATE TABLE user_shard (
+  user_id INTEGER PRIMARY KEY,
+  shard INTEGER NOT NULL,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+-- Users whose todos were moved out of this database, by flask rebalance-shards. The triggers below refuse any change of
+--  their todos here, so a process that still routes them to this database fails instead of writing where they no longer
+--  live. Only the rebalance deletes their todos, while it sets draining.
+CREATE TABLE shard_fence (
+  user_id INTEGER PRIMARY KEY,
+  draining INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER shard_fence_insert BEFORE INSERT ON todo
+WHEN EXISTS (SELECT 1 FROM shard_fence WHERE user_id = new.created_by) BEGIN
+  SELECT RAISE(ABORT, 'todoer: the user moved to another shard');
+END;
+
+CREATE TRIGGER shard_fence_update BEFORE UPDATE ON todo
+WHEN EXISTS (SELECT 1 FROM shard_fence WHERE user_id = old.created_by) BEGIN
+  SELECT RAISE(ABORT, 'todoer: the user moved to another shard');
+END;
+
+CREATE TRIGGER shard_fence_delete BEFORE DELETE ON todo
+WHEN EXISTS (SELECT 1 FROM shard_fence WHERE user_id = old.created_by AND NOT draining) BEGIN
+  SELECT RAISE(ABORT, 'todoer: the user moved to another shard');
+END;
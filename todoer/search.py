@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# Secrets: random marks of the matches, that the text of the todos can't contain
+import secrets
+# Time: clock used to report how long the index rebuild took
+import time
+
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+# MarkupSafe: escapes the text of the todos, keeping only the highlight marks as html
+from markupsafe import Markup, escape
+
+from todoer.db import get_db
+from todoer.shards import database_ids, merge_shards, shard_count
+from todoer.usernames import get_usernames
+
+
+
+def build_match_query(text: str) -> str:
+    """
+    Turn the text typed by the user into an FTS5 query: each word is quoted, so FTS5 operators typed by the user are
+     taken literally, and matched as a prefix, so the results show up while typing. All words must match.
+
+    :param text: search text
+
+    :return: FTS5 query, empty if there are no words
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+def _new_marks() -> tuple:
+    # The matches are highlighted by SQLite between these marks, and then replaced by <mark> tags once the text is
+    #  escaped. Any text can be stored in a todo, so the marks are random for each search, instead of characters that
+    #  a todo could contain too. Escaping leaves them unchanged
+    token = secrets.token_hex(8)
+    return f'\x02{token}\x02', f'\x03{token}\x03'
+
+
+def _highlight(text: str, marks: tuple) -> Markup:
+    return Markup(str(escape(text)).replace(marks[0], '<mark>').replace(marks[1], '</mark>'))
+
+
+def search_todos(text: str,
+                 page: int = 1,
+                 per_page: int = 20) -> dict:
+    """
+    Search the todos by task and description, best matches first. Matches in the task weigh more than in the
+     description.
+    When sharded, each shard returns its best matches down to the page, and they are merged by score. The scores are
+     computed from the statistics of each shard, which are alike once the users are spread among them.
+
+    :param text: search text
+    :param page: page number, starting at 1
+    :param per_page: page size
+
+    :return: dict with the todos found, their highlighted task and description, and whether there is a next page
+    """
+    query = build_match_query(text)
+    if not query:
+        return {'results': [], 'has_next': False}
+
+    marks = _new_marks()
+    offset = (page - 1) * per_page
+    # Each shard may hold every result of the page, so they are all read from the first one on
+    limit, skip = (offset + per_page + 1, offset) if shard_count() else (per_page + 1, 0)
+    rows = merge_shards(
+        lambda conn: conn.execute(
+            'SELECT todo.id, todo.task, todo.description, todo.created_by, CAST(todo.created_at AS TEXT) AS created_at,'
+            ' todo.completed, CAST(todo.completed_at AS TEXT) AS completed_at,'
+            ' highlight(todo_fts, 0, ?, ?) AS task_highlight,'
+            ' snippet(todo_fts, 1, ?, ?, \'…\', 32) AS description_highlight,'
+            ' bm25(todo_fts, 10.0, 1.0) AS score'
+            ' FROM todo_fts'
+            ' JOIN todo ON todo.id = todo_fts.rowid'
+            ' WHERE todo_fts MATCH ?'
+            ' ORDER BY score, todo.id'
+            ' LIMIT ? OFFSET ?',
+            (*marks, *marks, query, limit, offset - skip)
+        ).fetchall(),
+        key=lambda row: (row['score'], row['id']), limit=limit
+    )[skip:]
+    todos = get_usernames().attach(rows[:per_page])
+
+    return {
+        'results': [
+            {
+                'todo': todo,
+                'task': _highlight(todo['task_highlight'], marks),
+                'description': _highlight(todo['description_highlight'], marks),
+            }
+            for todo in todos
+        ],
+        'has_next': len(rows) > per_page,
+    }
+
+
+def reindex_search():
+    """
+    Rebuild the full-text search index from the todo table, in a single transaction per database. Under WAL the
+     readers keep searching the previous index until it commits.
+
+    :return: seconds taken
+    """
+    started = time.perf_counter()
+    for database in database_ids():
+        db = get_db(database)
+        db.execute("INSERT INTO todo_fts (todo_fts) VALUES ('rebuild')")
+        # Merge the b-trees of the index, so the searches read fewer pages
+        db.execute("INSERT INTO todo_fts (todo_fts) VALUES ('optimize')")
+        db.commit()
+    return time.perf_counter() - started
+
+
+# click.command() defines a command line, command called reindex-search. To invoke it, run in CLI:
+#  flask reindex-search
+@click.command('reindex-search')
+@with_appcontext
+def reindex_search_command():
+    """
+    Rebuild the full-text search index of the todos.
+    """
+    seconds = reindex_search()
+    click.echo(f'Rebuilt the search index in {seconds:.2f} seconds.')
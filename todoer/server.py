@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Production server of Todoer: a master process that binds the listening socket and pre-forks worker processes, each one
+ serving requests from a pool of THREADS_PER_PAGE threads.
+    - SIGHUP: graceful reload, new workers are started, loading again the settings, the templates and the modules of
+      the app (except the ones the master loaded: todoer/__init__.py, db.py, shards.py, template_cache.py and this one,
+      which need a restart of the master), and once they are ready the old ones stop accepting connections, finish
+      their requests in flight and exit
+    - SIGTERM / SIGINT: graceful stop of the workers and the master
+Run it from the root of the project, e.g.:
+    TODOER_SECRET_KEY=... python -m todoer.server --bind 0.0.0.0:8000 --workers 4
+To serve the app with another WSGI server instead, point it at wsgi:app.
+"""
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# Concurrent.futures: the requests of each worker are served by a fixed pool of threads
+from concurrent.futures import ThreadPoolExecutor
+# Logging: startup times and the life cycle of the workers are logged
+import logging
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Select: the master waits for the new workers to report they are ready
+import select
+# Signal: reload and stop requests to the master, and stop requests to the workers
+import signal
+# Socket: the listening socket, bound once by the master and shared by all the workers
+import socket
+# Threading: a worker is stopped from a thread other than the one serving
+import threading
+# Time: clock used to measure the startup
+import time
+
+# Werkzeug: "BaseWSGIServer" is the WSGI server run by each worker
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from todoer import create_app
+from todoer.db import get_pool
+from todoer.shards import database_ids
+from todoer.template_cache import compile_templates
+
+logger = logging.getLogger('todoer.server')
+
+# Settings of the production environment, loaded over config.py unless TODOER_SETTINGS points to other ones
+PRODUCTION_SETTINGS = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config_production.py'))
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # One request per connection, so idle keep-alive connections can't hold the threads of the pool
+    protocol_version = 'HTTP/1.0'
+
+    def make_environ(self) -> dict:
+        environ = super().make_environ()
+        # The streams of live updates the threads of the server allow, see todo.live_update_streams()
+        environ['todoer.live_update_streams'] = self.server.live_update_streams
+        return environ
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that serves the requests from a fixed pool of threads, instead of a new thread per request.
+    """
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, threads: int, fd: int = None):
+        super().__init__(host, port, app, handler=_RequestHandler, fd=fd)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='todoer-request')
+        # Each stream of live updates holds a thread of the pool for its whole life, so they can take at most half of
+        #  them, see feed.changes(). Passed to the requests, the configuration of the app is left as loaded
+        self.live_update_streams = min(app.config.get('LIVE_UPDATES_MAX_STREAMS', 16), threads // 2)
+        if not self.live_update_streams and app.config.get('LIVE_UPDATES', True):
+            logger.warning(
+                'Live updates are off: %d thread(s) leave none for their streams, set THREADS_PER_PAGE to 2 or more',
+                threads
+            )
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # Stop accepting connections first, then finish the requests in flight
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        # And then the writes the requests queued. Imported here, so the master doesn't load the module and a reload
+        #  picks up its changes
+        from todoer.write_queue import close_write_queues
+        close_write_queues(self.app)
+
+
+def warm_up(app, connections: int) -> dict:
+    """
+    Do at startup the work the first requests would do otherwise: open the database connections, the ones of every
+     shard too, and load all the templates, compiling the ones missing from the bytecode cache.
+
+    :param app: application
+    :param connections: read-only connections to open, usually one per thread
+
+    :return: seconds spent on each part of the warm-up
+    """
+    timings = {}
+    with app.app_context():
+        started = time.perf_counter()
+        for database in database_ids():
+            for readonly, count in ((False, 1), (True, connections)):
+                pool = get_pool(readonly, shard=database)
+                borrowed = [pool.acquire() for _ in range(min(count, pool.max_size))]
+                for conn in borrowed:
+                    pool.release(conn)
+        timings['connections'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        compile_templates(app)
+        timings['templates'] = time.perf_counter() - started
+    return timings
+
+
+def _run_worker(listener: socket.socket, config_file: str, threads: int, ready_fd: int):
+    # Reloading and stopping are up to the master: Ctrl+C reaches the whole process group, and the master then stops
+    #  the workers. Until the worker is ready, SIGTERM simply ends it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    started = time.perf_counter()
+    app = create_app(config_file)
+    app_seconds = time.perf_counter() - started
+    threads = threads or app.config.get('THREADS_PER_PAGE', 2)
+    timings = warm_up(app, threads)
+
+    host, port = listener.getsockname()[:2]
+    server = ThreadPoolWSGIServer(host, port, app, threads, fd=listener.fileno())
+    listener.close()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't be called from the thread serving
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info(
+        'Worker %d ready in %.0f ms (app %.0f ms, connections %.0f ms, templates %.0f ms), %d threads',
+        os.getpid(), (time.perf_counter() - started) * 1000, app_seconds * 1000, timings['connections'] * 1000,
+        timings['templates'] * 1000, threads
+    )
+    os.write(ready_fd, b'1')
+    os.close(ready_fd)
+    server.serve_forever()
+    logger.info('Worker %d stopped', os.getpid())
+
+
+class Master:
+    """
+    Master process: forks the workers, replaces the ones that die, and handles the reload and stop signals.
+    """
+
+    def __init__(self, listener: socket.socket, workers: int, threads: int, config_file: str,
+                 boot_timeout: float = 60.0):
+        self.listener = listener
+        self.workers = workers
+        self.threads = threads
+        self.config_file = config_file
+        self.boot_timeout = boot_timeout
+        # {pid: generation} of the running workers. A reload starts a new generation
+        self.children = {}
+        self.generation = 0
+        self._reload = False
+        self._stop = False
+
+    def spawn(self) -> tuple:
+        """
+        :return: tuple (pid, file descriptor the worker writes to once it is ready)
+        """
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            code = 0
+            try:
+                _run_worker(self.listener, self.config_file, self.threads, ready_write)
+            except BaseException:
+                logger.exception('Worker %d failed', os.getpid())
+                code = 1
+            finally:
+                # Never run the code of the master in the worker
+                os._exit(code)
+
+        os.close(ready_write)
+        self.children[pid] = self.generation
+        return pid, ready_read
+
+    def spawn_generation(self, count: int) -> bool:
+        """
+        Start workers of the current generation, and wait until all of them are ready.
+
+        :param count: number of workers
+
+        :return: whether all of them got ready
+        """
+        pending = dict(self.spawn() for _ in range(count))
+        ready = True
+        deadline = time.monotonic() + self.boot_timeout
+        while pending:
+            timeout = deadline - time.monotonic()
+            readable = select.select(list(pending.values()), [], [], max(timeout, 0))[0] if timeout > 0 else []
+            if not readable:
+                logger.error('Workers %s not ready after %.0f seconds', sorted(pending), self.boot_timeout)
+                ready = False
+                break
+            for pid, fd in list(pending.items()):
+                if fd in readable:
+                    # One byte when the worker is ready, nothing when it exited before
+                    ready = bool(os.read(fd, 1)) and ready
+                    os.close(fd)
+                    del pending[pid]
+        for fd in pending.values():
+            os.close(fd)
+        return ready
+
+    def stop_workers(self, generation: int = None):
+        """
+        Ask the workers to stop gracefully, all of them or the ones of a generation.
+        """
+        for pid, worker_generation in list(self.children.items()):
+            if generation is None or worker_generation == generation:
+                self._kill(pid, signal.SIGTERM)
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            if self.children.pop(pid, None) is not None and os.waitstatus_to_exitcode(status) != 0:
+                logger.warning('Worker %d exited with status %d', pid, os.waitstatus_to_exitcode(status))
+
+    def reload(self):
+        old_generation = self.generation
+        self.generation += 1
+        started = time.perf_counter()
+        if self.spawn_generation(self.workers):
+            self.stop_workers(old_generation)
+            logger.info('Reloaded %d workers in %.0f ms', self.workers, (time.perf_counter() - started) * 1000)
+        else:
+            # The workers running keep serving
+            logger.error('Reload failed, keeping the workers of the previous generation')
+            self.stop_workers(self.generation)
+            self.generation = old_generation
+
+    def run(self) -> int:
+        """
+        Start the workers and supervise them until the master is asked to stop.
+
+        :return: exit code
+        """
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, '_reload', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, '_stop', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, '_stop', True))
+
+        started = time.perf_counter()
+        if not self.spawn_generation(self.workers):
+            logger.error('The workers failed to start')
+            self.shutdown()
+            return 1
+        logger.info('Started %d workers in %.0f ms, listening on %s', self.workers,
+                    (time.perf_counter() - started) * 1000, self.listener.getsockname())
+
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            self.reap()
+            # Replace the workers that died
+            missing = self.workers - sum(1 for generation in self.children.values() if generation == self.generation)
+            if missing > 0:
+                self.spawn_generation(missing)
+            time.sleep(0.5)
+
+        self.shutdown()
+        return 0
+
+    def shutdown(self):
+        self.stop_workers()
+        while self.children:
+            self.reap()
+            time.sleep(0.1)
+        logger.info('Master %d stopped', os.getpid())
+
+    def _kill(self, pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.children.pop(pid, None)
+
+
+def _parse_bind(bind: str) -> tuple:
+    host, _, port = bind.rpartition(':')
+    return host.strip('[]') or '127.0.0.1', int(port)
+
+
+@click.command()
+@click.option('--bind', default='127.0.0.1:8000', show_default=True, envvar='TODOER_BIND', help='Host and port.')
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True, envvar='TODOER_WORKERS',
+              help='Worker processes.')
+@click.option('--threads', type=int, default=None, envvar='TODOER_THREADS',
+              help='Threads per worker, defaults to the THREADS_PER_PAGE configuration key.')
+@click.option('--config', 'config_file', default='', help='Config file of the app. Defaults to config.py.')
+@click.option('--settings', default=None,
+              help='Settings loaded over the config file. Defaults to TODOER_SETTINGS, or else config_production.py.')
+def main(bind, workers, threads, config_file, settings):
+    """
+    Serve Todoer with pre-forked worker processes.
+    """
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s in %(process)d: %(message)s')
+    # Read by create_app() in each worker
+    os.environ['TODOER_SETTINGS'] = settings or os.environ.get('TODOER_SETTINGS') or PRODUCTION_SETTINGS
+
+    host, port = _parse_bind(bind)
+    listener = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                    backlog=1024)
+    listener.set_inheritable(True)
+
+    if not hasattr(os, 'fork'):
+        # Without fork, e.g. on Windows, a single process serves with its pool of threads
+        app = create_app(config_file)
+        threads = threads or app.config.get('THREADS_PER_PAGE', 2)
+        warm_up(app, threads)
+        server = ThreadPoolWSGIServer(host, port, app, threads, fd=listener.fileno())
+        listener.close()
+        logger.info('Serving on %s:%d with %d threads', host, port, threads)
+        server.serve_forever()
+        return
+
+    raise SystemExit(Master(listener, workers, threads, config_file).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# Contextlib: fenced() is a context manager
+import contextlib
+# Heapq: "merge" combines the sorted results of every shard into a single sorted list
+import heapq
+# Itertools: "islice" stops the merge once the page is full
+import itertools
+# Mmap: the rebalance generation is a counter in a file mapped in memory by every process
+import mmap
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# SQLite3: support for SQLite
+import sqlite3
+# Struct: packing of the rebalance generation counter
+import struct
+# Threading: the shard map is shared by the threads serving requests
+import threading
+# Time: expiry of the entries of the shard map, and pauses of the rebalance
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+# Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
+from werkzeug.exceptions import abort
+
+from todoer.db import create_schema, get_db, get_read_db, shard_path
+
+# The ids of the todos of each shard start at (shard + 1) * SHARD_ID_SPAN, so the shard of a todo is known from its id,
+#  and the ids below SHARD_ID_SPAN are left to the todos of the main database, from before it was sharded. With 2 ** 40
+#  ids per shard, the ids of up to 8191 shards stay below 2 ** 53, exact as JavaScript numbers.
+SHARD_ID_SPAN = 2 ** 40
+
+# Error raised by the fence triggers of schema.sql
+FENCE_MESSAGE = 'todoer: the user moved to another shard'
+
+
+def shard_count() -> int:
+    """
+    :return: number of shards of the todos, 0 when SHARDS is disabled
+    """
+    return current_app.config.get('SHARDS', 0)
+
+
+def shard_ids() -> list:
+    """
+    :return: the databases that keep the todos: the shard numbers, or [None], the main database, when SHARDS is disabled
+    """
+    return list(range(shard_count())) or [None]
+
+
+def database_ids() -> list:
+    """
+    :return: every database of the app: None, the main one, followed by the shard numbers
+    """
+    return [None, *range(shard_count())]
+
+
+def shard_of_todo(id: int):
+    """
+    :param id: todo identifier
+
+    :return: shard of the todo, known from the range of its id, or None, the main database, when SHARDS is disabled
+    """
+    count = shard_count()
+    if not count or id < SHARD_ID_SPAN:
+        return None
+    # The ids beyond the range of the last shard don't exist, and are looked up there to be not found
+    return min(id // SHARD_ID_SPAN - 1, count - 1)
+
+
+class ShardMap:
+    """
+    In-memory map from user id to the shard of their todos, read from the user_shard table of the main database.
+    The hits are served from memory. Each entry is tagged with the rebalance generation, a counter in a file that every
+     process maps in memory, which flask rebalance-shards bumps after routing each moved user, see bump(). An entry of
+     an older generation is read again, so the reads and writes of a moved user find their new shard right away,
+     without querying any database on the hits. A process that still writes to the old shard, having looked it up just
+     before the move, is refused by the fence triggers there, see fenced(). Besides, the entries expire after a while.
+    """
+
+    def __init__(self, count: int, ttl: float = 60.0, generation_path: str = None):
+        """
+        :param count: number of shards
+        :param ttl: seconds an entry is kept
+        :param generation_path: file of the rebalance generation, shared by the processes of the app, created when
+         missing. Without it, only the writes refused and the expiry notice the moves
+        """
+        self.count = count
+        self.ttl = ttl
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._generation = None
+        if generation_path is not None:
+            fd = os.open(generation_path, os.O_RDWR | os.O_CREAT)
+            try:
+                # Growing the file fills it with zeros, and a process that grows it after another one changes nothing
+                if os.fstat(fd).st_size < 8:
+                    os.ftruncate(fd, 8)
+                self._generation = mmap.mmap(fd, 8)
+            finally:
+                os.close(fd)
+
+    def generation(self) -> int:
+        """
+        :return: rebalance generation, read from the memory shared with the other processes
+        """
+        return 0 if self._generation is None else struct.unpack_from('<Q', self._generation)[0]
+
+    def bump(self):
+        """
+        Start a new rebalance generation, once a moved user was routed to their new shard, so every process reads the
+         shard of its users again.
+        """
+        with self._lock:
+            if self._generation is not None:
+                struct.pack_into('<Q', self._generation, 0, self.generation() + 1)
+            self._shards.clear()
+
+    def lookup(self, user_id: int, pin: bool = False) -> int:
+        """
+        :param user_id: user identifier
+        :param pin: record the shard of the user when it has none yet, as before writing their first todo
+
+        :return: shard of the todos of the user
+        """
+        # Read before the user_shard table, so an entry read while a move ends is of the older generation
+        generation = self.generation()
+        entry = self._shards.get(user_id)
+        if entry is not None and entry[1] > time.monotonic() and entry[2] == generation:
+            return entry[0]
+
+        row = get_read_db().execute('SELECT shard FROM user_shard WHERE user_id = ?', (user_id, )).fetchone()
+        if row is None:
+            # The users are spread by their id until the rebalance moves them
+            shard = user_id % self.count
+            if not pin:
+                # Without todos yet, the user may be pinned elsewhere by another process
+                return shard
+            db = get_db()
+            db.execute('INSERT OR IGNORE INTO user_shard (user_id, shard) VALUES (?, ?)', (user_id, shard))
+            db.commit()
+            row = db.execute('SELECT shard FROM user_shard WHERE user_id = ?', (user_id, )).fetchone()
+
+        with self._lock:
+            self._shards[user_id] = (row[0], time.monotonic() + self.ttl, generation)
+        return row[0]
+
+    def forget(self, user_id: int):
+        """
+        Drop the entry of a user, e.g. once a shard refused their write, so the next lookup reads it again.
+        """
+        with self._lock:
+            self._shards.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {'shards': self.count, 'users': len(self._shards), 'generation': self.generation()}
+
+
+def get_shard_map() -> ShardMap:
+    """
+    :return: shard map of the current app, created on first use, or None when SHARDS is disabled
+    """
+    shard_map = current_app.extensions.get('shard_map')
+    if shard_map is None and shard_count():
+        os.makedirs(current_app.config['SHARD_DIR'], exist_ok=True)
+        shard_map = current_app.extensions.setdefault('shard_map', ShardMap(
+            shard_count(), current_app.config.get('SHARD_MAP_TTL', 60.0),
+            os.path.join(current_app.config['SHARD_DIR'], 'generation')
+        ))
+    return shard_map
+
+
+def user_shard(user_id: int, pin: bool = False):
+    """
+    :param user_id: user identifier
+    :param pin: record the shard of the user when it has none yet, see ShardMap.lookup()
+
+    :return: shard of the todos of the user, or None, the main database, when SHARDS is disabled
+    """
+    shard_map = get_shard_map()
+    return None if shard_map is None else shard_map.lookup(user_id, pin)
+
+
+@contextlib.contextmanager
+def fenced(user_id: int):
+    """
+    Run the writes of a user, answering 503 when a shard refuses them because the user was moved out of it, so the
+     client tries again once the process routes the user to their new shard.
+
+    :param user_id: user identifier
+    """
+    try:
+        yield
+    except sqlite3.IntegrityError as e:
+        if FENCE_MESSAGE not in str(e):
+            raise
+        get_shard_map().forget(user_id)
+        # 503 HTTP code means “Service Unavailable”
+        abort(503, 'Your todos are being moved to another database, try again in a moment.')
+
+
+def merge_shards(query, key, reverse: bool = False, limit: int = None) -> list:
+    """
+    Run a query on every shard and merge their results, each one already sorted by the same key, into one sorted list:
+     a k-way merge, that only compares the heads of the results.
+
+    :param query: function called with the read connection of each shard, that returns its sorted results
+    :param key: function that returns the sort key of a result
+    :param reverse: whether the results are sorted in descending order
+    :param limit: maximum number of results
+
+    :return: list of results
+    """
+    results = [query(get_read_db(shard)) for shard in shard_ids()]
+    if len(results) == 1:
+        return results[0][:limit]
+    return list(itertools.islice(heapq.merge(*results, key=key, reverse=reverse), limit))
+
+
+def init_shard(shard: int):
+    """
+    Create the empty tables of a shard, with the ids of its todos starting at its range.
+
+    :param shard: shard number
+    """
+    db = get_db(shard)
+    create_schema(db)
+    # schema.sql turns on the foreign keys of the connection, but the users live in the main database, and the user
+    #  table of the shard stays empty, so the references to it can't be enforced
+    db.execute('PRAGMA foreign_keys = OFF')
+    db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('todo', ?)", ((shard + 1) * SHARD_ID_SPAN, ))
+    db.commit()
+
+
+def ensure_shards(echo=None):
+    """
+    Create the shards missing, e.g. after raising SHARDS.
+
+    :param echo: function called with the progress messages
+    """
+    for shard in range(shard_count()):
+        if not os.path.exists(shard_path(shard)):
+            init_shard(shard)
+            if echo is not None:
+                echo(f'Created shard {shard} at {shard_path(shard)}.')
+
+
+def _user_todos(db) -> dict:
+    # Todos of each user in a database, archived ones included, from the counters of user_stats
+    return dict(db.execute(
+        'SELECT user_id, open_todos + completed_todos FROM user_stats WHERE open_todos + completed_todos > 0'
+    ).fetchall())
+
+
+def plan_rebalance(todos: dict, routes: dict, tolerance: float = 0.1, max_moves: int = 100) -> list:
+    """
+    Plan the moves of users between databases:
+        - first, the todos that are not in the shard of their user: the ones of the main database, from before it was
+          sharded, and the ones left by an interrupted move. A user without shard gets the one with fewer todos
+        - then, while the gap between the shards with most and fewest todos is above the tolerance, the user of the
+          fullest shard whose todos best halve the gap moves to the emptiest one
+
+    :param todos: todos of each user, by database: None for the main one, or the shard number
+    :param routes: shard of each user, from user_shard
+    :param tolerance: gap between the shards, as a ratio of the mean todos per shard, below which they are balanced
+    :param max_moves: maximum number of moves of the balancing
+
+    :return: list of tuples (user_id, source, target, todos)
+    """
+    shards = [database for database in todos if database is not None]
+    totals = {shard: sum(todos[shard].values()) for shard in shards}
+    users = {shard: dict(todos[shard]) for shard in shards}
+    routes = dict(routes)
+    moves = []
+
+    for source, source_users in todos.items():
+        for user_id, count in sorted(source_users.items(), key=lambda item: -item[1]):
+            target = routes.setdefault(user_id, min(totals, key=totals.get))
+            if source == target:
+                continue
+            moves.append((user_id, source, target, count))
+            if source is not None:
+                totals[source] -= count
+                del users[source][user_id]
+            totals[target] += count
+            users[target][user_id] = users[target].get(user_id, 0) + count
+
+    balancing = 0
+    while len(totals) > 1 and balancing < max_moves:
+        high, low = max(totals, key=totals.get), min(totals, key=totals.get)
+        gap = totals[high] - totals[low]
+        if gap <= tolerance * sum(totals.values()) / len(totals):
+            break
+        # Moving a user with n todos leaves a gap of |gap - 2n| between both shards
+        candidates = [(abs(gap - 2 * count), user_id, count) for user_id, count in users[high].items() if count < gap]
+        if not candidates:
+            break
+        _, user_id, count = min(candidates)
+        moves.append((user_id, high, low, count))
+        totals[high] -= count
+        totals[low] += count
+        users[low][user_id] = users[high].pop(user_id)
+        balancing += 1
+    return moves
+
+
+def move_user(user_id: int, source, target: int, batch_size: int = 500, pause: float = 0.01) -> int:
+    """
+    Move the todos of a user, archived ones included, from a database to a shard, batch by batch, and route the user to
+     that shard. Each batch is copied and deleted in one transaction over both files, through a connection of its own
+     with the shard attached.
+    First, the user is fenced out of the source, so any process that still routes them there is refused, see fenced().
+     The moved todos get new ids from the range of the target, the archived ones keep theirs.
+
+    :param user_id: user identifier
+    :param source: database of the todos: None for the main one, or the shard number
+    :param target: shard number
+    :param batch_size: todos per transaction
+    :param pause: seconds slept between batches, letting the requests take the write locks
+
+    :return: number of todos moved
+    """
+    conn = sqlite3.connect(current_app.config['DATABASE'] if source is None else shard_path(source),
+                           isolation_level=None)
+    busy_timeout = int(current_app.config.get('DATABASE_PRAGMAS', {}).get('busy_timeout', 5000))
+    conn.execute(f'PRAGMA busy_timeout = {busy_timeout}')
+    conn.execute('ATTACH DATABASE ? AS target', (shard_path(target), ))
+    moved = 0
+    try:
+        # In case the user was moved out of the target before
+        conn.execute('DELETE FROM target.shard_fence WHERE user_id = ?', (user_id, ))
+        conn.execute('INSERT OR IGNORE INTO main.shard_fence (user_id) VALUES (?)', (user_id, ))
+        columns = 'created_by, created_at, task, description, completed, completed_at'
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row[0] for row in conn.execute(
+                    'SELECT id FROM main.todo WHERE created_by = ? LIMIT ?', (user_id, batch_size)
+                )]
+                archived = [row[0] for row in conn.execute(
+                    'SELECT id FROM main.todo_archive WHERE created_by = ? LIMIT ?', (user_id, batch_size)
+                )]
+                if ids:
+                    placeholders = ', '.join('?' * len(ids))
+                    conn.execute('UPDATE main.shard_fence SET draining = 1 WHERE user_id = ?', (user_id, ))
+                    conn.execute(
+                        f'INSERT INTO target.todo ({columns})'
+                        f' SELECT {columns} FROM main.todo WHERE id IN ({placeholders}) ORDER BY id',
+                        ids
+                    )
+                    conn.execute(f'DELETE FROM main.todo WHERE id IN ({placeholders})', ids)
+                    conn.execute('UPDATE main.shard_fence SET draining = 0 WHERE user_id = ?', (user_id, ))
+                if archived:
+                    placeholders = ', '.join('?' * len(archived))
+                    conn.execute(
+                        f'INSERT INTO target.todo_archive (id, {columns}, archived_at)'
+                        f' SELECT id, {columns}, archived_at FROM main.todo_archive WHERE id IN ({placeholders})',
+                        archived
+                    )
+                    conn.execute(f'DELETE FROM main.todo_archive WHERE id IN ({placeholders})', archived)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            if not ids and not archived:
+                break
+            moved += len(ids) + len(archived)
+            time.sleep(pause)
+    finally:
+        conn.close()
+
+    route_user(user_id, target)
+    return moved
+
+
+def route_user(user_id: int, shard: int):
+    """
+    Record the shard of a user in user_shard, and bump the rebalance generation, so every process routes the user
+     there on their next request, see ShardMap.
+
+    :param user_id: user identifier
+    :param shard: shard number
+    """
+    db = get_db()
+    db.execute(
+        'INSERT INTO user_shard (user_id, shard) VALUES (?, ?)'
+        ' ON CONFLICT (user_id) DO UPDATE SET shard = excluded.shard',
+        (user_id, shard)
+    )
+    db.commit()
+    get_shard_map().bump()
+
+
+# click.command() defines a command line, command called rebalance-shards. To invoke it, run in CLI:
+#  flask rebalance-shards
+@click.command('rebalance-shards')
+@click.option('--user', 'user_id', type=int, help='Move only this user, to the shard given by --to.')
+@click.option('--to', 'target', type=int, help='Shard where --user is moved.')
+@click.option('--tolerance', default=0.1, show_default=True,
+              help='Gap between the shards, as a ratio of the mean todos per shard, below which they are balanced.')
+@click.option('--max-moves', default=100, show_default=True,
+              help='Maximum number of users moved to balance the shards.')
+@click.option('--batch-size', default=500, show_default=True, help='Todos moved per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only list the moves.')
+@with_appcontext
+def rebalance_shards_command(user_id, target, tolerance, max_moves, batch_size, dry_run):
+    """
+    Create the shards missing, move the todos of the main database into the shards, and move users from the shards
+     with more todos to the ones with fewer, while the app keeps serving requests.
+    """
+    count = shard_count()
+    if not count:
+        raise click.ClickException('Sharding is disabled, set SHARDS to the number of shards.')
+    if (user_id is None) != (target is None):
+        raise click.UsageError('--user and --to go together.')
+    if target is not None and not 0 <= target < count:
+        raise click.UsageError(f'--to must be a shard from 0 to {count - 1}.')
+    if user_id is not None and get_read_db().execute('SELECT 1 FROM user WHERE id = ?', (user_id, )).fetchone() is None:
+        raise click.ClickException(f'User {user_id} does not exist.')
+
+    ensure_shards(click.echo)
+    todos = {database: _user_todos(get_read_db(database)) for database in database_ids()}
+    if user_id is not None:
+        moves = [(user_id, database, target, users[user_id])
+                 for database, users in todos.items() if user_id in users and database != target]
+    else:
+        routes = dict(get_read_db().execute('SELECT user_id, shard FROM user_shard').fetchall())
+        moves = plan_rebalance(todos, routes, tolerance, max_moves)
+
+    started = time.perf_counter()
+    for moved_user, source, target_shard, user_todos in moves:
+        source_name = 'the main database' if source is None else f'shard {source}'
+        if dry_run:
+            click.echo(f'Would move user {moved_user} from {source_name} to shard {target_shard}: {user_todos} todos.')
+            continue
+        moved = move_user(moved_user, source, target_shard, batch_size)
+        click.echo(f'Moved user {moved_user} from {source_name} to shard {target_shard}: {moved} todos.')
+
+    if not dry_run:
+        if user_id is not None and not moves:
+            # Without todos to move, the user is only routed to the shard
+            route_user(user_id, target)
+        click.echo(f'Made {len(moves)} moves in {time.perf_counter() - started:.2f} seconds.')
+        for shard in range(count):
+            click.echo(f'  shard {shard}: {sum(_user_todos(get_read_db(shard)).values())} todos')
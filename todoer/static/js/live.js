@@ -0,0 +1,73 @@
+/*
+    Live updates of the todo list. Follows the change feed of the todos through Server-Sent Events, see feed.py, and
+     patches the cards of the list instead of reloading the whole page:
+        - upsert: replaces the card of the todo, or adds it at the top of the first page when it's new
+        - delete: removes the card of the todo
+        - reset: reloads the page, as the list is too far behind to be patched
+    The browser reconnects by itself when a stream ends, sending the id of the last event it got. When the server
+     refuses the stream, e.g. because it has too many open, it tries again later.
+*/
+(function () {
+    'use strict';
+
+    var list = document.getElementById('todos');
+    if (!list || !list.dataset.changesUrl || !window.EventSource) {
+        return;
+    }
+    var liveInserts = list.dataset.liveInserts === 'true';
+    var url = list.dataset.changesUrl;
+    // Milliseconds to wait before trying again, once the server refused the stream
+    var retryDelay = 30000;
+
+    function buildItem(change) {
+        var item = document.createElement('div');
+        item.className = 'todo-item';
+        item.id = 'todo-' + change.id;
+        item.innerHTML = change.html + '<hr>';
+        return item;
+    }
+
+    function onUpsert(event) {
+        var change = JSON.parse(event.data);
+        var item = document.getElementById('todo-' + change.id);
+        if (item) {
+            item.replaceWith(buildItem(change));
+        } else if (liveInserts && change.op === 'insert') {
+            list.insertBefore(buildItem(change), list.firstChild);
+        }
+    }
+
+    function onDelete(event) {
+        var item = document.getElementById('todo-' + JSON.parse(event.data).id);
+        if (item) {
+            item.remove();
+        }
+    }
+
+    function connect(streamUrl) {
+        var source = new EventSource(streamUrl);
+        var lastId = null;
+        function track(handler) {
+            return function (event) {
+                lastId = event.lastEventId;
+                handler(event);
+            };
+        }
+        source.addEventListener('upsert', track(onUpsert));
+        source.addEventListener('delete', track(onDelete));
+        source.addEventListener('reset', function () {
+            source.close();
+            window.location.reload();
+        });
+        source.onerror = function () {
+            // A closed source was refused by the server and won't reconnect by itself
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(function () {
+                    connect(lastId === null ? streamUrl : streamUrl.replace(/([?&]since=)\d+/, '$1' + lastId));
+                }, retryDelay);
+            }
+        };
+    }
+
+    connect(url);
+})();
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# datetime: this module supplies classes for manipulating dates and times.
+import datetime as dt
+# Time: clock used to report how long the rebuild took
+import time
+
+# Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
+#        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
+from flask import Blueprint, render_template
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+
+from todoer.db import get_db, get_read_db
+from todoer.shards import database_ids
+from todoer.usernames import get_usernames
+
+# Create a Blueprint named 'stats', without url_prefix
+bp = Blueprint('stats', __name__)
+
+# Counters of user_stats, kept up to date by the triggers of schema.sql
+STATS_COLUMNS = ('open_todos', 'completed_todos', 'timed_todos', 'completion_seconds')
+
+# The same counters computed from the todos of {source}, per user, for the todos matching {where}. It is what user_stats
+#  saves computing on every view: a scan of the todos
+COUNT_TODOS = (
+    'SELECT created_by, SUM(completed = 0), SUM(completed <> 0), SUM(completed <> 0 AND completed_at IS NOT NULL),'
+    ' TOTAL(CASE WHEN completed <> 0 THEN IFNULL((julianday(completed_at) - julianday(created_at)) * 86400, 0) END)'
+    ' FROM {source}'
+    '{where}'
+    ' GROUP BY created_by'
+)
+
+# All the todos counted by user_stats: the ones of the todo table and the archived ones
+ALL_TODOS = (
+    '(SELECT created_by, created_at, completed, completed_at FROM todo'
+    ' UNION ALL SELECT created_by, created_at, completed, completed_at FROM todo_archive)'
+)
+
+
+def _summarize(counters: dict) -> dict:
+    # Statistics shown from the counters of one user, or of all of them
+    total = counters['open_todos'] + counters['completed_todos']
+    return {
+        'open_todos': counters['open_todos'],
+        'completed_todos': counters['completed_todos'],
+        'total_todos': total,
+        'completion_rate': counters['completed_todos'] / total if total else None,
+        'average_completion_seconds': (
+            counters['completion_seconds'] / counters['timed_todos'] if counters['timed_todos'] else None
+        ),
+    }
+
+
+def get_user_stats(conn=None) -> dict:
+    """
+    Read the statistics of the todos of each user from the counters of user_stats, in O(users), without touching the
+     todo table. When sharded, the counters of every database are added up, as the todos of a user being moved to
+     another shard are split between both.
+
+    :param conn: database connection, defaults to the read connections of every database
+
+    :return: dict with the statistics of each user with todos, by username, and the totals: open, completed and total
+             todos, completion rate, and average seconds from creation to completion
+    """
+    per_user = {}
+    for db in [conn] if conn else [get_read_db(database) for database in database_ids()]:
+        for row in db.execute(f'SELECT user_id, {", ".join(STATS_COLUMNS)} FROM user_stats'):
+            counters = per_user.setdefault(row[0], dict.fromkeys(STATS_COLUMNS, 0))
+            for name, value in zip(STATS_COLUMNS, row[1:]):
+                counters[name] += value
+    # The users live in the main database
+    names = get_usernames().lookup(per_user, conn)
+
+    users = []
+    totals = dict.fromkeys(STATS_COLUMNS, 0)
+    for user_id, counters in per_user.items():
+        if not counters['open_todos'] and not counters['completed_todos']:
+            # All the todos of the user were deleted
+            continue
+        for name, value in counters.items():
+            totals[name] += value
+        users.append({'user_id': user_id, 'username': names.get(user_id), **_summarize(counters)})
+    users.sort(key=lambda user: user['username'] or '')
+
+    return {'users': users, 'totals': _summarize(totals)}
+
+
+def rebuild_stats() -> tuple:
+    """
+    Recompute the counters of user_stats from the todos, archived ones included, in a single transaction per database,
+     e.g. to drop the rounding errors that the running sum of completion times accumulates.
+
+    :return: tuple (users counted, seconds taken)
+    """
+    started = time.perf_counter()
+    users = 0
+    for database in database_ids():
+        db = get_db(database)
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM user_stats')
+            users += db.execute(
+                f'INSERT INTO user_stats (user_id, {", ".join(STATS_COLUMNS)})'
+                f' {COUNT_TODOS.format(source=ALL_TODOS, where="")}'
+            ).rowcount
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return users, time.perf_counter() - started
+
+
+def format_duration(seconds) -> str:
+    """
+    Template filter that formats a number of seconds, e.g. {{ 93784 | duration }} gives '1 day, 2:03:04'
+
+    :param seconds: seconds, or None
+
+    :return: formatted duration, '-' when there is none
+    """
+    return '-' if seconds is None else str(dt.timedelta(seconds=round(seconds)))
+
+
+# Make format_duration() available in all templates, as the filter "duration"
+bp.add_app_template_filter(format_duration, 'duration')
+
+
+# @bp.route associates the URL '/stats' with the 'index' view function
+@bp.route('/stats')
+def index() -> str:
+    """
+    Show the statistics of the todos of each user. The same statistics are available as JSON at /api/stats.
+
+    :return: rendered html of the statistics
+    """
+    return render_template('stats/index.html', **get_user_stats())
+
+
+# click.command() defines a command line, command called rebuild-stats. To invoke it, run in CLI: flask rebuild-stats
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """
+    Recompute the statistics of the todos of each user from scratch.
+    """
+    users, seconds = rebuild_stats()
+    click.echo(f'Rebuilt the statistics of {users} users in {seconds:.2f} seconds.')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Visit https://jinja.palletsprojects.com/en/3.1.x/api/#bytecode-cache
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Time: clock used to time the compilation
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+# Jinja2: "FileSystemBytecodeCache" stores the compiled templates as files, shared by all the processes of the app
+from jinja2 import FileSystemBytecodeCache
+
+
+def compile_templates(app) -> list:
+    """
+    Load and compile all the templates of the app. With the bytecode cache enabled, the compiled code of the templates
+     that are not in the cache yet, or whose source changed, is written to it.
+
+    :param app: application
+
+    :return: names of the templates
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+# click.command() defines a command line, command called compile-templates. To invoke it, run in CLI:
+#  flask compile-templates
+@click.command('compile-templates')
+@click.option('--clear', is_flag=True, help='Empty the bytecode cache first.')
+@with_appcontext
+def compile_templates_command(clear):
+    """
+    Compile all the templates into the bytecode cache, so the workers started after a deploy don't compile them.
+    """
+    cache = current_app.jinja_env.bytecode_cache
+    if cache is None:
+        raise click.ClickException('The bytecode cache is disabled, set the TEMPLATE_CACHE_DIR configuration key.')
+    if clear:
+        cache.clear()
+
+    started = time.perf_counter()
+    names = compile_templates(current_app)
+    click.echo(
+        f'Compiled {len(names)} templates into {current_app.config["TEMPLATE_CACHE_DIR"]}'
+        f' in {(time.perf_counter() - started) * 1000:.0f} ms.'
+    )
+
+
+def init_app(app):
+    """
+    Set up the bytecode cache of the templates, in the TEMPLATE_CACHE_DIR directory, when the key is set.
+    Must be called before the Jinja environment of the app is used, as it is created with these options.
+
+    :param app: application
+    """
+    directory = app.config.get('TEMPLATE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(directory)}
+
+    app.cli.add_command(compile_templates_command)
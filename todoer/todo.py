@@ -2,6 +2,15 @@
 
 # datetime: this module supplies classes for manipulating dates and times.
 import datetime as dt
+# Itertools: combinations of filters whose query plans are checked
+import itertools
+# Collections: "namedtuple" is the base of the compact records of the todo lists
+from collections import namedtuple
+# Operator: "attrgetter" gives the sort key of the todos merged from the shards
+from operator import attrgetter
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
 # Flask: is a lightweight WSGI (Web Server Gateway Interface) web application framework
 #        - A "Blueprint" is a way to organize a group of related views and other code. They're configurable
 #        - "flash" allows nice and simple way to send and display small messages to the users
@@ -9,38 +18,428 @@ import datetime as dt
 #          multiple functions during the request
 #        - "session" allows referring to the user in the current context, which interacts with the Flask application
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, make_response, redirect, render_template, request, session, url_for
 )
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
 # Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
 from werkzeug.exceptions import abort
 
 from todoer.auth import login_required
-from todoer.db import get_db
+from todoer.cache import MISSING
+from todoer.db import get_read_db
+from todoer.render_cache import data_version, get_page_cache, make_etag, render_card
+from todoer.search import search_todos
+from todoer.shards import fenced, merge_shards, shard_count, shard_of_todo, user_shard
+from todoer.usernames import get_usernames
+from todoer.write_queue import execute_write
 
 # Create a Blueprint named 'todo'. Like the app object, the blueprint needs to know where it’s defined, so __name__ is
 #  passed as the 2º argument. Unlike the 'auth' blueprint, the 'todo' blueprint does not have a url_prefix.
 bp = Blueprint('todo', __name__)
+# Make render_card() available in all templates, the index uses it to render each todo card
+bp.add_app_template_global(render_card)
+
+
+# Columns shared by every query that lists or fetches todos. The username of the creator is not among them: it is added
+#  from the in-memory map of usernames, see usernames.UsernameMap, so the queries don't JOIN the user table.
+# The timestamps are selected as the text SQLite stores, CAST being an expression without declared type, so
+#  PARSE_DECLTYPES doesn't parse each of them into a datetime: they are only formatted when a card is rendered, see
+#  format_timestamp().
+TODO_COLUMNS = (
+    'todo.id, todo.task, todo.description, todo.created_by, CAST(todo.created_at AS TEXT) AS created_at,'
+    ' todo.completed, CAST(todo.completed_at AS TEXT) AS completed_at'
+)
+
+
+class TodoRecord(namedtuple('TodoRecord', (
+        'id', 'task', 'description', 'created_by', 'created_at', 'completed', 'completed_at', 'username'
+))):
+    """
+    Todo of a list, as a plain tuple with the values of TODO_COLUMNS plus the username of the creator. Much smaller and
+     faster to build than a dict per row, and hashable, so the todo itself keys the cache of its rendered card.
+    As sqlite3.Row, its values can be read by name, todo['task'], and dict(todo) gives its columns.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key) if isinstance(key, str) else tuple.__getitem__(self, key)
+
+    def keys(self) -> tuple:
+        return self._fields
+
+
+def fetch_todos(conn, sql: str, parameters=()) -> list:
+    """
+    Run a query selecting TODO_COLUMNS, and materialize its rows as records.
+
+    :param conn: database connection
+    :param sql: SQL statement
+    :param parameters: parameters of the statement
+
+    :return: list of TodoRecord
+    """
+    rows = conn.execute(sql, parameters).fetchall()
+    # created_by is the 4th column of TODO_COLUMNS. The users live in the main database, not in the shards
+    names = get_usernames().lookup({row[3] for row in rows}, None if shard_count() else conn)
+    # tuple.__new__ skips the argument parsing of the namedtuple constructor
+    new = tuple.__new__
+    return [new(TodoRecord, (*row, names.get(row[3]))) for row in rows]
+
+
+def last_change(conn) -> int:
+    """
+    :param conn: database connection
+
+    :return: sequence number of the last change of the todos in the change feed, see feed.py, 0 if there is none
+    """
+    # As the sequence is AUTOINCREMENT, its last number is kept even when the changes are pruned
+    return conn.execute(
+        "SELECT IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'todo_change'), 0)"
+    ).fetchone()[0]
+
+
+def live_update_streams() -> int:
+    """
+    :return: streams of live updates this process serves at a time, see feed.changes(): LIVE_UPDATES_MAX_STREAMS, or
+     less when the production server has not threads enough for them, and 0 when the live updates are off
+    """
+    config = current_app.config
+    if not config.get('LIVE_UPDATES', True) or shard_count():
+        return 0
+    limit = config.get('LIVE_UPDATES_MAX_STREAMS', 16)
+    # The production server passes the limit its threads allow in the WSGI environment, see server.py
+    return min(limit, request.environ.get('todoer.live_update_streams', limit))
+
+
+def format_timestamp(value, fmt: str) -> str:
+    """
+    Template filter that formats a timestamp, e.g. {{ todo['created_at'] | timestamp('%b-%d-%Y %H:%M') }}
+
+    :param value: timestamp, as the text stored by SQLite or as datetime
+    :param fmt: strftime() format
+
+    :return: formatted timestamp
+    """
+    if isinstance(value, str):
+        value = dt.datetime.fromisoformat(value)
+    return value.strftime(fmt)
+
+
+# Make format_timestamp() available in all templates, as the filter "timestamp"
+bp.add_app_template_filter(format_timestamp, 'timestamp')
+
+
+def encode_cursor(todo) -> str:
+    """
+    Build the opaque pagination cursor of a todo, made with the keyset (created_at, id) used to sort the list.
+
+    :param todo: todo row
+
+    :return: cursor, e.g. '2022-05-01 10:20:30_15'
+    """
+    return f'{todo["created_at"]}_{todo["id"]}'
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Split a pagination cursor into its keyset values. A malformed cursor aborts the request.
+
+    :param cursor: cursor built by encode_cursor
+
+    :return: tuple (created_at, id)
+    """
+    created_at, _, id_ = cursor.rpartition('_')
+    try:
+        # Validate the timestamp, but keep it as text, because SQLite compares it against the stored text
+        dt.datetime.fromisoformat(created_at)
+        id_ = int(id_)
+        # SQLite integers are 64-bit, a larger one can't even be bound to the query
+        if not -2 ** 63 <= id_ < 2 ** 63:
+            raise ValueError(id_)
+        return created_at, id_
+    except ValueError:
+        # 400 HTTP code means “Bad Request”
+        abort(400, f'Invalid page cursor {cursor}.')
+
+
+# Query string arguments that filter the todo list, in the index and in the API
+FILTER_ARGS = ('created_by', 'completed', 'created_from', 'created_to', 'completed_from', 'completed_to')
+
+
+def parse_todo_filters(args) -> dict:
+    """
+    Parse the filters of the todo list from the query string arguments. Invalid values abort the request.
+        - created_by: only the todos of this user identifier, or 'me' for the logged in user
+        - completed: only the completed (true / 1) or open (false / 0) todos
+        - created_from / created_to: only the todos created within these dates (YYYY-MM-DD), both included
+        - completed_from / completed_to: only the todos completed within these dates (YYYY-MM-DD), both included
+
+    :param args: query string arguments, i.e. request.args
+
+    :return: dict with the filters given, ready to be passed to get_todo_page
+    """
+    filters = {}
+    for name in FILTER_ARGS:
+        value = args.get(name, '').strip()
+        if not value:
+            continue
+
+        if name == 'created_by':
+            if value == 'me':
+                if g.user is None:
+                    # 401 HTTP code means “Unauthorized”
+                    abort(401, 'Log in to filter your own todos.')
+                filters[name] = g.user['id']
+            elif value.isdigit():
+                filters[name] = int(value)
+            else:
+                # 400 HTTP code means “Bad Request”
+                abort(400, 'Argument created_by must be a user identifier or "me".')
+
+        elif name == 'completed':
+            if value.lower() in ('1', 'true'):
+                filters[name] = True
+            elif value.lower() in ('0', 'false'):
+                filters[name] = False
+            else:
+                abort(400, 'Argument completed must be true or false.')
+
+        else:
+            try:
+                filters[name] = dt.date.fromisoformat(value)
+            except ValueError:
+                abort(400, f'Argument {name} must be a date as YYYY-MM-DD.')
+
+    return filters
+
+
+def build_todo_page_query(before: str = None,
+                          after: str = None,
+                          per_page: int = 20,
+                          created_by: int = None,
+                          completed: bool = None,
+                          created_from: dt.date = None,
+                          created_to: dt.date = None,
+                          completed_from: dt.date = None,
+                          completed_to: dt.date = None) -> tuple:
+    """
+    Build the query of one page of the todo list. The filters are applied in SQL, each one backed by an index of
+     schema.sql whose columns end with (created_at, id), so the page is still read in order straight from the index.
+    The completion dates are the exception: without the user, the range of completion dates is searched in
+     todo_completed_at_idx, and the todos found are sorted, instead of walking the whole list checking each todo.
+
+    :return: tuple (sql, params)
+    """
+    conditions, params = [], []
+    if created_by is not None:
+        conditions.append('todo.created_by = ?')
+        params.append(created_by)
+    if completed is not None:
+        conditions.append('todo.completed = ?')
+        params.append(int(completed))
+    # The timestamps are stored as text, so they are compared to the text of the dates, the end date being excluded
+    #  from the next day on
+    for column, date_from, date_to in (('created_at', created_from, created_to),
+                                       ('completed_at', completed_from, completed_to)):
+        if date_from is not None:
+            conditions.append(f'todo.{column} >= ?')
+            params.append(date_from.isoformat())
+        if date_to is not None:
+            conditions.append(f'todo.{column} < ?')
+            params.append((date_to + dt.timedelta(days=1)).isoformat())
+
+    if after:
+        # Going back: walk the index in ascending order from the cursor, and then reverse the fetched rows
+        conditions.append('(todo.created_at, todo.id) > (?, ?)')
+        params.extend(decode_cursor(after))
+        order = 'ASC'
+    else:
+        if before:
+            conditions.append('(todo.created_at, todo.id) < (?, ?)')
+            params.extend(decode_cursor(before))
+        order = 'DESC'
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    # Left alone, SQLite prefers walking todo_created_at_id_idx in order, which reads the whole list when few todos
+    #  were completed within the dates
+    indexed_by = (
+        ' INDEXED BY todo_completed_at_idx'
+        if created_by is None and (completed_from is not None or completed_to is not None) else ''
+    )
+
+    # One more row than the page size is requested, to know whether there is a page beyond this one
+    sql = (
+        f'SELECT {TODO_COLUMNS}'
+        f' FROM todo{indexed_by}'
+        f'{where}'
+        f' ORDER BY todo.created_at {order}, todo.id {order}'
+        ' LIMIT ?'
+    )
+    return sql, params + [per_page + 1]
+
+
+def get_todo_page(before: str = None,
+                  after: str = None,
+                  per_page: int = None,
+                  **filters) -> dict:
+    """
+    Fetch one page of the todo list, most recent first, using keyset pagination on (created_at, id).
+    Instead of OFFSET, that reads and discards every previous row, the page starts right after the cursor, so the
+     index todo_created_at_id_idx is searched and a deep page costs the same as the first one.
+    When sharded, the todos of one user are read from their shard, and otherwise the page is read from every shard and
+     their pages are merged, see shards.merge_shards().
+
+    :param before: cursor of the last todo of the previous page, to go to older todos
+    :param after: cursor of the first todo of the next page, to go back to newer todos
+    :param per_page: page size, defaults to the TODOS_PER_PAGE configuration key
+    :param filters: filters of the list, as returned by parse_todo_filters
+
+    :return: dict with the todos of the page and the cursors to the older (next) and newer (previous) pages
+    """
+    per_page = per_page or current_app.config['TODOS_PER_PAGE']
+
+    sql, params = build_todo_page_query(before, after, per_page, **filters)
+    if filters.get('created_by') is not None:
+        todos = fetch_todos(get_read_db(user_shard(filters['created_by'])), sql, params)
+    else:
+        # Going back, the pages of the shards are in ascending order
+        todos = merge_shards(lambda conn: fetch_todos(conn, sql, params),
+                             key=attrgetter('created_at', 'id'), reverse=not after, limit=per_page + 1)
+
+    has_more = len(todos) > per_page
+    todos = todos[:per_page]
+    if after:
+        todos.reverse()
+
+    # There are older todos when more rows were found going forward, or when coming back from them
+    has_older = has_more if not after else True
+    # There are newer todos when more rows were found going back, or when coming from them
+    has_newer = has_more if after else before is not None
+
+    return {
+        'todos': todos,
+        'next_cursor': encode_cursor(todos[-1]) if todos and has_older else None,
+        'prev_cursor': encode_cursor(todos[0]) if todos and has_newer else None,
+    }
+
+
+def explain_todo_page_queries() -> list:
+    """
+    Get the query plan of the todo list query, for every combination of filters and for the first, next and previous
+     pages, to check that every one of them searches the todo table through an index.
+    A "SCAN todo" walks the whole table or index, so it only passes for the first page without filters: the ordered
+     walk of todo_created_at_id_idx, stopped by the LIMIT once the page is full.
+
+    :return: list of tuples (filters, pagination, plan details, whether the todo table is searched through an index)
+    """
+    sample = {
+        'created_by': 1, 'completed': True,
+        'created_from': dt.date.today(), 'created_to': dt.date.today(),
+        'completed_from': dt.date.today(), 'completed_to': dt.date.today(),
+    }
+    cursor = f'{dt.datetime.now():%Y-%m-%d %H:%M:%S}_1'
+    plans = []
+    db = get_read_db()
+    for count in range(len(FILTER_ARGS) + 1):
+        for names in itertools.combinations(FILTER_ARGS, count):
+            for pagination in ({}, {'before': cursor}, {'after': cursor}):
+                sql, params = build_todo_page_query(**pagination, **{name: sample[name] for name in names})
+                details = [row['detail'] for row in db.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+                scans = [detail for detail in details if detail.startswith('SCAN todo')]
+                indexed = not scans or (
+                    not names and scans == ['SCAN todo USING INDEX todo_created_at_id_idx']
+                )
+                plans.append((names, next(iter(pagination), 'first'), details, indexed))
+    return plans
+
+
+# click.command() defines a command line, command called check-query-plans. To invoke it, run in CLI:
+#  flask check-query-plans
+@click.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Show the plan of every query.')
+@with_appcontext
+def check_query_plans_command(verbose):
+    """
+    Check with EXPLAIN QUERY PLAN that every filter of the todo list searches an index, instead of scanning.
+    """
+    failures = 0
+    for names, pagination, details, indexed in explain_todo_page_queries():
+        if verbose or not indexed:
+            click.echo(f'{"OK  " if indexed else "SCAN"} {", ".join(names) or "no filters"} ({pagination} page):')
+            for detail in details:
+                click.echo(f'       {detail}')
+        failures += not indexed
+
+    if failures:
+        raise click.ClickException(f'{failures} todo list queries scan the todo table instead of searching an index.')
+    click.echo('Every todo list query searches the todo table through an index.')
 
 
 # @bp.route associates the URL '/', '/index' or '/todo/index' with the 'index' view function
 @bp.route('/')
 def index() -> str:
     """
-    The index will show todo list, most recent first.
-    A JOIN is used so that the author information from the user table is available in the result.
+    The index will show todo list, most recent first, one page at a time, and then follows the change feed to patch its
+     cards live, see feed.changes().
+    The username of the author of each todo comes from the in-memory map of usernames, instead of a JOIN.
+    The query string arguments 'before' and 'after' carry the cursor of the page to show, and the ones in FILTER_ARGS
+     filter the list, see parse_todo_filters().
+    Rendered pages are cached, keyed by the data version, the user and the query string, and the key digest is sent as
+     ETag, so a browser asking again for an unchanged page gets a 304 without touching SQLite or Jinja.
 
     :return: rendered html for TODO list
     """
-    db = get_db()
+    # Pages showing flashed messages are one-offs, so they are neither cached nor validated
+    cacheable = '_flashes' not in session
+    key = (data_version(), session.get('user_id'), tuple(sorted(request.args.items(multi=True))))
+    etag = make_etag(key)
+
+    if cacheable and request.if_none_match.contains(etag):
+        # 304 HTTP code means “Not Modified”, the browser shows the page it already has
+        response = make_response('', 304)
+    else:
+        page_cache = get_page_cache()
+        html = page_cache.get(key) if cacheable else MISSING
+        if html is MISSING:
+            filters = parse_todo_filters(request.args)
+            # The live updates of the page start from the last change before it was read, so any change made meanwhile
+            #  is applied again. The shards have a change feed each, so there are no live updates when sharded
+            live_updates = live_update_streams() > 0
+            since = last_change(get_read_db()) if live_updates else None
+            page = get_todo_page(before=request.args.get('before'), after=request.args.get('after'), **filters)
+            # The filters given are kept in the links to the other pages, and shown in the filter form
+            filter_args = {name: request.args[name] for name in FILTER_ARGS if request.args.get(name)}
+            # New todos are only added live to the first page of the whole list, the others only update their cards
+            live_inserts = not (request.args.get('before') or request.args.get('after') or filter_args)
+            html = render_template(
+                'todo/index.html', filter_args=filter_args, since=since, live_inserts=live_inserts, **page
+            )
+            if cacheable:
+                page_cache.set(key, html)
+        response = make_response(html)
+
+    if cacheable:
+        response.set_etag(etag)
+        # The page is personal, and the browser must check it is still fresh before using it
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+# @bp.route associates the URL '/search' with the 'search' view function
+@bp.route('/search')
+def search() -> str:
+    """
+    Full-text search of the todos, by task and description, with the best matches first and the matched words
+     highlighted. The query string arguments are 'q', the text to search, and 'page', the page number.
 
-    todos = db.execute(
-        'SELECT todo.id, todo.task, todo.description, todo.created_by, user.username, todo.created_at,'
-        ' todo.completed, todo.completed_at'
-        ' FROM todo JOIN user ON todo.created_by = user.id'
-        ' ORDER BY todo.created_at DESC'
-    ).fetchall()
+    :return: rendered html for the search results
+    """
+    text = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    found = search_todos(text, page, current_app.config.get('SEARCH_PER_PAGE', 20))
 
-    return render_template('todo/index.html', todos=todos)
+    return render_template('todo/search.html', q=text, page=page, **found)
 
 
 # @bp.route associates the URL '/create' or '/todo/create' with the 'create' view function
@@ -75,13 +474,13 @@ def create() -> str:
             flash(error)
 
         else:
-            # If validation is ok, then insert new record into datatable of database
-            db = get_db()
-            db.execute(
-                'INSERT INTO todo (task, description, created_by, completed) VALUES (?, ?, ?, 0)',
-                (task, description, g.user['id'])
-            )
-            db.commit()
+            # If validation is ok, then insert new record into datatable of database, in the shard of the user
+            with fenced(g.user['id']):
+                execute_write(
+                    'INSERT INTO todo (task, description, created_by, completed) VALUES (?, ?, ?, 0)',
+                    (task, description, g.user['id']),
+                    shard=user_shard(g.user['id'], pin=True)
+                )
 
             # After creating the todo, redirect to the index page.
             return redirect(url_for('todo.index'))
@@ -91,6 +490,29 @@ def create() -> str:
     return render_template('todo/create.html')
 
 
+def check_todo(todo,
+               id: int,
+               check_creator: bool = True) -> tuple:
+    """
+    Check that a todo exists and, optionally, that the logged in user created it.
+
+    :param todo: todo row, or None if it was not found
+    :param id: todo identifier
+    :param check_creator: whether the logged in user must be the creator of the todo
+
+    :return: tuple (HTTP status code, message) with the failed check, or None if the todo can be accessed
+    """
+    if todo is None:
+        # 404 HTTP code means “Not Found”
+        return 404, f'Todo identified with {id} does not exist.'
+
+    if check_creator and todo['created_by'] != g.user['id']:
+        # 403 HTTP code means “Forbidden”
+        return 403, None
+
+    return None
+
+
 # Both the update and delete views will need to fetch a post by id and check if the author matches the logged in user.
 # To apply DRY (Don't Repeat Yourself) principle, this method is called from each view (update or delete).
 def get_todo(id: int,
@@ -102,23 +524,15 @@ def get_todo(id: int,
 
     :return: todo data
     """
-    todo = get_db().execute(
-        'SELECT todo.id, todo.task, todo.description, todo.created_by, user.username, todo.created_at,'
-        ' todo.completed, todo.completed_at'
-        ' FROM todo JOIN user ON todo.created_by = user.id'
-        ' WHERE todo.id = ?',
-        (id, )
-    ).fetchone()
+    # The shard of the todo is known from its id
+    todos = fetch_todos(get_read_db(shard_of_todo(id)), f'SELECT {TODO_COLUMNS} FROM todo WHERE todo.id = ?', (id, ))
+    todo = todos[0] if todos else None
 
     # abort() will raise a special exception that returns an HTTP status code. It takes an optional message to show
     #  with the error, otherwise a default message is used.
-    if todo is None:
-        # 404 HTTP code means “Not Found”
-        abort(404, f'Todo identified with {id} does not exist.')
-
-    if check_creator and todo['created_by'] != g.user['id']:
-        # 403 HTTP code means “Forbidden”
-        abort(403)
+    error = check_todo(todo, id, check_creator)
+    if error is not None:
+        abort(*error)
 
     return todo
 
@@ -151,7 +565,8 @@ def update(id: int) -> str:
         description = request.form['description']
         if request.form.get('completed') == 'on':
             completed = 1
-            completed_at = dt.datetime.now()
+            # In UTC, as created_at is set by CURRENT_TIMESTAMP, so the time taken to complete the todo is right
+            completed_at = dt.datetime.utcnow()
         else:
             completed = 0
             completed_at = None
@@ -170,13 +585,13 @@ def update(id: int) -> str:
 
         else:
             # If validation is ok, then update record into datatable of database
-            db = get_db()
-            db.execute(
-                'UPDATE todo SET task = ?, description = ?, completed = ?, completed_at = ?'
-                ' WHERE id = ? AND created_by = ?',
-                (task, description, completed, completed_at, id, g.user['id'])
-            )
-            db.commit()
+            with fenced(g.user['id']):
+                execute_write(
+                    'UPDATE todo SET task = ?, description = ?, completed = ?, completed_at = ?'
+                    ' WHERE id = ? AND created_by = ?',
+                    (task, description, completed, completed_at, id, g.user['id']),
+                    shard=shard_of_todo(id)
+                )
 
             # After updating the todo, redirect to the index page.
             return redirect(url_for('todo.index'))
@@ -198,7 +613,6 @@ def update(id: int) -> str:
 # Since there is no template, it will only handle the POST method and then redirect to the index view.
 def delete(id: int):
     get_todo(id)
-    db = get_db()
-    db.execute('DELETE FROM todo WHERE id = ? AND created_by = ?', (id, g.user['id']))
-    db.commit()
+    with fenced(g.user['id']):
+        execute_write('DELETE FROM todo WHERE id = ? AND created_by = ?', (id, g.user['id']), shard=shard_of_todo(id))
     return redirect(url_for('todo.index'))
\ No newline at end of file
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+# Click: Command Line Interface Creation Kit, package to run commands in console/terminal
+import click
+# CSV: reads and writes the todos as comma separated values
+import csv
+# datetime: this module supplies classes for manipulating dates and times.
+import datetime as dt
+# IO: in-memory text buffer where each batch of CSV lines is written before being yielded
+import io
+# JSON: reads and writes the todos as newline delimited JSON
+import json
+# Time: clock used to report the import speed
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Flask.cli: "with_appcontext" guarantees the commands are called with the application context
+from flask.cli import with_appcontext
+
+from todoer.db import get_db, get_pool
+from todoer.shards import shard_count, user_shard
+from todoer.usernames import get_usernames
+
+# Columns of the exported todos, in order
+EXPORT_COLUMNS = ('id', 'task', 'description', 'created_by', 'username', 'created_at', 'completed', 'completed_at')
+# Content type of each export format
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def iter_todo_batches(conn, usernames, batch_size: int = 1000, users_conn=None):
+    """
+    Read all the todos through a single cursor, batch by batch, so only one batch is in memory at a time.
+    Reading through one statement also means one snapshot: the export is consistent even while todos change.
+
+    :param conn: database connection
+    :param usernames: map of usernames, see usernames.get_usernames()
+    :param batch_size: number of rows fetched at a time
+    :param users_conn: connection used to look up the usernames, defaults to conn
+
+    :return: generator of lists of tuples, with the EXPORT_COLUMNS values
+    """
+    cursor = conn.cursor()
+    # Plain tuples are cheaper than sqlite3.Row, and the columns are known. The timestamps are exported as the text
+    #  SQLite stores, without parsing them into datetime
+    cursor.row_factory = None
+    cursor.execute(
+        'SELECT todo.id, todo.task, todo.description, todo.created_by, CAST(todo.created_at AS TEXT),'
+        ' todo.completed, CAST(todo.completed_at AS TEXT)'
+        ' FROM todo'
+        ' ORDER BY todo.id'
+    )
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            # The username goes after created_by, as in EXPORT_COLUMNS
+            names = usernames.lookup({row[3] for row in rows}, users_conn or conn)
+            yield [row[:4] + (names.get(row[3]), ) + row[4:] for row in rows]
+    finally:
+        cursor.close()
+
+
+def _to_text(value):
+    # Timestamps are parsed into datetime by PARSE_DECLTYPES, str() gives back the same text SQLite stores
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return str(value)
+
+
+def export_todos(conn, usernames, fmt: str = 'ndjson', batch_size: int = 1000, shard_conns=None):
+    """
+    Export all the todos, as a generator of text chunks, one chunk per batch of rows.
+
+    :param conn: database connection
+    :param usernames: map of usernames, see usernames.get_usernames()
+    :param fmt: 'csv' or 'ndjson'
+    :param batch_size: number of rows per chunk
+    :param shard_conns: when sharded, connections of the shards, whose todos are exported one shard after the other,
+                        each one from its own snapshot. The usernames are still read through conn
+
+    :return: generator of str
+    """
+    def batches():
+        for source in shard_conns or [conn]:
+            yield from iter_todo_batches(source, usernames, batch_size, conn)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+        for rows in batches():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([_to_text(value) for value in row] for row in rows)
+            yield buffer.getvalue()
+    else:
+        for rows in batches():
+            yield ''.join(
+                json.dumps(dict(zip(EXPORT_COLUMNS, map(_to_text, row))), ensure_ascii=False) + '\n' for row in rows
+            )
+
+
+def stream_export(fmt: str = 'ndjson', batch_size: int = 1000):
+    """
+    Export all the todos through connections of its own, borrowed from the read-only pools for the lifetime of the
+     generator, so the export can be streamed in a response after the view has returned.
+
+    :param fmt: 'csv' or 'ndjson'
+    :param batch_size: number of rows per chunk
+
+    :return: generator of str
+    """
+    pools = [get_pool(readonly=True)] + [get_pool(readonly=True, shard=shard) for shard in range(shard_count())]
+    usernames = get_usernames()
+
+    def generate():
+        conns = []
+        try:
+            for pool in pools:
+                conns.append(pool.acquire())
+            yield from export_todos(conns[0], usernames, fmt, batch_size, conns[1:])
+        finally:
+            for pool, conn in zip(pools, conns):
+                pool.release(conn)
+
+    return generate()
+
+
+def _parse_timestamp(value):
+    """
+    Parse a timestamp of an imported todo into the text SQLite stores, in UTC as CURRENT_TIMESTAMP.
+
+    :param value: timestamp in ISO 8601 format, or an empty value
+
+    :return: timestamp as 'YYYY-MM-DD HH:MM:SS', with the fraction of a second if any, or None if there is none
+    :raise ValueError: when the value is not a valid timestamp
+    """
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f'Invalid timestamp {value!r}.')
+    timestamp = dt.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    # As exported: the fraction of a second is kept, as the completion times written by the app have one
+    return timestamp.isoformat(sep=' ')
+
+
+def _read_records(file, fmt: str):
+    # Records of the file as dicts, read one line at a time. A line that isn't a JSON object gives None, to be skipped
+    if fmt == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield record if isinstance(record, dict) else None
+
+
+def import_todos(db,
+                 file,
+                 fmt: str = 'ndjson',
+                 batch_size: int = 1000,
+                 commit_every: int = 10000,
+                 progress=None,
+                 route=None) -> dict:
+    """
+    Import todos, inserting them with executemany in batches and committing every so many rows, so memory stays flat
+     and the write lock is released regularly for the live traffic.
+    The todos get new ids. Their creator is looked up by username, or else by the created_by identifier, and the todos
+     of unknown users are skipped, as are the ones with invalid timestamps or a task or description that isn't text,
+     and the lines that aren't a JSON object. A completed todo without completion time is taken as completed when
+     imported.
+
+    :param db: database connection, where the users are read
+    :param file: text file with the todos, as written by export_todos
+    :param fmt: 'csv' or 'ndjson'
+    :param batch_size: number of rows per executemany
+    :param commit_every: number of rows per transaction
+    :param progress: function called after each commit with the counters so far
+    :param route: when sharded, function called with the id of a user that returns the connection to the shard of
+                  their todos. Defaults to inserting every todo through db
+
+    :return: counters: rows imported, rows skipped, seconds and rows per second
+    """
+    users = {row[1]: row[0] for row in db.execute('SELECT id, username FROM user')}
+    user_ids = set(users.values())
+    counters = {'imported': 0, 'skipped': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    started = time.perf_counter()
+    # The rows of the current batch, by the connection where they are inserted
+    batches, uncommitted = {}, 0
+
+    def report():
+        counters['seconds'] = time.perf_counter() - started
+        counters['rows_per_second'] = counters['imported'] / counters['seconds'] if counters['seconds'] else 0.0
+        if progress is not None:
+            progress(counters)
+
+    def flush():
+        for target, batch in batches.items():
+            target.executemany(
+                'INSERT INTO todo (task, description, created_by, created_at, completed, completed_at)'
+                ' VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?)',
+                batch
+            )
+            counters['imported'] += len(batch)
+            batch.clear()
+
+    def commit():
+        for target in batches:
+            target.commit()
+
+    for record in _read_records(file, fmt):
+        if record is None:
+            counters['skipped'] += 1
+            continue
+        created_by = users.get(record.get('username'))
+        if created_by is None:
+            try:
+                created_by = int(record.get('created_by'))
+            except (TypeError, ValueError):
+                pass
+        # Any other value would fail the whole batch of the executemany
+        task, description = record.get('task'), record.get('description') or ''
+        if created_by not in user_ids or not task or not isinstance(task, str) or not isinstance(description, str):
+            counters['skipped'] += 1
+            continue
+        try:
+            created_at = _parse_timestamp(record.get('created_at'))
+            completed_at = _parse_timestamp(record.get('completed_at'))
+        except ValueError:
+            counters['skipped'] += 1
+            continue
+        completed = 1 if str(record.get('completed')) in ('1', 'True', 'true') else 0
+        if not completed:
+            completed_at = None
+        elif completed_at is None:
+            completed_at = _parse_timestamp(dt.datetime.utcnow().isoformat())
+
+        batches.setdefault(db if route is None else route(created_by), []).append((
+            task, description, created_by, created_at, completed, completed_at
+        ))
+        pending = sum(map(len, batches.values()))
+        if pending >= batch_size:
+            uncommitted += pending
+            flush()
+        if uncommitted >= commit_every:
+            commit()
+            uncommitted = 0
+            report()
+
+    flush()
+    commit()
+    db.commit()
+    report()
+    return counters
+
+
+def _guess_format(fmt: str, filename: str) -> str:
+    if fmt:
+        return fmt
+    return 'csv' if filename.lower().endswith('.csv') else 'ndjson'
+
+
+# click.command() defines a command line, command called export-todos. To invoke it, run in CLI:
+#  flask export-todos todos.ndjson
+@click.command('export-todos')
+@click.argument('output', type=click.File('w', encoding='utf8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(('csv', 'ndjson')), help='Defaults by the file extension.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows read and written at a time.')
+@with_appcontext
+def export_todos_command(output, fmt, batch_size):
+    """
+    Export all the todos to a CSV or NDJSON file, or to the standard output.
+    """
+    for chunk in stream_export(_guess_format(fmt, output.name), batch_size):
+        output.write(chunk)
+
+
+# click.command() defines a command line, command called import-todos. To invoke it, run in CLI:
+#  flask import-todos todos.ndjson
+@click.command('import-todos')
+@click.argument('input', type=click.File('r', encoding='utf8'))
+@click.option('--format', 'fmt', type=click.Choice(('csv', 'ndjson')), help='Defaults by the file extension.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows inserted by each executemany.')
+@click.option('--commit-every', default=None, type=int,
+              help='Rows per transaction, defaults to the IMPORT_COMMIT_INTERVAL configuration key.')
+@with_appcontext
+def import_todos_command(input, fmt, batch_size, commit_every):
+    """
+    Import todos from a CSV or NDJSON file, as written by export-todos, adding them to the existing ones.
+    """
+    def progress(counters):
+        click.echo(f'{counters["imported"]} rows imported, {counters["rows_per_second"]:.0f} rows/s', err=True)
+
+    counters = import_todos(
+        get_db(), input, _guess_format(fmt, input.name), batch_size,
+        commit_every or current_app.config.get('IMPORT_COMMIT_INTERVAL', 10000), progress,
+        # When sharded, the todos of each user go to their shard
+        (lambda user_id: get_db(user_shard(user_id, pin=True))) if shard_count() else None
+    )
+    click.echo(
+        f'Imported {counters["imported"]} todos, skipped {counters["skipped"]},'
+        f' in {counters["seconds"]:.2f} seconds ({counters["rows_per_second"]:.0f} rows/s).'
+    )
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+
+from todoer.cache import LRUCache, MISSING
+from todoer.db import get_read_db
+
+# Maximum number of ids bound to a single "IN (...)" query, below the SQLite limit of host parameters
+_IDS_PER_QUERY = 500
+
+
+class UsernameMap:
+    """
+    In-memory map from user id to username. A username never changes once the user registers, so it can be kept
+     without expiring, and the queries that list todos don't need to JOIN the user table to show it.
+    The map is filled lazily: the ids not known yet, e.g. users registered in another process, are looked up in one
+     query per batch of rows, and then kept. It is an LRUCache, so it keeps at most maxsize users, the least recently
+     shown ones are evicted first.
+    """
+
+    def __init__(self,
+                 maxsize: int = 16384,
+                 ttl: float = None):
+        """
+        :param maxsize: maximum number of usernames kept
+        :param ttl: seconds a username is kept, None or 0 to keep it until evicted
+        """
+        self._names = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def add(self, user_id: int, username: str):
+        """
+        Record the username of a user, e.g. right after registering it.
+        """
+        self._names.set(user_id, username)
+
+    def lookup(self, user_ids, conn=None) -> dict:
+        """
+        :param user_ids: user identifiers
+        :param conn: database connection used to look up the unknown ids, defaults to get_read_db()
+
+        :return: new map from user id to username, with the requested ids that exist
+        """
+        names = {}
+        missing = []
+        for user_id in set(user_ids):
+            username = self._names.get(user_id)
+            if username is MISSING:
+                missing.append(user_id)
+            else:
+                names[user_id] = username
+        if missing:
+            conn = conn or get_read_db()
+            for start in range(0, len(missing), _IDS_PER_QUERY):
+                chunk = missing[start:start + _IDS_PER_QUERY]
+                for user_id, username in conn.execute(
+                        f'SELECT id, username FROM user WHERE id IN ({", ".join("?" * len(chunk))})', chunk
+                ):
+                    self._names.set(user_id, username)
+                    names[user_id] = username
+        return names
+
+    def attach(self, rows, conn=None) -> list:
+        """
+        Add the username of the creator to todo rows.
+
+        :param rows: todo rows, with a created_by column
+        :param conn: database connection used to look up the unknown ids, defaults to get_read_db()
+
+        :return: list of dicts, the columns of each row plus 'username'
+        """
+        rows = list(rows)
+        if rows:
+            # zip() over the values of each row is much cheaper than dict(row), which looks up each key by name
+            keys = rows[0].keys()
+            rows = [dict(zip(keys, row)) for row in rows]
+        names = self.lookup({row['created_by'] for row in rows}, conn)
+        for row in rows:
+            row['username'] = names.get(row['created_by'])
+        return rows
+
+    def stats(self) -> dict:
+        return self._names.stats()
+
+
+def get_usernames() -> UsernameMap:
+    """
+    :return: map from user id to username of the current app, created on first use, sized by USERNAME_CACHE_SIZE and
+     USERNAME_CACHE_TTL
+    """
+    usernames = current_app.extensions.get('usernames')
+    if usernames is None:
+        usernames = current_app.extensions.setdefault('usernames', UsernameMap(
+            maxsize=current_app.config.get('USERNAME_CACHE_SIZE', 16384),
+            ttl=current_app.config.get('USERNAME_CACHE_TTL')
+        ))
+    return usernames
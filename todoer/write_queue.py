@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent.futures: each request waits on a future until the transaction with its write is committed
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+# Queue: the writes wait in a queue for the writer thread
+import queue
+# SQLite3: support for SQLite
+import sqlite3
+# Threading: the writer thread, and the lock of the statistics
+import threading
+# Time: clocks used to wait for the batch window and to measure the batches
+import time
+
+# Flask: "current_app" is a special object that points to the Flask application handling the request
+from flask import current_app
+# Werkzeug: has inbuilt functions to handle exceptions that return an HTTP status code.
+from werkzeug.exceptions import abort
+
+from todoer.db import get_db, get_pool
+from todoer.render_cache import bump_data_version
+
+# Put in the queue by WriteQueue.close(), after the last write the writer thread applies
+_STOP = object()
+
+
+class WriteQueueClosedError(RuntimeError):
+    """
+    Raised by the future of a write submitted once the write queue is closed, as when the server stops.
+    """
+
+
+class WriteQueue:
+    """
+    Group commit: the writes of many requests are applied by a single writer thread, in one transaction per batch,
+     instead of one transaction per request. A batch takes the writes that arrive within a short window after the first
+     one, up to a maximum, so under a burst the cost of each commit is shared by the whole batch.
+    Each write runs inside its own savepoint, so a write that fails is rolled back alone and the rest of the batch is
+     committed. The request that submitted a write waits on its future until the batch is committed, so it only
+     answers once its change is as durable as with its own commit.
+    Each shard has its own queue and writer thread, so the shards commit their batches in parallel.
+    Every future is resolved: with the rows changed, with the error of the write or of its batch, or, once the queue
+     is closed, with WriteQueueClosedError.
+    """
+
+    def __init__(self,
+                 app,
+                 window: float = 0.002,
+                 max_batch: int = 256,
+                 timeout: float = 10.0,
+                 shard: int = None):
+        """
+        :param app: application, whose writer pool and data version the writer thread uses
+        :param window: seconds the writer waits for more writes after the first one of a batch, 0 to only batch the
+                       writes already queued
+        :param max_batch: maximum number of writes per transaction
+        :param timeout: seconds a request waits for its write to be committed
+        :param shard: shard whose writes are applied, None for the main database
+        """
+        self.app = app
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.shard = shard
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self._stats = dict.fromkeys(('writes', 'failed', 'batches', 'max_batch_size'), 0)
+        self._stats['commit_seconds_total'] = 0.0
+
+    def submit(self, sql: str, parameters=()) -> Future:
+        """
+        Queue a write.
+
+        :param sql: SQL statement
+        :param parameters: parameters of the statement
+
+        :return: future with the number of rows changed, once the write is committed
+        """
+        future = Future()
+        # Under the lock, so a write is either queued before close() stops the writer thread, or refused
+        with self._lock:
+            if not self._closed:
+                self._ensure_thread()
+                self._queue.put((sql, parameters, future))
+                return future
+        future.set_exception(WriteQueueClosedError('The write queue is closed.'))
+        return future
+
+    def close(self, timeout: float = None):
+        """
+        Stop the writer thread once the writes already queued are committed, as when the server stops. The writes
+         submitted afterwards are refused.
+
+        :param timeout: seconds to wait for the writer thread
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread if self._pid == os.getpid() and self._thread.is_alive() else None
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                return
+        # Writes left without a thread to apply them
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                item[2].set_exception(WriteQueueClosedError('The write queue is closed.'))
+
+    def execute(self, sql: str, parameters=()) -> int:
+        """
+        Queue a write and wait until it is committed.
+
+        :param sql: SQL statement
+        :param parameters: parameters of the statement
+
+        :return: number of rows changed
+        """
+        return self.submit(sql, parameters).result(self.timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['window'] = self.window
+        stats['mean_batch_size'] = stats['writes'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def _ensure_thread(self):
+        # Called under the lock. The thread doesn't survive a fork, so each worker process starts its own
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            if self._pid != os.getpid():
+                # Writes queued by the parent process are not this process's to apply
+                self._queue = queue.Queue()
+            name = 'todoer-writer' if self.shard is None else f'todoer-writer-{self.shard}'
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _next_batch(self) -> tuple:
+        # The writes of the next batch, and whether close() asked the thread to stop after them
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        with self.app.app_context():
+            pool = get_pool(shard=self.shard)
+            while True:
+                batch, stopping = self._next_batch()
+                if batch:
+                    self._write(pool, batch)
+                if stopping:
+                    return
+
+    def _write(self, pool, batch: list):
+        # Apply a batch and resolve the future of each of its writes
+        started = time.perf_counter()
+        try:
+            conn = pool.acquire()
+            try:
+                results = self._apply(conn, batch)
+            finally:
+                pool.release(conn)
+        except Exception as e:
+            # The whole batch failed, e.g. the database is locked by another process beyond busy_timeout
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        seconds = time.perf_counter() - started
+        try:
+            bump_data_version()
+        finally:
+            # The batch is committed, so its futures are resolved even if the data version can't be bumped
+            for (_, _, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        with self._lock:
+            self._stats['writes'] += len(batch)
+            self._stats['failed'] += sum(isinstance(result, Exception) for result in results)
+            self._stats['batches'] += 1
+            self._stats['max_batch_size'] = max(self._stats['max_batch_size'], len(batch))
+            self._stats['commit_seconds_total'] += seconds
+
+    @staticmethod
+    def _apply(conn, batch: list) -> list:
+        # One transaction for the batch, one savepoint for each write
+        results = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, parameters, _ in batch:
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append(conn.execute(sql, parameters).rowcount)
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO write')
+                    results.append(e)
+                conn.execute('RELEASE write')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return results
+
+
+def get_write_queue(shard: int = None) -> WriteQueue:
+    """
+    Get the write queue of the current app, created on first use with the WRITE_QUEUE_* configuration keys.
+
+    :param shard: get the write queue of this shard instead of the one of the main database
+
+    :return: write queue, or None when WRITE_QUEUE is disabled
+    """
+    key = 'write_queue' if shard is None else f'write_queue_{shard}'
+    write_queue = current_app.extensions.get(key)
+    if write_queue is None and current_app.config.get('WRITE_QUEUE', False):
+        config = current_app.config
+        write_queue = current_app.extensions.setdefault(key, WriteQueue(
+            current_app._get_current_object(),
+            window=config.get('WRITE_QUEUE_WINDOW', 0.002),
+            max_batch=config.get('WRITE_QUEUE_MAX_BATCH', 256),
+            timeout=config.get('WRITE_QUEUE_TIMEOUT', 10.0),
+            shard=shard
+        ))
+    return write_queue
+
+
+def close_write_queues(app, timeout: float = None):
+    """
+    Close the write queues of an app, the ones of the shards too, once the writes already queued are committed.
+
+    :param app: application
+    :param timeout: seconds to wait for each writer thread
+    """
+    for extension in list(app.extensions.values()):
+        if isinstance(extension, WriteQueue):
+            extension.close(timeout)
+
+
+def execute_write(sql: str, parameters=(), shard: int = None) -> int:
+    """
+    Run and commit a single write of a request: through the write queue, batched with the writes of other requests,
+     when it is enabled, or else in its own transaction. Either way, it returns once the write is committed, and the
+     cached pages are invalidated.
+    When the queue doesn't commit the write within WRITE_QUEUE_TIMEOUT the request is refused, although the write may
+     still be committed later.
+
+    :param sql: SQL statement
+    :param parameters: parameters of the statement
+    :param shard: shard where the write is made, None for the main database
+
+    :return: number of rows changed
+    """
+    write_queue = get_write_queue(shard)
+    if write_queue is not None:
+        try:
+            return write_queue.execute(sql, parameters)
+        except FutureTimeoutError:
+            # 503 HTTP code means “Service Unavailable”
+            abort(503, 'The server is busy, try again in a moment.')
+        except WriteQueueClosedError:
+            abort(503, 'The server is stopping, try again in a moment.')
+
+    db = get_db(shard)
+    try:
+        rowcount = db.execute(sql, parameters).rowcount
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    bump_data_version()
+    return rowcount
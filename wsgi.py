@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+# WSGI entry point, for WSGI servers such as gunicorn or uWSGI, e.g.: gunicorn --workers 4 --threads 2 wsgi:app
+# It loads the production settings over config.py, unless the environment variable TODOER_SETTINGS points to others.
+
+# OS: library that allows access to functionalities dependent on the Operating System.
+import os
+
+from todoer import create_app
+from todoer.server import PRODUCTION_SETTINGS, warm_up
+
+os.environ.setdefault('TODOER_SETTINGS', PRODUCTION_SETTINGS)
+
+app = create_app()
+# Open the database connections and compile the templates before the first request
+warm_up(app, app.config.get('THREADS_PER_PAGE', 2))